@@ -2,8 +2,8 @@
 """
 door - NWP CMC Global Deterministic Forecast System
 
-__date__ = '20230703'
-__version__ = '1.0.0'
+__date__ = '20261017'
+__version__ = '1.1.0'
 __author__ =
         'Andrea Libertino (andrea.libertino@cimafoundation.org',
 __library__ = 'DOOR'
@@ -13,12 +13,15 @@ python3 door_downloader_nwp_icon_global.py -settings_file configuration.json -ti
 
 Version(s):
 20230703 (1.0.0) --> Beta release
+20261017 (1.1.0) --> Decode the forecast steps in parallel with ecCodes into a preallocated array cropped to the domain
+                     instead of open_mfdataset with cfgrib and a global crop
 """
 # -------------------------------------------------------------------------------------
 
 # -------------------------------------------------------------------------------------
 # Complete library
 import datetime as dt
+import eccodes
 import json
 import logging
 import shutil
@@ -35,6 +38,7 @@ from copy import deepcopy
 from math import floor, ceil
 import requests
 import time
+from concurrent.futures import ProcessPoolExecutor
 from multiprocessing import cpu_count
 from multiprocessing.pool import ThreadPool
 import glob
@@ -43,8 +47,8 @@ import glob
 # -------------------------------------------------------------------------------------
 # Algorithm information
 alg_name = 'DOOR - NWP CMC Global Deterministic Forecast System'
-alg_version = '1.0.0'
-alg_release = '2023-07-03'
+alg_version = '1.1.0'
+alg_release = '2026-10-17'
 # Algorithm parameter(s)
 time_format = '%Y%m%d%H%M'
 # -------------------------------------------------------------------------------------
@@ -100,6 +104,9 @@ def main():
             cpu_cores = cpu_count() - 1
     else:
         cpu_cores = 1
+    cpu_decode = data_settings["algorithm"]["ancillary"].get("process_decode", None)
+    if cpu_decode is None:
+        cpu_decode = max(cpu_count() - 1, 1)
 
     # Model settings
     logging.info(" ---> Model settings...")
@@ -187,29 +194,17 @@ def main():
             shutil.rmtree(ancillary_out_var)
             raise FileNotFoundError(" -> Size of the downloaded forecast step is < 1000 byte! Forecast is unavailable or corrupted!")
 
-        logging.info( "---> Open and merge forecast time steps... It can take some minutes...")
-        with xr.open_mfdataset(out_files_unzipped, concat_dim='valid_time', data_vars='minimal', combine='nested', coords='minimal',
-                               compat='override', engine="cfgrib") as ds:
-            ds = ds.where((ds.latitude <= data_settings['data']['static']['bounding_box']["lat_top"]) &
-                          (ds.latitude >= data_settings['data']['static']['bounding_box']["lat_bottom"]) &
-                          (ds.longitude >= data_settings['data']['static']['bounding_box']["lon_left"]) &
-                          (ds.longitude <= data_settings['data']['static']['bounding_box']["lon_right"]), drop=True)
+        logging.info("---> Decode and merge forecast time steps...")
+        frc_out_var = read_data_grib(out_files_unzipped, forecast_steps, time_run,
+                                     data_settings['data']['static']['bounding_box'], cpu_decode)
 
-            var_names = [vars for vars in ds.data_vars.variables.mapping]
-            if len(var_names) > 1:
-                logging.error("ERROR! Only one variable should be in the grib file, check file integrity!")
-                raise TypeError
-            var_name = var_names[0]
-
-            ds = ds[var_name].drop("time").rename({"longitude":"lon", "latitude":"lat", "valid_time":"time"})
-
-            if first_step is True:
-                frc_out = xr.Dataset({data_settings['data']['dynamic']["variables"][var]:ds})
-                first_step = False
-            else:
-                frc_out[data_settings['data']['dynamic']["variables"][var]] = ds
+        if first_step is True:
+            frc_out = xr.Dataset({data_settings['data']['dynamic']["variables"][var]:frc_out_var})
+            first_step = False
+        else:
+            frc_out[data_settings['data']['dynamic']["variables"][var]] = frc_out_var
 
-            logging.info("---> Open and merge forecast time steps...DONE")
+        logging.info("---> Decode and merge forecast time steps...DONE")
 
         logging.info(" --> Compute variable: " + var + "...DONE")
     # -------------------------------------------------------------------------------------
@@ -402,6 +397,90 @@ def download_parallel(in_out_files, cpu_cores):
         print(' --> Compute:', result)
 # ----------------------------------------------------------------------------
 
+# ----------------------------------------------------------------------------
+# Method to decode the forecast steps of a variable in parallel into a preallocated (time, lat, lon) array cropped
+# to the domain (grid and crop indexes computed once from the first step)
+def read_data_grib(file_list, forecast_steps, time_run, data_bbox, cpu_decode):
+    with open(file_list[0], 'rb') as file_handle:
+        grib_id = eccodes.codes_grib_new_from_file(file_handle)
+    if grib_id is None:
+        raise IOError("No grib message found in " + file_list[0])
+    try:
+        grid_lat, grid_lon, grid_shape, grid_idx = set_grid_grib(grib_id, data_bbox)
+    finally:
+        eccodes.codes_release(grib_id)
+
+    var_values = np.full((len(file_list), grid_lat.shape[0], grid_lon.shape[0]), np.nan, dtype=np.float32)
+    var_attrs = {}
+    with ProcessPoolExecutor(max_workers=min(cpu_decode, len(file_list))) as process_pool:
+        step_results = process_pool.map(read_file_grib, file_list, [grid_shape] * len(file_list),
+                                        [grid_idx] * len(file_list))
+        for step_id, (file_path, step_result) in enumerate(zip(file_list, step_results)):
+            if step_result is None:
+                logging.warning(" WARNING! Forecast step " + str(forecast_steps[step_id]) + " not available!")
+                continue
+            var_values[step_id, :, :], var_attrs = step_result
+
+    return xr.DataArray(var_values, dims=["time", "lat", "lon"], attrs=var_attrs,
+                        coords={"time": pd.DatetimeIndex([time_run + pd.Timedelta(str(t) + "H") for t in forecast_steps]),
+                                "lat": grid_lat, "lon": grid_lon})
+# ----------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------
+# Method to read the values cropped to the domain and the attributes of a single message grib file (None if the file
+# can not be decoded)
+def read_file_grib(file_path, grid_shape, grid_idx):
+    grib_id = None
+    try:
+        with open(file_path, 'rb') as file_handle:
+            grib_id = eccodes.codes_grib_new_from_file(file_handle)
+        if grib_id is None:
+            raise IOError("No grib message found in " + file_path)
+        values = eccodes.codes_get_values(grib_id)
+        if eccodes.codes_get(grib_id, 'bitmapPresent'):
+            values[values == eccodes.codes_get(grib_id, 'missingValue')] = np.nan
+        attrs = {'long_name': eccodes.codes_get(grib_id, 'name'), 'units': eccodes.codes_get(grib_id, 'units')}
+        return values.reshape(grid_shape)[grid_idx['lat'], :][:, grid_idx['lon']].astype(np.float32), attrs
+    except Exception as e:
+        logging.warning(" WARNING! Forecast file " + file_path + " can not be decoded: " + str(e))
+        return None
+    finally:
+        if grib_id is not None:
+            eccodes.codes_release(grib_id)
+# ----------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------
+# Method to define the grid coordinates (as decoded by ecCodes and cfgrib) and the crop indexes
+def set_grid_grib(grib_id, data_bbox):
+    grid_lat = np.linspace(eccodes.codes_get(grib_id, 'latitudeOfFirstGridPointInDegrees'),
+                           eccodes.codes_get(grib_id, 'latitudeOfLastGridPointInDegrees'),
+                           eccodes.codes_get(grib_id, 'Nj'))
+    grid_lon_first = eccodes.codes_get(grib_id, 'longitudeOfFirstGridPointInDegrees')
+    grid_lon_last = eccodes.codes_get(grib_id, 'longitudeOfLastGridPointInDegrees')
+    # Grid crossing the antimeridian (e.g. first longitude 180 encoded for -180)
+    if grid_lon_last < grid_lon_first:
+        grid_lon_first = grid_lon_first - 360
+    grid_lon = np.linspace(grid_lon_first, grid_lon_last, eccodes.codes_get(grib_id, 'Ni'))
+    grid_shape = (grid_lat.shape[0], grid_lon.shape[0])
+
+    grid_idx = {'lat': set_crop_index((grid_lat <= data_bbox["lat_top"]) & (grid_lat >= data_bbox["lat_bottom"])),
+                'lon': set_crop_index((grid_lon >= data_bbox["lon_left"]) & (grid_lon <= data_bbox["lon_right"]))}
+
+    return grid_lat[grid_idx['lat']], grid_lon[grid_idx['lon']], grid_shape, grid_idx
+# ----------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------
+# Method to convert a coordinate mask to a slice (view of the values) or, if not contiguous, to an index array
+def set_crop_index(grid_mask):
+    grid_idx = np.where(grid_mask)[0]
+    if grid_idx.shape[0] == 0:
+        logging.error(" --> ERROR! Bounding box does not intersect the forecast grid!")
+        raise ValueError("Bounding box does not intersect the forecast grid")
+    if grid_idx[-1] - grid_idx[0] + 1 == grid_idx.shape[0]:
+        return slice(int(grid_idx[0]), int(grid_idx[-1]) + 1)
+    return grid_idx
+# ----------------------------------------------------------------------------
+
 # ----------------------------------------------------------------------------
 def decompress_file(filepath):
     zipfile = bz2.BZ2File(filepath)  # open the file
@@ -2,8 +2,8 @@
 """
 door - NWP ICON GLOBAL
 
-__date__ = '20231023'
-__version__ = '1.0.2'
+__date__ = '20261017'
+__version__ = '1.4.0'
 __author__ =
         'Andrea Libertino (andrea.libertino@cimafoundation.org',
 __library__ = 'DOOR'
@@ -15,12 +15,21 @@ Version(s):
 20230626 (1.0.0) --> Beta release
 20230920 (1.0.1) --> Drop useless dimensions for Continuum compatibility
 20231023 (1.0.2) --> Add radiation computing
+20261017 (1.1.0) --> Remap each step in process with a sparse matrix restricted to the domain (cdo weights loaded once)
+                     instead of a global cdo remap of every step file; cdo is no longer required
+20261017 (1.2.0) --> Stream downloads to disk and decompress, decode and remap the steps in a process pool
+                     (bz2 decompressed by chunks straight into memory, no decompressed file written)
+20261017 (1.3.0) --> Download all the (variable, step) pairs through a single queue and merge each variable as soon as its
+                     steps are computed
+20261017 (1.4.0) --> Plan the downloads on the directory listings (only the published steps are scheduled, the missing ones
+                     are polled again)
 """
 # -------------------------------------------------------------------------------------
 
 # -------------------------------------------------------------------------------------
 # Complete library
 import datetime as dt
+import eccodes
 import json
 import logging
 import shutil
@@ -28,6 +37,7 @@ import shutil
 import numpy as np
 import os
 import pandas as pd
+import scipy.sparse as sp
 import xarray as xr
 import bz2
 import tarfile
@@ -35,8 +45,11 @@ import tarfile
 from argparse import ArgumentParser
 from copy import deepcopy
 from math import floor, ceil
+import queue
+import re
 import requests
 import time
+from concurrent.futures import ProcessPoolExecutor
 from multiprocessing import cpu_count
 from multiprocessing.pool import ThreadPool
 import glob
@@ -45,10 +58,11 @@ import glob
 # -------------------------------------------------------------------------------------
 # Algorithm information
 alg_name = 'DOOR - NWP ICON Global'
-alg_version = '1.0.2'
-alg_release = '2023-10-23'
+alg_version = '1.4.0'
+alg_release = '2026-10-17'
 # Algorithm parameter(s)
 time_format = '%Y%m%d%H%M'
+chunk_size = 1024 * 1024
 # -------------------------------------------------------------------------------------
 
 # -------------------------------------------------------------------------------------
@@ -102,13 +116,20 @@ def main():
             cpu_cores = cpu_count() - 1
     else:
         cpu_cores = 1
+    cpu_decompress = data_settings["algorithm"]["ancillary"].get("process_decompress", None)
+    if data_settings["algorithm"]["flags"].get("downloading_listing", False):
+        listing_settings = {"poll_interval": data_settings["algorithm"]["ancillary"].get("listing_poll_interval", 60),
+                            "poll_max": data_settings["algorithm"]["ancillary"].get("listing_poll_max", 10)}
+    else:
+        listing_settings = None
+    if cpu_decompress is None:
+        cpu_decompress = max(cpu_count() - 1, 1)
 
     # Model settings
     logging.info(" ---> Model settings...")
     model = data_settings["data"]["dynamic"]["input"]["model_type"]
     global model_settings
     model_settings = {}
-    model_settings["cdo_path"] = data_settings["algorithm"]["ancillary"]["cdo_path"]
     logging.info(" ----> Set up model " + model)
 
     if model == "ICON0p125":
@@ -151,21 +172,30 @@ def main():
     data_settings['data']['static']['bounding_box']["lat_top"] = data_settings['data']['static']['bounding_box']["lat_top"]
     data_settings['data']['static']['bounding_box']["lon_right"] = data_settings['data']['static']['bounding_box']["lon_right"]
 
+    logging.info(" ----> Build remapping matrix for the domain...")
+    model_settings["remap_matrix"], model_settings["lat"], model_settings["lon"] = \
+        set_remap_matrix(model_settings["weigths_file"], data_settings['data']['static']['bounding_box'])
+    logging.info(" ----> Build remapping matrix for the domain...DONE")
+
+    # Decompression, decoding and remapping are cpu bound: they run in a process pool fed by the download threads
+    process_pool = ProcessPoolExecutor(max_workers=cpu_decompress, initializer=set_worker,
+                                       initargs=(model_settings["remap_matrix"], model_settings["lat"], model_settings["lon"]))
+
     logging.info(" --> Set up algorithm...DONE")
     # -------------------------------------------------------------------------------------
 
     # -------------------------------------------------------------------------------------
-    # Download and compute variables
-    first_step = True
+    # Download and compute variables (all the (variable, step) pairs go through a single download queue and each
+    # variable is merged as soon as all of its steps are computed)
     var_folders = []
+    var_files = {}
+    inputs = []
 
     for var in variables:
-        logging.info(" --> Compute variable: " + var)
         template_filled["var"] = var
         template_filled["VAR"] = var.upper()
         template_filled["step"] = "{step}"
 
-        logging.info(" ---> Download forecast data...")
         ancillary_out_var = os.path.join(ancillary_fld,var,"")
         if os.path.isdir(ancillary_out_var):
             shutil.rmtree(ancillary_out_var)
@@ -176,49 +206,51 @@ def main():
 
         url_var = url_blank.format(**template_filled)
         urls = [url_var.format(step=str(t).zfill(3)) for t in forecast_steps]
-        out_files = [out_file.format(step=str(t).zfill(3)) for t in forecast_steps]
-
-        inputs = zip(urls, out_files)
-
-        if data_settings["algorithm"]["flags"]["downloading_mp"]:
-            logging.info(" ----> Start download in parallel mode...")
-        else:
-            logging.info(" ----> Start download in serial mode...")
-        download_parallel(inputs,cpu_cores)
-        logging.info(" ---> Download forecast data...DONE")
-
-        out_files_unzipped = [i.replace(".bz2", "").replace("frc", "regr_frc") for i in out_files]
-
-        if os.path.getsize(out_files_unzipped[0]) < 1000:
-            logging.error(" ERROR! First file of the forecast is empty, possibly forecast file is not available yet!")
-            shutil.rmtree(ancillary_out_var)
-            raise FileNotFoundError(" -> Size of the downloaded forecast step is < 1000 byte! Forecast is unavailable or corrupted!")
-
-        logging.info( "---> Open and merge forecast time steps... It can take some minutes...")
-        with xr.open_mfdataset(out_files_unzipped, concat_dim='valid_time', data_vars='minimal', combine='nested', coords='minimal',
-                               compat='override', engine="cfgrib") as ds:
-            ds = ds.where((ds.latitude <= data_settings['data']['static']['bounding_box']["lat_top"]) &
-                          (ds.latitude >= data_settings['data']['static']['bounding_box']["lat_bottom"]) &
-                          (ds.longitude >= data_settings['data']['static']['bounding_box']["lon_left"]) &
-                          (ds.longitude <= data_settings['data']['static']['bounding_box']["lon_right"]), drop=True)
-
-            var_names = [vars for vars in ds.data_vars.variables.mapping]
-            if len(var_names) > 1:
-                logging.error("ERROR! Only one variable should be in the grib file, check file integrity!")
-                raise TypeError
-            var_name = var_names[0]
-
-            ds = ds[var_name].drop("time").rename({"longitude":"lon", "latitude":"lat", "valid_time":"time"})
+        var_files[var] = [out_file.format(step=str(t).zfill(3)) for t in forecast_steps]
 
-            if first_step is True:
-                frc_out = xr.Dataset({data_settings['data']['dynamic']["variables"][var]:ds})
-                first_step = False
-            else:
-                frc_out[data_settings['data']['dynamic']["variables"][var]] = ds
+        inputs += [(url, out_file_step, var) for url, out_file_step in zip(urls, var_files[var])]
 
-            logging.info("---> Open and merge forecast time steps...DONE")
+    logging.info(" ---> Download forecast data...")
+    if data_settings["algorithm"]["flags"]["downloading_mp"]:
+        logging.info(" ----> Start download in parallel mode...")
+    else:
+        logging.info(" ----> Start download in serial mode...")
 
-        logging.info(" --> Compute variable: " + var + "...DONE")
+    frc_vars = {}
+    out_iterator = download_parallel(inputs, cpu_cores, process_pool, var_files, listing_settings=listing_settings)
+    try:
+        for var, out_results in out_iterator:
+            logging.info(" --> Compute variable: " + var)
+            out_files = var_files[var]
+
+            if out_results.get(out_files[0]) is None:
+                logging.error(" ERROR! First file of the forecast is empty, possibly forecast file is not available yet!")
+                shutil.rmtree(os.path.join(ancillary_fld,var,""))
+                raise FileNotFoundError(" -> First forecast step not downloaded or not decoded! Forecast is unavailable or corrupted!")
+
+            logging.info("---> Merge forecast time steps...")
+            var_values = np.full((len(forecast_steps), model_settings["lat"].shape[0], model_settings["lon"].shape[0]),
+                                 np.nan, dtype=np.float32)
+            var_attrs = {}
+            for step_id, out_file_step in enumerate(out_files):
+                if out_results.get(out_file_step) is None:
+                    logging.warning(" WARNING! Forecast step " + str(forecast_steps[step_id]) + " not available!")
+                    continue
+                var_values[step_id, :, :], var_attrs = out_results[out_file_step]
+
+            frc_vars[var] = xr.DataArray(var_values, dims=["time", "lat", "lon"], attrs=var_attrs,
+                                         coords={"time": pd.DatetimeIndex([time_run + pd.Timedelta(str(t) + "H") for t in forecast_steps]),
+                                                 "lat": model_settings["lat"], "lon": model_settings["lon"]})
+            logging.info("---> Merge forecast time steps...DONE")
+
+            logging.info(" --> Compute variable: " + var + "...DONE")
+    finally:
+        # Stop the download threads and the workers also when a variable fails (e.g. first step not available)
+        out_iterator.close()
+        process_pool.shutdown(cancel_futures=True)
+    logging.info(" ---> Download forecast data...DONE")
+
+    frc_out = xr.Dataset({data_settings['data']['dynamic']["variables"][var]: frc_vars[var] for var in variables})
     # -------------------------------------------------------------------------------------
 
     # -------------------------------------------------------------------------------------
@@ -401,35 +433,221 @@ def fill_template(templates, time_now):
 # -------------------------------------------------------------------------------------
 
 # -------------------------------------------------------------------------------------
+# Method to download a forecast step (streamed to disk by chunks)
 def download_url(args):
-    url, fn = args[0], args[1]
+    url, fn, var = args[0], args[1], args[2]
     try:
-        r = requests.get(url)
-        with open(fn, 'wb') as f:
-            f.write(r.content)
-        decompress_file(fn)
-        os.remove(fn)
-        os.system(model_settings["cdo_path"] + " -O remap," + model_settings["grid_file"] + ","+ model_settings["weigths_file"] +" " + fn[:-4] + " " + fn[:-4].replace("frc","regr_frc"))
-        os.remove(fn[:-4])
-        return fn
+        with requests.get(url, stream=True) as r:
+            r.raise_for_status()
+            with open(fn + ".part", 'wb') as f:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+        os.replace(fn + ".part", fn)
+        return fn, var, True
     except Exception as e:
         print('Exception in download_url():', e)
+        return fn, var, False
 # -------------------------------------------------------------------------------------
 
 # -------------------------------------------------------------------------------------
-def download_parallel(in_out_files, cpu_cores):
-    cpus = cpu_cores
-    results = ThreadPool(cpus).imap_unordered(download_url, in_out_files)
-    for result in results:
-        print(' --> Compute:', result)
+# Method to download the (variable, step) pairs in a single thread pool, to submit each downloaded step to the process
+# pool and to yield each variable with the results of its steps (None for the failed ones) as soon as they are complete.
+# With the listing settings only the steps found in the directory listings are scheduled and the missing ones are
+# polled again every poll_interval seconds (up to poll_max times)
+def download_parallel(in_out_files, cpu_cores, process_pool, var_files, listing_settings=None):
+    out_queue = queue.Queue()
+
+    def compute_step(result):
+        fn, var, downloaded = result
+        logging.info(" ----> Download: " + fn)
+        if not downloaded:
+            out_queue.put((fn, var, None))
+            return
+        try:
+            out_future = process_pool.submit(compute_file, fn)
+        except Exception as e:
+            # Callback runs in the result handler of the thread pool: a failure must still reach the queue
+            logging.error(" ERROR! Step " + fn + " can not be submitted to the process pool: " + str(e))
+            out_queue.put((fn, var, None))
+            return
+        out_future.add_done_callback(lambda future: out_queue.put((fn, var, future)))
+
+    if listing_settings is None:
+        in_out_ready, in_out_pending = in_out_files, []
+    else:
+        in_out_ready, in_out_pending = check_listing(in_out_files)
+        logging.info(" ----> Steps available: " + str(len(in_out_ready)) + "/" + str(len(in_out_files)))
+
+    thread_pool = ThreadPool(cpu_cores)
+    for in_out_file in in_out_ready:
+        thread_pool.apply_async(download_url, (in_out_file,), callback=compute_step)
+
+    flag_completed = False
+    try:
+        poll_n = 0
+        out_results = {var: {} for var in var_files.keys()}
+        for _ in range(len(in_out_files)):
+            while True:
+                try:
+                    fn, var, out_future = out_queue.get(timeout=listing_settings["poll_interval"] if in_out_pending else None)
+                    break
+                except queue.Empty:
+                    poll_n += 1
+                    in_out_ready, in_out_pending = check_listing(in_out_pending)
+                    logging.info(" ----> Steps still missing: " + str(len(in_out_pending)) + " (poll " + str(poll_n) + ")")
+                    if poll_n >= listing_settings["poll_max"]:
+                        for in_out_file in in_out_pending:
+                            out_queue.put((in_out_file[1], in_out_file[2], None))
+                        in_out_pending = []
+                    for in_out_file in in_out_ready:
+                        thread_pool.apply_async(download_url, (in_out_file,), callback=compute_step)
+
+            out_results[var][fn] = None
+            if out_future is not None:
+                try:
+                    out_results[var][fn] = out_future.result()
+                    logging.info(" ----> Compute: " + fn)
+                except Exception as e:
+                    logging.warning(" WARNING! Forecast step " + fn + " can not be decoded: " + str(e))
+            if len(out_results[var]) == len(var_files[var]):
+                yield var, out_results.pop(var)
+        flag_completed = True
+    finally:
+        if flag_completed:
+            thread_pool.close()
+            thread_pool.join()
+        else:
+            # Consumer failed or closed the generator: pending downloads and computations are dropped
+            thread_pool.terminate()
+            process_pool.shutdown(wait=False, cancel_futures=True)
+# ----------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------
+# Method to split the (variable, step) pairs in available and missing ones according to the directory listings
+# (one listing request for each remote directory)
+def check_listing(in_out_files):
+    listings = {}
+    in_out_ready, in_out_pending = [], []
+    for in_out_file in in_out_files:
+        url_dir, url_name = in_out_file[0].rsplit("/", 1)
+        if url_dir not in listings:
+            listings[url_dir] = get_listing(url_dir + "/")
+        if listings[url_dir] is None or listings[url_dir].get(url_name, {}).get("size", 0) > 0:
+            in_out_ready.append(in_out_file)
+        else:
+            in_out_pending.append(in_out_file)
+    return in_out_ready, in_out_pending
+# ----------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------
+# Method to parse an apache-style directory listing (file name -> time and size in bytes, None if not available)
+def get_listing(url_dir):
+    try:
+        r = requests.get(url_dir, timeout=60)
+        r.raise_for_status()
+    except Exception as e:
+        logging.warning(" WARNING! Directory listing " + url_dir + " not available: " + str(e))
+        return None
+
+    size_factors = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    listing = {}
+    for row in re.finditer(r'<a href="([^"?/]+)">[^<]*</a>\s+(\d{2}-\w{3}-\d{4} \d{2}:\d{2}(?::\d{2})?)\s+([\d.]+)([KMG]?)',
+                           r.text):
+        listing[row.group(1)] = {"time": pd.to_datetime(row.group(2)),
+                                 "size": int(float(row.group(3)) * size_factors[row.group(4)])}
+    return listing
+# ----------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------
+# Method to set the remapping matrix in the workers of the process pool
+def set_worker(remap_matrix, lat, lon):
+    global model_settings
+    model_settings = {"remap_matrix": remap_matrix, "lat": lat, "lon": lon}
+# ----------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------
+# Method to decompress, decode and remap to the domain a downloaded forecast step
+def compute_file(filepath):
+    try:
+        values, attrs = read_file_grib(decompress_file(filepath))
+    finally:
+        os.remove(filepath)
+    return remap_data(values), attrs
+# ----------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------
+# Method to read the values (on the icosahedral grid) and the attributes of a single grib message
+def read_file_grib(message):
+    if not message:
+        raise IOError("No grib message found")
+    grib_id = eccodes.codes_new_from_message(message)
+    try:
+        values = eccodes.codes_get_values(grib_id)
+        if eccodes.codes_get(grib_id, 'bitmapPresent'):
+            values[values == eccodes.codes_get(grib_id, 'missingValue')] = np.nan
+        attrs = {'long_name': eccodes.codes_get(grib_id, 'name'), 'units': eccodes.codes_get(grib_id, 'units')}
+    finally:
+        eccodes.codes_release(grib_id)
+    return values, attrs
+# ----------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------
+# Method to build the sparse matrix remapping the icosahedral grid to the regular grid of the domain (the rows of the
+# cdo weights file whose target cell falls outside the bounding box are dropped)
+def set_remap_matrix(weights_file, bbox):
+    with xr.open_dataset(weights_file, decode_times=False) as weights:
+        src_address = weights["src_address"].values.astype(np.int64) - 1
+        dst_address = weights["dst_address"].values.astype(np.int64) - 1
+        remap_weights = weights["remap_matrix"].values
+        remap_weights = remap_weights[:, 0] if remap_weights.ndim > 1 else remap_weights
+        src_size = weights["src_grid_center_lat"].shape[0]
+        dst_dims = weights["dst_grid_dims"].values
+        dst_lat = weights["dst_grid_center_lat"].values
+        dst_lon = weights["dst_grid_center_lon"].values
+        if "rad" in weights["dst_grid_center_lat"].attrs.get("units", "radians"):
+            dst_lat, dst_lon = np.rad2deg(dst_lat), np.rad2deg(dst_lon)
+
+    # Regular target grid (scrip order: longitude runs fastest)
+    n_lon, n_lat = int(dst_dims[0]), int(dst_dims[1])
+    grid_lat = np.round(dst_lat.reshape(n_lat, n_lon)[:, 0], 6)
+    grid_lon = np.round(((dst_lon.reshape(n_lat, n_lon)[0, :] + 180) % 360) - 180, 6)
+
+    lat_idx = np.where((grid_lat >= bbox["lat_bottom"]) & (grid_lat <= bbox["lat_top"]))[0]
+    lon_idx = np.where((grid_lon >= bbox["lon_left"]) & (grid_lon <= bbox["lon_right"]))[0]
+    lon_idx = lon_idx[np.argsort(grid_lon[lon_idx], kind="stable")]
+    if lat_idx.size == 0 or lon_idx.size == 0:
+        logging.error(" ERROR! The bounding box does not contain any cell of the target grid!")
+        raise ValueError("Empty domain for the remapping")
+
+    # Position of each target cell in the domain (-1 outside the domain)
+    dst_position = np.full(n_lat * n_lon, -1, dtype=np.int64)
+    dst_position[(lat_idx[:, None] * n_lon + lon_idx[None, :]).ravel()] = np.arange(lat_idx.size * lon_idx.size)
+    dst_domain = dst_position[dst_address]
+    link_mask = dst_domain >= 0
+
+    remap_matrix = sp.csr_matrix((remap_weights[link_mask], (dst_domain[link_mask], src_address[link_mask])),
+                                 shape=(lat_idx.size * lon_idx.size, src_size))
+    return remap_matrix, grid_lat[lat_idx], grid_lon[lon_idx]
+# ----------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------
+# Method to remap values from the icosahedral grid to the domain
+def remap_data(values):
+    values_domain = model_settings["remap_matrix"].dot(values)
+    return values_domain.reshape(model_settings["lat"].shape[0], model_settings["lon"].shape[0]).astype(np.float32)
 # ----------------------------------------------------------------------------
 
 # ----------------------------------------------------------------------------
+# Method to decompress a bz2 file by chunks straight into memory (no decompressed file written to disk)
 def decompress_file(filepath):
-    zipfile = bz2.BZ2File(filepath)  # open the file
-    data = zipfile.read()  # get the decompressed data
-    newfilepath = filepath[:-4]  # assuming the filepath ends with .bz2
-    open(newfilepath, 'wb').write(data)
+    decompressor = bz2.BZ2Decompressor()
+    data = bytearray()
+    with open(filepath, 'rb') as zipfile:
+        for chunk in iter(lambda: zipfile.read(chunk_size), b''):
+            data += decompressor.decompress(chunk)
+            if decompressor.eof:
+                break
+    return bytes(data)
 # ----------------------------------------------------------------------------
 
 # ----------------------------------------------------------------------------
@@ -3,8 +3,8 @@
 """
 door - Download ECMWF open data High Resolution (0.25 degree) single run
 
-__date__ = '20250113'
-__version__ = '2.5.0'
+__date__ = '20261017'
+__version__ = '2.8.0'
 __author__ =
         'Andrea Libertino (andrea.libertino@cimafoundation.org',
 __library__ = 'door'
@@ -13,6 +13,12 @@ General command line:
 python3 door_downloader_ecmwf_opendata_single_hires.py -settings_file configuration.json -time "YYYY-MM-DD HH:MM"
 
 Version(s):
+20261017 (2.8.0) --> Add per-step retrieval through the open data index files (byte ranges of the needed parameters fetched
+                     concurrently, each step decoded as soon as it is downloaded)
+20261017 (2.7.0) --> Crop each decoded message to the domain with integer slices computed once from the bounding box
+                     (no global arrays and boolean masks)
+20261017 (2.6.0) --> Decode the forecast file in a single ecCodes pass (10 m, 2 m and surface messages sorted into preallocated arrays)
+                     instead of three cfgrib loads and a merge
 20250113 (2.5.0) --> Add support to AIFS model
                      Bug fixes in the download of forecast related to different height levels
 20240313 (2.0.0) --> Update to new 0.25 resoulution
@@ -24,16 +30,20 @@ Version(s):
 # -------------------------------------------------------------------------------------
 # Complete library
 import copy
+import eccodes
 import json
 import logging
 import time
 import os
 import numpy as np
 import pandas as pd
+import requests
+import threading
 import xarray as xr
 from copy import deepcopy
 
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from ecmwf.opendata import Client
 from requests.exceptions import HTTPError
@@ -43,10 +53,12 @@ from requests.exceptions import HTTPError
 # -------------------------------------------------------------------------------------
 # Algorithm information
 alg_name = 'DOOR - ECMWF open data SINGLE RUN 0.25'
-alg_version = '2.5.0'
-alg_release = '2025-01-13'
+alg_version = '2.8.0'
+alg_release = '2026-10-17'
 # Algorithm parameter(s)
 time_format = '%Y%m%d%H%M'
+# Thread data (one http session for each download thread)
+thread_data = threading.local()
 # -------------------------------------------------------------------------------------
 
 # -------------------------------------------------------------------------------------
@@ -95,10 +107,6 @@ def main():
     else:
         logging.error(" --> ERROR! Model type not correctly defined!")
         raise NotImplementedError
-    model_time_range = pd.date_range(time_run + pd.Timedelta(str(model_freq) + "H"),
-                                     time_run + pd.Timedelta(str(step_end) + "H"), freq=str(model_freq) + "H")
-    time_range = pd.date_range(time_run + pd.Timedelta("1H"),
-                               time_run + pd.Timedelta(str(step_end - 1) + "H"), freq="H")
 
     # Identify forecast run of interest and its availability
     logging.info(' --> TIME RUN: ' + str(time_run))
@@ -115,6 +123,12 @@ def main():
                 " --> WARNING! 3-hourly hires forecast are available only up to 90 forecast time steps for 06 an 18 model issues! Forecast period has been consequently limited!")
             step_end = 90
 
+    # Forecast steps (after the limits of the forecast period, shared by the client and the index retrieval)
+    model_time_range = pd.date_range(time_run + pd.Timedelta(str(model_freq) + "H"),
+                                     time_run + pd.Timedelta(str(step_end) + "H"), freq=str(model_freq) + "H")
+    time_range = pd.date_range(time_run + pd.Timedelta("1H"),
+                               time_run + pd.Timedelta(str(step_end - 1) + "H"), freq="H")
+
     # Generate folder structure
     logging.info(" --> Preparing system folders ...")
     template_filled = copy.deepcopy(data_settings["algorithm"]["template"])
@@ -129,30 +143,32 @@ def main():
     os.makedirs(ancillary_folder, exist_ok=True)
     logging.info(" --> Preparing system folders ... DONE!")
 
-    logging.info(" --> Download forecast data from ecmwf open data server ...")
-    # Setup client
-    client = Client(
-        source="ecmwf",
-        model=model_type,
-        resol="0p25",
-        preserve_request_order=False,
-        infer_stream_keyword=True,
-    )
-    # Perform request
-    try:
-        result = client.retrieve(
-            type="fc",
-            date=time_run.strftime("%Y%m%d"),
-            time=time_run.hour,
-            step=[i for i in np.arange(model_freq, step_end + 1, model_freq)],
-            param=[var for var in data_settings["data"]["dynamic"]["variables"].keys()],
-            target=os.path.join(ancillary_folder, ancillary_file)
+    flag_index = data_settings["algorithm"]["flags"].get("downloading_index", False)
+    if not flag_index:
+        logging.info(" --> Download forecast data from ecmwf open data server ...")
+        # Setup client
+        client = Client(
+            source="ecmwf",
+            model=model_type,
+            resol="0p25",
+            preserve_request_order=False,
+            infer_stream_keyword=True,
         )
-        logging.info(" --> Forecast file " + result.datetime.strftime("%Y-%m-%d %H:%M") + " correctly downloaded!")
-        logging.info(" --> Download forecast data from ecmwf open data server ... DONE!")
-    except HTTPError:
-        logging.error(" --> ERROR! File not found on the server!")
-        raise FileNotFoundError
+        # Perform request
+        try:
+            result = client.retrieve(
+                type="fc",
+                date=time_run.strftime("%Y%m%d"),
+                time=time_run.hour,
+                step=[i for i in np.arange(model_freq, step_end + 1, model_freq)],
+                param=[var for var in data_settings["data"]["dynamic"]["variables"].keys()],
+                target=os.path.join(ancillary_folder, ancillary_file)
+            )
+            logging.info(" --> Forecast file " + result.datetime.strftime("%Y-%m-%d %H:%M") + " correctly downloaded!")
+            logging.info(" --> Download forecast data from ecmwf open data server ... DONE!")
+        except HTTPError:
+            logging.error(" --> ERROR! File not found on the server!")
+            raise FileNotFoundError
 
     logging.info(" --> Convert dataset to netcdf ...")
     rename_dict = deepcopy(data_settings["data"]["dynamic"]["variables"])
@@ -169,19 +185,26 @@ def main():
         rename_dict["d2m"] = rename_dict["2d"]
         del rename_dict["2d"]
 
-    file_path = os.path.join(ancillary_folder, ancillary_file)
-    ds_10m = xr.load_dataset(file_path, engine="cfgrib", filter_by_keys={'typeOfLevel': 'heightAboveGround', 'level': 10})
-    ds_2m = xr.load_dataset(file_path, engine="cfgrib", filter_by_keys={'typeOfLevel': 'heightAboveGround', 'level': 2})
-    ds_surface = xr.load_dataset(file_path, engine="cfgrib", filter_by_keys={'typeOfLevel': 'surface'})
-
-    # Merge the datasets
-    frc_out = xr.merge([ds_10m, ds_2m, ds_surface], compat='override').rename_vars(rename_dict).drop_vars("time")
-    frc_out = frc_out.assign_coords({"step": model_time_range}).rename({"step": "time", "latitude": "lat", "longitude": "lon"})
-
-    frc_out = frc_out.where((frc_out.lat <= data_settings['data']['static']['bounding_box']["lat_top"]) &
-                            (frc_out.lat >= data_settings['data']['static']['bounding_box']["lat_bottom"]) &
-                            (frc_out.lon >= data_settings['data']['static']['bounding_box']["lon_left"]) &
-                            (frc_out.lon <= data_settings['data']['static']['bounding_box']["lon_right"]), drop=True)
+    if flag_index:
+        # Download the needed messages of each step by index files and decode each step as soon as it is downloaded
+        logging.info(" --> Download forecast data from ecmwf open data index files ...")
+        input_settings = data_settings["data"]["dynamic"].get("input", {})
+        frc_out, ancillary_list = retrieve_data_index(
+            time_run, model_type, model_time_range,
+            [var for var in data_settings["data"]["dynamic"]["variables"].keys()],
+            ancillary_folder, ancillary_file,
+            data_bbox=data_settings['data']['static']['bounding_box'],
+            url_root=input_settings.get("url_root", "https://data.ecmwf.int/forecasts"),
+            process_n=input_settings.get("process_n", 4),
+            retry_n=input_settings.get("retry_n", 3))
+        logging.info(" --> Download forecast data from ecmwf open data index files ... DONE!")
+    else:
+        # Decode the file in a single pass (10 m, 2 m and surface messages cropped to the domain as they are decoded)
+        file_path = os.path.join(ancillary_folder, ancillary_file)
+        frc_out = read_data_grib(file_path, time_run, model_time_range,
+                                 data_bbox=data_settings['data']['static']['bounding_box'])
+        ancillary_list = [file_path]
+    frc_out = frc_out.rename_vars(rename_dict)
 
     # If lat is a decreasing vector, flip it and the associated variables vertically
     if frc_out.lat.values[0] > frc_out.lat.values[-1]:
@@ -262,7 +285,7 @@ def main():
             logging.warning(" --> WARNING! 2m temperature and/or 2m dewpoint (2t, 2d) are missing, ground relative humidity can not be computed!")
 
     # frc_out = frc_out.reindex({'time': time_range}, method='nearest')
-    frc_out = frc_out.drop_vars(["valid_time","surface","heightAboveGround"]).reindex({'time': time_range}, method='nearest')
+    frc_out = frc_out.drop_vars(["valid_time","surface","heightAboveGround"], errors="ignore").reindex({'time': time_range}, method='nearest')
     frc_out["lat"].attrs["units"] = "degrees_north"
     frc_out["lon"].attrs["units"] = "degrees_east"
     logging.info(" --> Postprocess variables..DONE")
@@ -276,7 +299,8 @@ def main():
     frc_out.to_netcdf(outcome_file)
 
     if data_settings["algorithm"]["flags"]["clean_ancillary"]:
-        os.remove(os.path.join(ancillary_folder, ancillary_file))
+        for ancillary_path in ancillary_list:
+            os.remove(ancillary_path)
     # -------------------------------------------------------------------------------------
 
     # -------------------------------------------------------------------------------------
@@ -292,6 +316,217 @@ def main():
     # -------------------------------------------------------------------------------------
 
 
+# -------------------------------------------------------------------------------------
+# Method to read a grib file in a single ecCodes pass (messages at 10 m, 2 m and surface cropped to the domain and
+# sorted by step into preallocated arrays; variables named as cfgrib does)
+def read_data_grib(file_path, time_run, time_range, data_bbox=None):
+
+    grib_ws = {'time_steps': [int((time_step - time_run) / pd.Timedelta('1H')) for time_step in time_range],
+               'grid': None, 'data': {}, 'attrs': {}}
+    update_data_grib(file_path, grib_ws, data_bbox=data_bbox)
+
+    return create_data_grib(grib_ws, time_range)
+# -------------------------------------------------------------------------------------
+
+# -------------------------------------------------------------------------------------
+# Method to decode the messages of a grib file into the preallocated arrays of the grib workspace
+def update_data_grib(file_path, grib_ws, data_bbox=None):
+
+    time_steps = grib_ws['time_steps']
+    with open(file_path, 'rb') as file_handle:
+        while True:
+            grib_id = eccodes.codes_grib_new_from_file(file_handle)
+            if grib_id is None:
+                break
+            try:
+                var_level_type = eccodes.codes_get(grib_id, 'typeOfLevel')
+                if var_level_type == 'heightAboveGround':
+                    if eccodes.codes_get(grib_id, 'level') not in [2, 10]:
+                        continue
+                elif var_level_type != 'surface':
+                    continue
+
+                var_step = eccodes.codes_get(grib_id, 'endStep')
+                if var_step not in time_steps:
+                    continue
+
+                if grib_ws['grid'] is None:
+                    grib_ws['grid'] = set_grid_grib(grib_id, data_bbox=data_bbox)
+                grid_lat, grid_lon, grid_shape, grid_idx = grib_ws['grid']
+
+                var_name = eccodes.codes_get(grib_id, 'cfVarName')
+                if var_name not in grib_ws['data']:
+                    grib_ws['data'][var_name] = np.full((len(time_steps), grid_lat.shape[0], grid_lon.shape[0]),
+                                                        np.nan, dtype=np.float32)
+                    grib_ws['attrs'][var_name] = {'long_name': eccodes.codes_get(grib_id, 'name'),
+                                                  'units': eccodes.codes_get(grib_id, 'units')}
+
+                var_values = eccodes.codes_get_values(grib_id)
+                if eccodes.codes_get(grib_id, 'bitmapPresent'):
+                    var_values[var_values == eccodes.codes_get(grib_id, 'missingValue')] = np.nan
+                grib_ws['data'][var_name][time_steps.index(var_step)] = \
+                    var_values.reshape(grid_shape)[grid_idx['lat'], :][:, grid_idx['lon']]
+            finally:
+                eccodes.codes_release(grib_id)
+# -------------------------------------------------------------------------------------
+
+# -------------------------------------------------------------------------------------
+# Method to create the dataset from the grib workspace
+def create_data_grib(grib_ws, time_range):
+
+    if grib_ws['grid'] is None:
+        logging.error(" --> ERROR! No grib message found in the forecast file!")
+        raise IOError("No grib message found in the forecast file")
+    grid_lat, grid_lon = grib_ws['grid'][0], grib_ws['grid'][1]
+
+    frc_out = xr.Dataset(coords={'time': time_range, 'lat': grid_lat, 'lon': grid_lon})
+    for var_name, var_values in grib_ws['data'].items():
+        frc_out[var_name] = xr.DataArray(var_values, dims=['time', 'lat', 'lon'], attrs=grib_ws['attrs'][var_name])
+
+    return frc_out
+# -------------------------------------------------------------------------------------
+
+# -------------------------------------------------------------------------------------
+# Method to retrieve the needed messages of each step through the index files (byte ranges of the steps fetched
+# concurrently) and to decode each step as soon as it is downloaded
+def retrieve_data_index(time_run, model_type, time_range, var_list, ancillary_folder, ancillary_file,
+                        data_bbox=None, url_root="https://data.ecmwf.int/forecasts", process_n=4, retry_n=3):
+
+    # Stream of the open data (ifs 06 and 18 runs are published as short cut-off)
+    if model_type == "ifs" and time_run.hour in [6, 18]:
+        model_stream = "scda"
+    else:
+        model_stream = "oper"
+    url_run = "/".join([url_root.rstrip("/"), time_run.strftime("%Y%m%d"), time_run.strftime("%H") + "z",
+                        model_type, "0p25", model_stream, time_run.strftime("%Y%m%d%H") + "0000"])
+
+    grib_ws = {'time_steps': [int((time_step - time_run) / pd.Timedelta('1H')) for time_step in time_range],
+               'grid': None, 'data': {}, 'attrs': {}}
+    ancillary_name, ancillary_ext = os.path.splitext(ancillary_file)
+
+    ancillary_list = []
+    with ThreadPoolExecutor(max_workers=process_n) as thread_pool:
+        step_futures = {thread_pool.submit(
+            request_data_index, url_run + "-" + str(time_step) + "h-" + model_stream + "-fc.grib2",
+            os.path.join(ancillary_folder, ancillary_name + "_" + str(time_step).zfill(3) + ancillary_ext),
+            var_list, retry_n=retry_n): time_step for time_step in grib_ws['time_steps']}
+        try:
+            for step_future in as_completed(step_futures):
+                step_path = step_future.result()
+                update_data_grib(step_path, grib_ws, data_bbox=data_bbox)
+                ancillary_list.append(step_path)
+                logging.info(" ---> Forecast step " + str(step_futures[step_future]) + "h downloaded and decoded")
+        except BaseException:
+            for step_future in step_futures:
+                step_future.cancel()
+            raise
+
+    return create_data_grib(grib_ws, time_range), ancillary_list
+# -------------------------------------------------------------------------------------
+
+# -------------------------------------------------------------------------------------
+# Method to download the messages of the needed parameters of a step file by its index (json lines) file
+def request_data_index(step_url, step_path, var_list, retry_n=3):
+
+    if getattr(thread_data, 'session', None) is None:
+        thread_data.session = requests.Session()
+    session = thread_data.session
+
+    for retry_id in range(retry_n):
+        try:
+            step_response = session.get(os.path.splitext(step_url)[0] + ".index", timeout=60)
+            if step_response.status_code == 404:
+                logging.error(" --> ERROR! File not found on the server! " + step_url)
+                raise FileNotFoundError
+            step_response.raise_for_status()
+            break
+        except (IOError, requests.exceptions.RequestException) as exc:
+            if isinstance(exc, FileNotFoundError) or retry_id == retry_n - 1:
+                logging.error(" --> ERROR! Download of the index of " + step_url + " failed!")
+                raise FileNotFoundError
+            logging.warning(" --> WARNING! Download of the index of " + step_url + " failed (" + str(exc) + "). Retry " +
+                            str(retry_id + 1) + "/" + str(retry_n))
+            time.sleep(min(10 * 2 ** retry_id, 120))
+
+    # Select the messages of the needed parameters and merge the contiguous byte ranges
+    step_ranges = []
+    for step_row in step_response.text.splitlines():
+        if not step_row.strip():
+            continue
+        step_entry = json.loads(step_row)
+        if step_entry.get("param") not in var_list:
+            continue
+        range_start, range_end = int(step_entry["_offset"]), int(step_entry["_offset"]) + int(step_entry["_length"])
+        step_ranges.append([range_start, range_end])
+    step_ranges.sort()
+    range_list = []
+    for range_start, range_end in step_ranges:
+        if range_list and range_start <= range_list[-1][1]:
+            range_list[-1][1] = max(range_list[-1][1], range_end)
+        else:
+            range_list.append([range_start, range_end])
+    if not range_list:
+        logging.error(" --> ERROR! No requested parameter found in the index of " + step_url)
+        raise FileNotFoundError
+
+    for retry_id in range(retry_n):
+        try:
+            with open(step_path + ".part", "wb") as step_handle:
+                for range_start, range_end in range_list:
+                    range_response = session.get(step_url, timeout=200,
+                                                 headers={"Range": "bytes=" + str(range_start) + "-" + str(range_end - 1)})
+                    range_response.raise_for_status()
+                    if range_response.status_code != 206 or len(range_response.content) != range_end - range_start:
+                        raise IOError("Byte range not honoured by the server")
+                    step_handle.write(range_response.content)
+            os.replace(step_path + ".part", step_path)
+            return step_path
+        except (IOError, requests.exceptions.RequestException) as exc:
+            logging.warning(" --> WARNING! Download of " + step_url + " failed (" + str(exc) + "). Retry " +
+                            str(retry_id + 1) + "/" + str(retry_n))
+            time.sleep(min(10 * 2 ** retry_id, 120))
+
+    logging.error(" --> ERROR! Download of " + step_url + " failed!")
+    raise FileNotFoundError
+# -------------------------------------------------------------------------------------
+
+# -------------------------------------------------------------------------------------
+# Method to define grid coordinates and crop indexes (slices if the domain is contiguous) from a grib message
+def set_grid_grib(grib_id, data_bbox=None):
+
+    grid_lat = np.linspace(eccodes.codes_get(grib_id, 'latitudeOfFirstGridPointInDegrees'),
+                           eccodes.codes_get(grib_id, 'latitudeOfLastGridPointInDegrees'),
+                           eccodes.codes_get(grib_id, 'Nj'))
+    grid_lon_first = eccodes.codes_get(grib_id, 'longitudeOfFirstGridPointInDegrees')
+    grid_lon_last = eccodes.codes_get(grib_id, 'longitudeOfLastGridPointInDegrees')
+    # Grid crossing the antimeridian (e.g. first longitude 180 encoded for -180): longitudes as decoded by ecCodes
+    if grid_lon_last < grid_lon_first:
+        grid_lon_first = grid_lon_first - 360
+    grid_lon = np.linspace(grid_lon_first, grid_lon_last, eccodes.codes_get(grib_id, 'Ni'))
+    grid_shape = (grid_lat.shape[0], grid_lon.shape[0])
+
+    if data_bbox is None:
+        grid_idx = {'lat': slice(None), 'lon': slice(None)}
+    else:
+        grid_idx = {'lat': set_crop_index((grid_lat <= data_bbox["lat_top"]) & (grid_lat >= data_bbox["lat_bottom"])),
+                    'lon': set_crop_index((grid_lon >= data_bbox["lon_left"]) & (grid_lon <= data_bbox["lon_right"]))}
+
+    return grid_lat[grid_idx['lat']], grid_lon[grid_idx['lon']], grid_shape, grid_idx
+# -------------------------------------------------------------------------------------
+
+# -------------------------------------------------------------------------------------
+# Method to convert a coordinate mask to a slice (view of the values) or, if not contiguous, to an index array
+def set_crop_index(grid_mask):
+
+    grid_idx = np.where(grid_mask)[0]
+    if grid_idx.shape[0] == 0:
+        logging.error(" --> ERROR! Bounding box does not intersect the forecast grid!")
+        raise ValueError("Bounding box does not intersect the forecast grid")
+    if grid_idx[-1] - grid_idx[0] + 1 == grid_idx.shape[0]:
+        return slice(int(grid_idx[0]), int(grid_idx[-1]) + 1)
+    return grid_idx
+# -------------------------------------------------------------------------------------
+
 # -------------------------------------------------------------------------------------
 # Method to read file json
 def read_file_json(file_name):
@@ -3,8 +3,8 @@
 """
 HyDE Downloading Tool - NWP GFS 0.25 backup procedure UCAR server
 
-__date__ = '20231109'
-__version__ = '2.0.3'
+__date__ = '20261017'
+__version__ = '2.2.0'
 __author__ =
         'Andrea Libertino (andrea.libertino@cimafoundation.org',
         'Fabio Delogu (fabio.delogu@cimafoundation.org',
@@ -15,6 +15,10 @@ General command line:
 python3 hyde_downloader_nwp_gfs_ftp.py -settings_file configuration.json -time YYYY-MM-DD HH:MM
 
 Version(s):
+20261017 (2.2.0) --> Apply continuum conversions, longitude shift and de-accumulation on the in-memory data before the single write
+                     (no reopen, deepcopy and rewrite of the output files)
+20261017 (2.1.0) --> Send one NCSS query for each variable (and optional time block) concurrently, merge them in memory
+                     and write each output file in a single pass
 20231109 (2.0.3) --> Add possibility to choose output name for compatibility with opendap downaloader
 20221205 (2.0.2) --> Bug fixes
 20210609 (2.0.1) --> Add shifting of longitudes from [0,360] to [-180,180]
@@ -38,6 +42,7 @@ from xarray.backends import NetCDF4DataStore
 import xarray as xr
 import pandas as pd
 from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 import os
 import time
 import json
@@ -48,8 +53,8 @@ import numpy as np
 # -------------------------------------------------------------------------------------
 # Algorithm information
 alg_name = 'DOOR DOWNLOADING TOOL - NWP GFS BACKUP PROCEDURE'
-alg_version = '2.0.3'
-alg_release = '2023-11-09'
+alg_version = '2.2.0'
+alg_release = '2026-10-17'
 # Algorithm parameter(s)
 time_format = '%Y%m%d%H%M'
 # -------------------------------------------------------------------------------------
@@ -121,22 +126,16 @@ def main():
         if v in ncss.variables:
             presentVariables = presentVariables + (v,)
 
+    # Download variables (one query for each variable and time block, sent concurrently and merged in memory)
     logging.info(' ---> Download forecast file ... ')
-    query = ncss.query()
-    query.lonlat_box(data_settings["data"]["static"]["bounding_box"]["lon_left"], data_settings["data"]["static"]["bounding_box"]["lon_right"], data_settings["data"]["static"]["bounding_box"]["lat_bottom"], data_settings["data"]["static"]["bounding_box"]["lat_top"])
-    query.accept('netcdf4')
-    query.variables(*presentVariables)
-
-    # Download variables
-    if timeRun is not None and timeEnd is not None:
-        query.time_range(timeRun, timeEnd)
-    else:
-        query.all_times()
-    data = ncss.get_data(query)
-    data = xr.open_dataset(NetCDF4DataStore(data))
+    data = retrieve_data_ncss(ncss, presentVariables, data_settings["data"]["static"]["bounding_box"], timeRun, timeEnd,
+                              time_block=data_settings["algorithm"]["ancillary"].get("time_block", None),
+                              process_n=data_settings["algorithm"]["ancillary"].get("process_n", 4),
+                              retry_n=data_settings["algorithm"]["ancillary"].get("retry_n", 3))
     logging.info(' ---> Download forecast file ... OK ')
 
     output_list = []
+    output_data = {}
 
     # Merge and reformat downloaded file to be consistent with the outcomes of the NOMADS gfs download procedure
     logging.info(' ---> Compute output files ... ')
@@ -162,74 +161,35 @@ def main():
 
             if varGFS=="Precipitation_rate_surface_Mixed_intervals_Average":
                 if not data_settings['data']['dynamic']['vars_standards']['convert2standard_continuum_format']:
-                    temp = deepcopy(varFilled)*3600
-                    varFilled = temp.cumsum(dim=temp.dims[0], keep_attrs=True)
+                    varFilled = (varFilled * 3600).cumsum(dim=varFilled.dims[0], keep_attrs=True)
                 else:
-                    varFilled = deepcopy(varFilled)*3600
+                    varFilled = varFilled * 3600
 
             if "height" in [i for i in varIn.dims]:
                 varFilled = varFilled.squeeze(dim="height", drop=True)
 
             outName = outNameTemplate.format(out_group=variables[varHMC][varGFS]["out_group"])
-
-            if not os.path.isfile(os.path.join(outFolder, outName)):
-                varFilled.to_dataset(name=variables[varHMC][varGFS]["varName"]).to_netcdf(
-                    path=os.path.join(outFolder, outName), mode='w')
-            else:
-                varFilled.to_dataset(name=variables[varHMC][varGFS]["varName"]).to_netcdf(
-                    path=os.path.join(outFolder, outName), mode='a')
+            output_data.setdefault(outName, {})[variables[varHMC][varGFS]["varName"]] = varFilled
 
             output_list.append(outName)
             logging.info(' ----> Compute ' + varGFS + ' variable...OK')
 
     output_list = np.unique(output_list)
 
-    if data_settings['data']['dynamic']['vars_standards']['convert2standard_continuum_format'] is True:
+    # Convert (if needed) and write each output file in a single pass on the in-memory data
+    flag_continuum = data_settings['data']['dynamic']['vars_standards']['convert2standard_continuum_format'] is True
+    if flag_continuum:
         logging.info(' ----> Elaborate output file for being Continuum complient...')
-        for out_file_name in output_list:
-            out_file = deepcopy(xr.open_dataset(os.path.join(outFolder, out_file_name)))
-            os.remove(os.path.join(outFolder, out_file_name))
-            if '2t' in out_file.variables.mapping.keys():
-                if data_settings['data']['dynamic']['vars_standards']['source_temperature_mesurement_unit'] == 'C':
-                    pass
-                elif data_settings['data']['dynamic']['vars_standards']['source_temperature_mesurement_unit'] == 'K':
-                    logging.info(' ------> Convert temperature to C ... ')
-                    if os.path.isfile(os.path.join(outFolder, out_file_name)):
-                        os.remove(os.path.join(outFolder, out_file_name))
-                    out_file['2t_C'] = out_file['2t'] - 273.15
-                    out_file['2t_C'].attrs['long_name'] = '2 metre temperature'
-                    out_file['2t_C'].attrs['units'] = 'C'
-                    out_file['2t_C'].attrs['standard_name'] = "air_temperature"
-                    out_file = out_file.rename({'2t': '2t_K'})
-                    logging.info(' ------> Convert temperature to C ... DONE')
-                else:
-                    raise NotImplementedError
-
-            if '10u' in out_file.variables.mapping.keys() and data_settings['data']['dynamic']['vars_standards']['source_wind_separate_components'] is True:
-                logging.info(' ------> Combine wind component ... ')
-                if os.path.isfile(os.path.join(outFolder, out_file_name)):
-                    os.remove(os.path.join(outFolder, out_file_name))
-                out_file['10wind'] = np.sqrt(out_file['10u'] ** 2 + out_file['10v'] ** 2)
-                out_file['10wind'].attrs['long_name'] = '10 m wind'
-                out_file['10wind'].attrs['units'] = 'm s**-1'
-                out_file['10wind'].attrs['standard_name'] = "wind"
-                logging.info(' ------> Combine wind component ... DONE')
-
-            logging.info(' -----> Shift longitude to be in the -180 +180 range')
-            try:
-                out_file["lat"] = out_file["latitude"]
-                out_file["lon"] = out_file["longitude"]
-                out_file = out_file.swap_dims({"latitude": "lat", "longitude": "lon"})
-                out_file = out_file.drop_vars(['latitude','longitude'])
-            except:
-                pass
-            try:
-                out_file = out_file.drop_vars(['reftime'])
-            except:
-                pass
-            out_file = out_file.assign_coords({'lon': np.where(out_file['lon'].values > 180, out_file['lon'].values - 360, out_file['lon'].values)})
-            out_file.to_netcdf(os.path.join(outFolder, out_file_name))
-
+    for out_file_name in output_list:
+        out_file = xr.Dataset(output_data.pop(out_file_name))
+        if flag_continuum:
+            out_file = convert_data_standards(out_file, data_settings['data']['dynamic']['vars_standards'])
+
+        logging.info(' ----> Write ' + out_file_name + ' file...')
+        out_file.to_netcdf(path=os.path.join(outFolder, out_file_name), mode='w')
+        logging.info(' ----> Write ' + out_file_name + ' file...OK')
+        del out_file
+    if flag_continuum:
         logging.info(' ----> Elaborate output file for being Continuum complient...DONE')
 
 
@@ -245,6 +205,104 @@ def main():
     logging.info(' ============================================================================ ')
     # -------------------------------------------------------------------------------------
 
+# -------------------------------------------------------------------------------------
+# Method to convert an output dataset to continuum standard(s) (new variable(s) only, no copy of the dataset)
+def convert_data_standards(out_file, vars_standards):
+
+    if '2t' in out_file.variables.mapping.keys():
+        if vars_standards['source_temperature_mesurement_unit'] == 'C':
+            pass
+        elif vars_standards['source_temperature_mesurement_unit'] == 'K':
+            logging.info(' ------> Convert temperature to C ... ')
+            out_file['2t_C'] = out_file['2t'] - 273.15
+            out_file['2t_C'].attrs['long_name'] = '2 metre temperature'
+            out_file['2t_C'].attrs['units'] = 'C'
+            out_file['2t_C'].attrs['standard_name'] = "air_temperature"
+            out_file = out_file.rename({'2t': '2t_K'})
+            logging.info(' ------> Convert temperature to C ... DONE')
+        else:
+            raise NotImplementedError
+
+    if '10u' in out_file.variables.mapping.keys() and vars_standards['source_wind_separate_components'] is True:
+        logging.info(' ------> Combine wind component ... ')
+        out_file['10wind'] = np.sqrt(out_file['10u'] ** 2 + out_file['10v'] ** 2)
+        out_file['10wind'].attrs['long_name'] = '10 m wind'
+        out_file['10wind'].attrs['units'] = 'm s**-1'
+        out_file['10wind'].attrs['standard_name'] = "wind"
+        logging.info(' ------> Combine wind component ... DONE')
+
+    logging.info(' -----> Shift longitude to be in the -180 +180 range')
+    if "latitude" in out_file.dims and "longitude" in out_file.dims:
+        out_file = out_file.rename({"latitude": "lat", "longitude": "lon"})
+    if 'reftime' in out_file.variables:
+        out_file = out_file.drop_vars(['reftime'])
+    out_file = out_file.assign_coords(
+        {'lon': np.where(out_file['lon'].values > 180, out_file['lon'].values - 360, out_file['lon'].values)})
+
+    return out_file
+# -------------------------------------------------------------------------------------
+
+# -------------------------------------------------------------------------------------
+# Method to download variable(s) with one NCSS query for each variable and time block (sent concurrently)
+def retrieve_data_ncss(ncss, var_list, bbox, time_start, time_end, time_block=None, process_n=4, retry_n=3):
+
+    # Time blocks do not overlap: each one ends one minute before the next one starts
+    if (time_start is None) or (time_end is None) or (time_block is None):
+        time_blocks = [(time_start, time_end)]
+    else:
+        time_edges = list(pd.date_range(time_start, time_end, freq=str(time_block) + 'h'))
+        if time_edges[-1] < time_end:
+            time_edges.append(time_end)
+        time_blocks = [(block_start, block_end - pd.Timedelta('1min'))
+                       for block_start, block_end in zip(time_edges[:-2], time_edges[1:-1])]
+        time_blocks.append((time_edges[-2], time_edges[-1]))
+
+    query_list = [(var_name, block_start, block_end) for var_name in var_list for block_start, block_end in time_blocks]
+    logging.info(' ----> Send ' + str(len(query_list)) + ' query(ies) with ' + str(process_n) + ' thread(s) ... ')
+    with ThreadPoolExecutor(max_workers=process_n) as thread_pool:
+        query_data = list(thread_pool.map(
+            lambda query_step: request_data_ncss(ncss, query_step[0], bbox, query_step[1], query_step[2],
+                                                 retry_n=retry_n), query_list))
+    logging.info(' ----> Send ' + str(len(query_list)) + ' query(ies) with ' + str(process_n) + ' thread(s) ... OK')
+
+    data = {}
+    for var_name in var_list:
+        var_blocks = [var_data for (query_name, _, _), var_data in zip(query_list, query_data)
+                      if query_name == var_name]
+        if len(var_blocks) == 1:
+            data[var_name] = var_blocks[0]
+        else:
+            data[var_name] = xr.concat(var_blocks, dim=var_blocks[0].dims[0])
+
+    return data
+# -------------------------------------------------------------------------------------
+
+# -------------------------------------------------------------------------------------
+# Method to request a variable over a time block from the NCSS service (loaded in memory)
+def request_data_ncss(ncss, var_name, bbox, time_start, time_end, retry_n=3):
+
+    query = ncss.query()
+    query.lonlat_box(bbox["lon_left"], bbox["lon_right"], bbox["lat_bottom"], bbox["lat_top"])
+    query.accept('netcdf4')
+    query.variables(var_name)
+    if time_start is not None and time_end is not None:
+        query.time_range(time_start, time_end)
+    else:
+        query.all_times()
+
+    for retry_id in range(retry_n):
+        try:
+            with xr.open_dataset(NetCDF4DataStore(ncss.get_data(query))) as data:
+                return data[var_name].load()
+        except Exception as exc:
+            logging.warning(' ===> Query ' + var_name + ' from ' + str(time_start) + ' failed (' + str(exc) +
+                            '). Retry ' + str(retry_id + 1) + '/' + str(retry_n))
+            time.sleep(min(10 * 2 ** retry_id, 120))
+
+    logging.error(' ===> Query ' + var_name + ' from ' + str(time_start) + ' not downloaded!')
+    raise IOError('Query ' + var_name + ' from ' + str(time_start) + ' not downloaded')
+# -------------------------------------------------------------------------------------
+
 # -------------------------------------------------------------------------------------
 # Method to read file json
 def read_file_json(file_name):
@@ -3,8 +3,8 @@
 """
 HyDE Downloading Tool - NWP GFS 0.25 historical downloader
 
-__date__ = '20210618'
-__version__ = '1.0.0'
+__date__ = '20261017'
+__version__ = '1.2.0'
 __author__ =
         'Andrea Libertino (andrea.libertino@cimafoundation.org',
         'Fabio Delogu (fabio.delogu@cimafoundation.org',
@@ -13,8 +13,13 @@ __library__ = 'HyDE'
 
 General command line:
 python3 hyde_downloader_nwp_gfs_historical.py -settings_file configuration.json -time YYYY-MM-DD HH:MM
+python3 hyde_downloader_nwp_gfs_historical.py -settings_file configuration.json -time YYYY-MM-DD HH:MM -time_end YYYY-MM-DD HH:MM
 
 Version(s):
+20261017 (1.2.0) --> Add backfill mode over a date range ("-time_end") with checkpoint of finished runs and
+                     catalog listings cached on disk (TTL and ETag revalidation)
+20261017 (1.1.0) --> Fetch forecast steps concurrently (thread pool reusing one http session per thread) and store them
+                     by integer index in a preallocated cube
 20220608 (1.0.1) --> Allow edit output name
 20210618 (1.0.0) --> Beta release
 """
@@ -25,7 +30,6 @@ Version(s):
 import logging
 from argparse import ArgumentParser
 from datetime import timedelta, datetime
-from siphon.catalog import TDSCatalog
 from siphon.ncss import NCSS
 from xarray.backends import NetCDF4DataStore
 import xarray as xr
@@ -36,17 +40,24 @@ import time
 import json
 import numpy as np
 from siphon.http_util import session_manager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import hashlib
 import netrc
+from urllib.parse import urljoin
+from xml.etree import ElementTree
 
 # -------------------------------------------------------------------------------------
 
 # -------------------------------------------------------------------------------------
 # Algorithm information
 alg_name = 'HYDE DOWNLOADING TOOL - NWP GFS HISTORICAL DOWNLOADER'
-alg_version = '1.0.0'
-alg_release = '2021-06-18'
+alg_version = '1.2.0'
+alg_release = '2026-10-17'
 # Algorithm parameter(s)
 time_format = '%Y%m%d%H%M'
+# Thread data (one http session for each download thread)
+thread_data = threading.local()
 # -------------------------------------------------------------------------------------
 
 # -------------------------------------------------------------------------------------
@@ -55,7 +66,7 @@ def main():
 
     # -------------------------------------------------------------------------------------
     # Get algorithm settings
-    alg_settings, alg_time = get_args()
+    alg_settings, alg_time, alg_time_end = get_args()
 
     # Set algorithm settings
     data_settings = read_file_json(alg_settings)
@@ -83,7 +94,79 @@ def main():
     start_time = time.time()
     # -------------------------------------------------------------------------------------
 
+    # Connect to UCAR archive (credentials shared by all the sessions)
+    session_manager.set_session_options(auth=(UCARuser, UCARpwd))
+    backfill_settings = data_settings["algorithm"]["ancillary"].get("backfill", {})
+    catalog_cache = {"folder": backfill_settings.get("catalog_cache_folder", None),
+                     "ttl": backfill_settings.get("catalog_cache_ttl", 86400)}
+
     timeRun = datetime.strptime(alg_time,'%Y-%m-%d %H:%M')
+    if alg_time_end is None:
+        process_run(timeRun, data_settings, catalog_cache=catalog_cache)
+    else:
+        # Backfill mode: all the runs of the date range in one process (finished runs are checkpointed)
+        process_run_backfill(timeRun, datetime.strptime(alg_time_end, '%Y-%m-%d %H:%M'), data_settings,
+                             catalog_cache=catalog_cache,
+                             time_frequency=backfill_settings.get("time_frequency", "6H"),
+                             checkpoint_file=backfill_settings.get(
+                                 "checkpoint_file", os.path.join(data_settings['data']['log']['folder'],
+                                                                 'gfs_historical_backfill.json')))
+
+    # -------------------------------------------------------------------------------------
+    # Info algorithm
+    time_elapsed = round(time.time() - start_time, 1)
+
+    logging.info(' ')
+    logging.info(' ==> ' + alg_name + ' (Version: ' + alg_version + ' Release_Date: ' + alg_release + ')')
+    logging.info(' ==> TIME ELAPSED: ' + str(time_elapsed) + ' seconds')
+    logging.info(' ==> ... END')
+    logging.info(' ==> Bye, Bye')
+    logging.info(' ============================================================================ ')
+    # -------------------------------------------------------------------------------------
+
+# -------------------------------------------------------------------------------------
+# Method to process the runs of a date range in one process (runs already done are skipped on restart)
+def process_run_backfill(time_start, time_end, data_settings, catalog_cache=None, time_frequency='6H',
+                         checkpoint_file='gfs_historical_backfill.json'):
+
+    time_runs = pd.date_range(time_start, time_end, freq=time_frequency)
+
+    runs_done = []
+    if os.path.exists(checkpoint_file):
+        with open(checkpoint_file, 'r') as checkpoint_handle:
+            runs_done = json.load(checkpoint_handle)
+    logging.info(' --> BACKFILL: ' + str(len(time_runs)) + ' run(s) from ' + str(time_start) + ' to ' + str(time_end) +
+                 ' (' + str(len([i for i in time_runs if i.strftime(time_format) in runs_done])) + ' already done)')
+
+    runs_failed = []
+    for timeRun in time_runs:
+        if timeRun.strftime(time_format) in runs_done:
+            logging.info(' --> TIME RUN: ' + str(timeRun) + ' ... SKIPPED. Run already done.')
+            continue
+        try:
+            process_run(timeRun.to_pydatetime(), data_settings, catalog_cache=catalog_cache)
+        except Exception as exc:
+            logging.error(' --> TIME RUN: ' + str(timeRun) + ' ... FAILED (' + str(exc) + ')')
+            runs_failed.append(str(timeRun))
+            continue
+
+        runs_done.append(timeRun.strftime(time_format))
+        checkpoint_tmp = checkpoint_file + '.tmp'
+        with open(checkpoint_tmp, 'w') as checkpoint_handle:
+            json.dump(sorted(runs_done), checkpoint_handle)
+        os.replace(checkpoint_tmp, checkpoint_file)
+
+    if len(runs_failed) > 0:
+        logging.warning(' --> BACKFILL: run(s) failed (retried at the next launch): ' + ', '.join(runs_failed))
+# -------------------------------------------------------------------------------------
+
+# -------------------------------------------------------------------------------------
+# Method to process a run
+def process_run(timeRun, data_settings, catalog_cache=None):
+
+    if catalog_cache is None:
+        catalog_cache = {"folder": None, "ttl": 86400}
+
     timeEnd = timeRun + pd.Timedelta(str(data_settings["data"]["dynamic"]["time"]["time_forecast_period"]) + data_settings["data"]["dynamic"]["time"]["time_forecast_frequency"])
 
     outFolder = data_settings["data"]["dynamic"]["outcome"]["folder"]
@@ -111,70 +194,40 @@ def main():
             variables_info[varGFS] = variables[varHMC][varGFS]
 
     logging.info(' ---> Connect to UCAR archive...')
-    session_manager.set_session_options(auth=(UCARuser, UCARpwd))
-    archiveFrc = TDSCatalog(
+    archiveFrc = get_catalog_listing(
         'https://thredds.rda.ucar.edu/thredds/catalog/files/g/ds084.1/' + timeRun.strftime('%Y') + '/' + timeRun.strftime(
-            '%Y%m%d') + '/catalog.xml')
-    listFrc = [i for i in list(archiveFrc.datasets.values()) if timeRun.strftime('%Y%m%d%H') in i.name and  int(i.name[-9:-6])<=data_settings["data"]["dynamic"]["time"]["time_forecast_period"]]
+            '%Y%m%d') + '/catalog.xml', cache_folder=catalog_cache["folder"], cache_ttl=catalog_cache["ttl"])
+    listFrc = [i for i in archiveFrc if timeRun.strftime('%Y%m%d%H') in i["name"] and  int(i["name"][-9:-6])<=data_settings["data"]["dynamic"]["time"]["time_forecast_period"]]
     outVarName = [varGFS for varHMC in variables.keys() for varGFS in variables[varHMC]]
 
-    frcStepTimes = [timeRun + pd.Timedelta(str(int(frcStepDS.name[-9:-6])) + 'H') for frcStepDS in listFrc[1:]]
+    frcStepTimes = [timeRun + pd.Timedelta(str(int(frcStepDS["name"][-9:-6])) + 'H') for frcStepDS in listFrc[1:]]
+    if len(frcStepTimes) == 0:
+        logging.error(' ===> No forecast step of run ' + timeRun.strftime('%Y%m%d%H') + ' found in the UCAR archive catalog!')
+        raise FileNotFoundError('No forecast step of run ' + timeRun.strftime('%Y%m%d%H') + ' found in the UCAR archive')
 
     logging.info(' ---> Connect to UCAR archive... OK')
 
-    # Query remote UCAR server for data
-    for frcStepDS, time_frc in zip(listFrc[1:], frcStepTimes):
-        ncss = NCSS(frcStepDS.access_urls['NetcdfSubset'])
-
-        # Remove variables not contained in dataset
-        variablesGFS = convert_historical_GFS_varnames(outVarName)
-        presentVariables = ()
-
-        for v in variablesGFS:
-            if v in ncss.variables:
-                presentVariables = presentVariables + (v,)
-
-        if len(presentVariables) < len(outVarName):
-            variablesGFS = [w.replace('6_Hour', '3_Hour') for w in variablesGFS]
-            presentVariables = ()
-            for v in variablesGFS:
-                if v in ncss.variables:
-                    presentVariables = presentVariables + (v,)
-
-            if len(presentVariables) < len(variablesGFS):
-                logging.warning("---> WARNING! Some variables are not present in the original dataset!")
-        logging.info(' --> Forecast time ' + time_frc.strftime("%Y-%m-%d %H:%M"))
-        logging.info(' --> Download forecast file ' + frcStepDS.name)
-        query = ncss.query()
-        query.lonlat_box(data_settings["data"]["static"]["bounding_box"]["lon_left"], data_settings["data"]["static"]["bounding_box"]["lon_right"], data_settings["data"]["static"]["bounding_box"]["lat_bottom"], data_settings["data"]["static"]["bounding_box"]["lat_top"])
-        query.accept('netcdf4')
-        query.variables(*presentVariables)
-
-        query.all_times()
-        data = ncss.get_data(query)
-        data = xr.open_dataset(NetCDF4DataStore(data)).drop_dims("bounds_dim", errors='ignore')
-
-        if frcStepDS.name == listFrc[1].name:
-            frcDS = xr.Dataset(coords={'time':frcStepTimes, 'lat':data.latitude.values, 'lon':data.longitude.values})
-            for variableGFS in outVarName:
-                frcDS[variableGFS] = xr.DataArray(dims=['time','lat','lon'], coords={'time':pd.date_range(timeRun + pd.Timedelta('1H'), timeEnd, freq='1H'), 'lat':data.latitude.values, 'lon':data.longitude.values})
-
-        for presentVariable, variableGFS in zip(presentVariables, outVarName):
-            logging.info(' ---> Download variable ' + presentVariable)
-            if len(data[presentVariable].dims) > 3:
-                if 'height' in data[presentVariable].dims:
-                    data_step = data.loc[{'height':variables_info[variableGFS]["height"]}][presentVariable].squeeze().rename({'longitude':'lon','latitude':'lat'})
-                else:
-                    height_dim = [i for i in data[presentVariable].dims if 'height' in i]
-                    if len(height_dim) > 1:
-                        logging.error(" --> ERROR! Cannot identify heigth dim name for variable " + presentVariable)
-                        raise ValueError
-                    else:
-                        data_step = data.loc[{height_dim[0]: variables_info[variableGFS]["height"]}][presentVariable].squeeze().rename({'longitude':'lon','latitude':'lat'})
-            else:
-                data_step = data[presentVariable].squeeze().rename({'longitude':'lon','latitude':'lat'})
-
-            frcDS[variableGFS].loc[{'time':time_frc}] = data_step
+    # Query remote UCAR server for data (forecast steps fetched concurrently and stored by index in the cube)
+    process_n = data_settings["algorithm"]["ancillary"].get("process_n", 4)
+    logging.info(' ---> Download ' + str(len(frcStepTimes)) + ' forecast step(s) with ' + str(process_n) + ' thread(s)...')
+    frcCube, frcLat, frcLon = None, None, None
+    with ThreadPoolExecutor(max_workers=process_n) as thread_pool:
+        frcFutures = {thread_pool.submit(request_data_step, frcStepDS["name"], frcStepDS["ncss_url"],
+                                         time_frc, outVarName, variables_info,
+                                         data_settings["data"]["static"]["bounding_box"]): frcStepId
+                      for frcStepId, (frcStepDS, time_frc) in enumerate(zip(listFrc[1:], frcStepTimes))}
+        for frcFuture in as_completed(frcFutures):
+            stepLat, stepLon, stepData = frcFuture.result()
+            if frcCube is None:
+                frcLat, frcLon = stepLat, stepLon
+                frcCube = {variableGFS: np.full((len(frcStepTimes), frcLat.shape[0], frcLon.shape[0]), np.nan,
+                                                dtype=np.float32) for variableGFS in outVarName}
+            for variableGFS, stepValues in stepData.items():
+                frcCube[variableGFS][frcFutures[frcFuture]] = stepValues
+
+    frcDS = xr.Dataset(coords={'time': frcStepTimes, 'lat': frcLat, 'lon': frcLon})
+    for variableGFS in outVarName:
+        frcDS[variableGFS] = xr.DataArray(frcCube[variableGFS], dims=['time', 'lat', 'lon'])
 
     logging.info(' ---> Download forecast file ... OK ')
     output_list = []
@@ -250,19 +303,139 @@ def main():
             out_file.to_netcdf(os.path.join(outFolder, out_file_name))
 
         logging.info(' ----> Elaborate output file for being Continuum complient...DONE')
+# -------------------------------------------------------------------------------------
+
+# -------------------------------------------------------------------------------------
+# Method to list the datasets (name and NetcdfSubset url) of a THREDDS catalog, cached on disk for a TTL and
+# revalidated with the ETag of the catalog when expired
+def get_catalog_listing(catalog_url, cache_folder=None, cache_ttl=86400):
+
+    cache_file, cache_data = None, None
+    if cache_folder is not None:
+        os.makedirs(cache_folder, exist_ok=True)
+        cache_file = os.path.join(cache_folder, hashlib.sha1(catalog_url.encode('utf-8')).hexdigest() + '.json')
+        if os.path.exists(cache_file):
+            with open(cache_file, 'r') as cache_handle:
+                cache_data = json.load(cache_handle)
+            if time.time() - cache_data['updated'] < cache_ttl:
+                logging.info(' ---> Catalog listing from cache (fresh)')
+                return cache_data['datasets']
+
+    catalog_headers = {}
+    if (cache_data is not None) and (cache_data.get('etag') is not None):
+        catalog_headers['If-None-Match'] = cache_data['etag']
+    catalog_response = session_manager.create_session().get(catalog_url, headers=catalog_headers)
+
+    if catalog_response.status_code == 304:
+        logging.info(' ---> Catalog listing from cache (revalidated)')
+        catalog_datasets = cache_data['datasets']
+    else:
+        catalog_response.raise_for_status()
+        catalog_datasets = parse_catalog_listing(catalog_url, catalog_response.content)
 
+    if cache_file is not None:
+        cache_tmp = cache_file + '.tmp'
+        with open(cache_tmp, 'w') as cache_handle:
+            json.dump({'url': catalog_url, 'etag': catalog_response.headers.get('ETag'),
+                       'updated': time.time(), 'datasets': catalog_datasets}, cache_handle)
+        os.replace(cache_tmp, cache_file)
 
-    # -------------------------------------------------------------------------------------
-    # Info algorithm
-    time_elapsed = round(time.time() - start_time, 1)
+    return catalog_datasets
+# -------------------------------------------------------------------------------------
 
-    logging.info(' ')
-    logging.info(' ==> ' + alg_name + ' (Version: ' + alg_version + ' Release_Date: ' + alg_release + ')')
-    logging.info(' ==> TIME ELAPSED: ' + str(time_elapsed) + ' seconds')
-    logging.info(' ==> ... END')
-    logging.info(' ==> Bye, Bye')
-    logging.info(' ============================================================================ ')
-    # -------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------
+# Method to parse the datasets of a THREDDS catalog xml (NetcdfSubset url from the service base and url path)
+def parse_catalog_listing(catalog_url, catalog_content):
+
+    catalog_root = ElementTree.fromstring(catalog_content)
+
+    ncss_base = None
+    for catalog_element in catalog_root.iter():
+        if catalog_element.tag.endswith('service') and \
+                catalog_element.get('serviceType', '').lower() == 'netcdfsubset':
+            ncss_base = catalog_element.get('base')
+            break
+    if ncss_base is None:
+        logging.error(' ===> NetcdfSubset service not found in catalog ' + catalog_url)
+        raise ValueError('NetcdfSubset service not found in catalog')
+
+    catalog_datasets = []
+    for catalog_element in catalog_root.iter():
+        if catalog_element.tag.endswith('dataset') and catalog_element.get('urlPath') is not None:
+            catalog_datasets.append({'name': catalog_element.get('name'),
+                                     'ncss_url': urljoin(catalog_url, ncss_base + catalog_element.get('urlPath'))})
+
+    return catalog_datasets
+# -------------------------------------------------------------------------------------
+
+# -------------------------------------------------------------------------------------
+# Method to download a forecast step file (variable(s) squeezed to lat/lon grids)
+def request_data_step(step_name, step_url, time_frc, outVarName, variables_info, bbox):
+
+    ncss = NCSSThread(step_url)
+
+    # Remove variables not contained in dataset
+    variablesGFS = convert_historical_GFS_varnames(outVarName)
+    presentVariables = ()
+
+    for v in variablesGFS:
+        if v in ncss.variables:
+            presentVariables = presentVariables + (v,)
+
+    if len(presentVariables) < len(outVarName):
+        variablesGFS = [w.replace('6_Hour', '3_Hour') for w in variablesGFS]
+        presentVariables = ()
+        for v in variablesGFS:
+            if v in ncss.variables:
+                presentVariables = presentVariables + (v,)
+
+        if len(presentVariables) < len(variablesGFS):
+            logging.warning("---> WARNING! Some variables are not present in the original dataset!")
+    logging.info(' --> Forecast time ' + time_frc.strftime("%Y-%m-%d %H:%M"))
+    logging.info(' --> Download forecast file ' + step_name)
+    query = ncss.query()
+    query.lonlat_box(bbox["lon_left"], bbox["lon_right"], bbox["lat_bottom"], bbox["lat_top"])
+    query.accept('netcdf4')
+    query.variables(*presentVariables)
+
+    query.all_times()
+    data = ncss.get_data(query)
+    data = xr.open_dataset(NetCDF4DataStore(data)).drop_dims("bounds_dim", errors='ignore')
+
+    stepData = {}
+    for presentVariable, variableGFS in zip(presentVariables, outVarName):
+        logging.info(' ---> Download variable ' + presentVariable)
+        if len(data[presentVariable].dims) > 3:
+            if 'height' in data[presentVariable].dims:
+                data_step = data.loc[{'height':variables_info[variableGFS]["height"]}][presentVariable].squeeze()
+            else:
+                height_dim = [i for i in data[presentVariable].dims if 'height' in i]
+                if len(height_dim) > 1:
+                    logging.error(" --> ERROR! Cannot identify heigth dim name for variable " + presentVariable)
+                    raise ValueError
+                else:
+                    data_step = data.loc[{height_dim[0]: variables_info[variableGFS]["height"]}][presentVariable].squeeze()
+        else:
+            data_step = data[presentVariable].squeeze()
+        stepData[variableGFS] = data_step.values
+
+    return data.latitude.values, data.longitude.values, stepData
+# -------------------------------------------------------------------------------------
+
+# -------------------------------------------------------------------------------------
+# NCSS client using the http session of the calling thread (keep-alive connections reused across steps)
+class NCSSThread(NCSS):
+
+    @property
+    def _session(self):
+        if getattr(thread_data, 'session', None) is None:
+            thread_data.session = session_manager.create_session()
+        return thread_data.session
+
+    @_session.setter
+    def _session(self, session):
+        pass
+# -------------------------------------------------------------------------------------
 
 # -------------------------------------------------------------------------------------
 # Method to read file json
@@ -302,6 +475,7 @@ def get_args():
     parser_handle = ArgumentParser()
     parser_handle.add_argument('-settings_file', action="store", dest="alg_settings")
     parser_handle.add_argument('-time', action="store", dest="alg_time")
+    parser_handle.add_argument('-time_end', action="store", dest="alg_time_end")
     parser_values = parser_handle.parse_args()
 
     if parser_values.alg_settings:
@@ -314,7 +488,12 @@ def get_args():
     else:
         alg_time = None
 
-    return alg_settings, alg_time
+    if parser_values.alg_time_end:
+        alg_time_end = parser_values.alg_time_end
+    else:
+        alg_time_end = None
+
+    return alg_settings, alg_time, alg_time_end
 # -------------------------------------------------------------------------------------
 
 
@@ -3,8 +3,8 @@
 """
 HyDE Downloading Tool - NWP GFS 0.25
 
-__date__ = '20240524'
-__version__ = '2.0.1'
+__date__ = '20261017'
+__version__ = '2.9.0'
 __author__ =
         'Andrea Libertino (andrea.libertino@cimafoundation.org',
         'Fabio Delogu (fabio.delogu@cimafoundation.org',
@@ -15,6 +15,18 @@ General command line:
 python3 hyde_downloader_nwp_gfs_nomads.py -settings_file configuration.json -time YYYY-MM-DD HH:MM
 
 Version(s):
+20261017 (2.9.0) --> Add backfill mode overlapping download of a run with arranging of previous run(s)
+20261017 (2.8.0) --> Add server-side subregion derived from bounding box (margin and antimeridian wrapping) by "url_bbox_auto";
+                     skip global outcome if not requested
+20261017 (2.7.0) --> Replace size percentile check of corrupted data with structural grib check (mmap scan of message framing)
+20261017 (2.6.0) --> Add progressive mode polling (with backoff) and ingesting forecast steps as soon as they are published,
+                     dumping partial product(s) at the configured lead time(s)
+20261017 (2.5.0) --> Replace cdo chain (cat, infov, seltimestep, copy, sellonlatbox) with in-process ecCodes decoding
+                     cropping each message to global and domain grid(s) and writing each netcdf file once; cdo kept by "arranging_cdo" flag
+20261017 (2.4.0) --> Add "idx" source mode for retrieving the selected grib messages by byte-range requests using index files
+20261017 (2.3.0) --> Replace chunked 60 seconds waiting with a token bucket limiter shared by all processes (sqlite)
+20261017 (2.2.0) --> Add asyncio download engine (aiohttp) with keep-alive connection pool, selectable by "downloading_async" flag
+20261017 (2.1.0) --> Stream http request(s) to partial file(s) and resume interrupted download(s) with range request(s)
 20240521 (2.0.1) --> Change request function for avoid timeout error
 20210428 (2.0.0) --> Add hit per minute limit for new NOAA policy compatibility
                      Fix time step problems. Modified output format for decreasing number of hits to the server.
@@ -38,11 +50,14 @@ Version(s):
 # -------------------------------------------------------------------------------------
 # Complete library
 import logging
+import asyncio
 import os
 import time
 import json, requests
 import urllib.request
 import tempfile
+import mmap
+import sqlite3
 import xarray as xr
 
 import numpy as np
@@ -52,19 +67,33 @@ from urllib.request import Request, urlopen
 from urllib.error import URLError
 
 from copy import deepcopy
+from contextlib import closing
+from functools import partial
+from bisect import bisect_right
+from urllib.parse import urlparse, urldefrag, quote, unquote
 from cdo import Cdo
 from multiprocessing import Pool, cpu_count
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 from os import makedirs
 from os.path import join, exists, split
 from argparse import ArgumentParser
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+try:
+    import eccodes
+except ImportError:
+    eccodes = None
 # -------------------------------------------------------------------------------------
 
 # -------------------------------------------------------------------------------------
 # Algorithm information
 alg_name = 'HYDE DOWNLOADING TOOL - NWP GFS'
-alg_version = '2.0.1'
-alg_release = '2024-05-24'
+alg_version = '2.9.0'
+alg_release = '2026-10-17'
 # Algorithm parameter(s)
 time_format = '%Y%m%d%H%M'
 # -------------------------------------------------------------------------------------
@@ -105,88 +134,216 @@ def main():
     logging.info(' --> TIME RUN: ' + str(time_run))
 
     # Iterate over time steps
-    for time_run_step in time_run_range:
-
-        # Starting info
-        logging.info(' ---> NWP RUN: ' + str(time_run_step) + ' ... ')
-
-        # Get data time range
-        time_data_range = set_data_time(time_run_step, data_settings['data']['dynamic']['time'])
-
-        # Set data sources
-        data_source = set_data_source(time_run_step, time_data_range,
-                                      data_settings['data']['dynamic']['source'],
-                                      data_settings['data']['static']['bounding_box'],
-                                      data_settings['algorithm']['ancillary'],
-                                      data_settings['algorithm']['template'],
-                                      type_data=data_settings['algorithm']['ancillary']['type'],)
-        # Set data ancillary
-        data_ancillary = set_data_ancillary(time_run_step, time_data_range,
-                                            data_settings['data']['dynamic']['ancillary'],
-                                            data_settings['data']['static']['bounding_box'],
-                                            data_settings['algorithm']['ancillary'],
-                                            data_settings['algorithm']['template'],
-                                            type_data=data_settings['algorithm']['ancillary']['type'],)
-
-        # Set data outcome global
+    if data_settings['algorithm']['flags'].get('processing_backfill', False):
+        # Overlap downloading of the next run(s) with the arranging of the previous one(s)
+        process_run_backfill(time_run_range, data_settings,
+                             runs_max=data_settings['algorithm']['ancillary'].get('backfill_runs_max', 2))
+    else:
+        for time_run_step in time_run_range:
+
+            # Starting info
+            logging.info(' ---> NWP RUN: ' + str(time_run_step) + ' ... ')
+
+            # Set data source, ancillary and outcome
+            run_ws = set_run_data(time_run_step, data_settings)
+            # Download data ancillary
+            retrieve_run_data(run_ws, data_settings)
+            # Merge and mask data ancillary to data outcome
+            arrange_run_data(run_ws, data_settings)
+
+            # Ending info
+            logging.info(' ---> NWP RUN: ' + str(time_run_step) + ' ... DONE')
+    # -------------------------------------------------------------------------------------
+
+    # -------------------------------------------------------------------------------------
+    # Info algorithm
+    time_elapsed = round(time.time() - start_time, 1)
+
+    logging.info(' ')
+    logging.info(' ==> ' + alg_name + ' (Version: ' + alg_version + ' Release_Date: ' + alg_release + ')')
+    logging.info(' ==> TIME ELAPSED: ' + str(time_elapsed) + ' seconds')
+    logging.info(' ==> ... END')
+    logging.info(' ==> Bye, Bye')
+    logging.info(' ============================================================================ ')
+    # -------------------------------------------------------------------------------------
+
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Method to process run(s) in backfill mode (download of a run overlaps the arranging of the previous run(s))
+def process_run_backfill(time_run_range, data_settings, runs_max=2):
+
+    logging.info(' ---> Process runs in backfill mode ... ')
+
+    runs_max = max(1, runs_max)
+    with ProcessPoolExecutor(max_workers=runs_max) as process_pool:
+
+        run_futures = []
+        for time_run_step in time_run_range:
+
+            # Bound the number of runs waiting for (or in) the arranging step
+            while len(run_futures) >= runs_max:
+                run_done, run_pending = wait(run_futures, return_when=FIRST_COMPLETED)
+                for run_future in run_done:
+                    run_future.result()
+                run_futures = list(run_pending)
+
+            logging.info(' ---> NWP RUN: ' + str(time_run_step) + ' ... ')
+
+            run_ws = set_run_data(time_run_step, data_settings)
+            retrieve_run_data(run_ws, data_settings)
+            run_futures.append(process_pool.submit(arrange_run_data, run_ws, data_settings))
+
+            logging.info(' ---> NWP RUN: ' + str(time_run_step) + ' ... DOWNLOADED')
+
+        for run_future in run_futures:
+            run_future.result()
+
+    logging.info(' ---> Process runs in backfill mode ... DONE')
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Method to set data source, ancillary and outcome of a run
+def set_run_data(time_run, data_settings):
+
+    # Get data time range
+    time_data_range = set_data_time(time_run, data_settings['data']['dynamic']['time'])
+
+    # Set global outcome (if not requested, domain is masked without a global outcome)
+    flag_outcome_global = data_settings['data']['dynamic']['outcome'].get('global') is not None
+    # Set server-side subregion from bounding box (only for domain outcome)
+    flag_bbox_auto = data_settings['data']['dynamic']['source'].get('url_bbox_auto', False)
+    if flag_bbox_auto and flag_outcome_global:
+        logging.warning(' ===> Global outcome is requested! Server-side subregion is not applied.')
+        flag_bbox_auto = False
+
+    # Set data sources
+    data_source = set_data_source(time_run, time_data_range,
+                                  data_settings['data']['dynamic']['source'],
+                                  data_settings['data']['static']['bounding_box'],
+                                  data_settings['algorithm']['ancillary'],
+                                  data_settings['algorithm']['template'],
+                                  type_data=data_settings['algorithm']['ancillary']['type'],
+                                  bbox_auto=flag_bbox_auto)
+    # Set data ancillary
+    data_ancillary = set_data_ancillary(time_run, time_data_range,
+                                        data_settings['data']['dynamic']['ancillary'],
+                                        data_settings['data']['static']['bounding_box'],
+                                        data_settings['algorithm']['ancillary'],
+                                        data_settings['algorithm']['template'],
+                                        type_data=data_settings['algorithm']['ancillary']['type'],)
+
+    # Set data outcome global
+    if flag_outcome_global:
         data_outcome_global = set_data_outcome(
-            time_run_step,
+            time_run,
             data_settings['data']['dynamic']['outcome']['global'],
             data_settings['data']['static']['bounding_box'],
             data_settings['algorithm']['ancillary'],
             data_settings['algorithm']['template'],
             type_data=data_settings['algorithm']['ancillary']['type'],
             flag_updating=data_settings['algorithm']['flags']['cleaning_dynamic_data_global'])
+    else:
+        data_outcome_global = {type_step: [None] for type_step in data_settings['algorithm']['ancillary']['type']}
+
+    # Set data outcome domain
+    data_outcome_domain = set_data_outcome(
+        time_run,
+        data_settings['data']['dynamic']['outcome']['domain'],
+        data_settings['data']['static']['bounding_box'],
+        data_settings['algorithm']['ancillary'],
+        data_settings['algorithm']['template'],
+        type_data=data_settings['algorithm']['ancillary']['type'],
+        flag_updating=data_settings['algorithm']['flags']['cleaning_dynamic_data_domain'])
+
+    run_ws = {'time_run': time_run, 'time_data_range': time_data_range,
+              'data_source': data_source, 'data_ancillary': data_ancillary,
+              'data_outcome_global': data_outcome_global, 'data_outcome_domain': data_outcome_domain}
+
+    return run_ws
+# -------------------------------------------------------------------------------------
 
-        # Set data outcome domain
-        data_outcome_domain = set_data_outcome(
-            time_run_step,
-            data_settings['data']['dynamic']['outcome']['domain'],
-            data_settings['data']['static']['bounding_box'],
-            data_settings['algorithm']['ancillary'],
-            data_settings['algorithm']['template'],
-            type_data=data_settings['algorithm']['ancillary']['type'],
-            flag_updating=data_settings['algorithm']['flags']['cleaning_dynamic_data_domain'])
 
-        if data_settings['algorithm']['flags']['downloading_mp']:
+# -------------------------------------------------------------------------------------
+# Method to download data ancillary of a run
+def retrieve_run_data(run_ws, data_settings):
+
+    time_run = run_ws['time_run']
+    time_data_range = run_ws['time_data_range']
+    data_source = run_ws['data_source']
+    data_ancillary = run_ws['data_ancillary']
+    data_outcome_global = run_ws['data_outcome_global']
+    data_outcome_domain = run_ws['data_outcome_domain']
+
+    if data_settings['algorithm']['flags'].get('downloading_progressive', False):
+        # Download, merge and mask data ancillary to data outcome as soon as steps are published
+        retrieve_data_source_progressive(
+            data_source, data_ancillary, data_outcome_global, data_outcome_domain,
+            time_run, time_data_range,
+            data_bbox=data_settings['data']['static']['bounding_box'],
+            source_standards=data_settings['data']['dynamic']['source']['vars_standards'],
+            flag_updating=data_settings['algorithm']['flags']['cleaning_dynamic_data_ancillary'],
+            limit=data_settings['algorithm']['ancillary']['remote_server_hit_per_min'],
+            limiter_file=data_settings['algorithm']['ancillary'].get('remote_server_limiter_file'),
+            partial_hours=data_settings['algorithm']['ancillary'].get('progressive_partial_hours'),
+            poll_min=data_settings['algorithm']['ancillary'].get('progressive_poll_min', 30),
+            poll_max=data_settings['algorithm']['ancillary'].get('progressive_poll_max', 600),
+            poll_timeout=data_settings['algorithm']['ancillary'].get('progressive_poll_timeout', 10800))
+    else:
+        if data_settings['algorithm']['flags'].get('downloading_async', False):
+            retrieve_data_source_async(
+                data_source, data_ancillary,
+                flag_updating=data_settings['algorithm']['flags']['cleaning_dynamic_data_ancillary'],
+                process_n=data_settings['algorithm']['ancillary'].get('process_async', 20),
+                limit=data_settings['algorithm']['ancillary']['remote_server_hit_per_min'],
+                limiter_file=data_settings['algorithm']['ancillary'].get('remote_server_limiter_file'),
+                request_timeout=data_settings['algorithm']['ancillary'].get('request_timeout', 200))
+        elif data_settings['algorithm']['flags']['downloading_mp']:
             retrieve_data_source_mp(
                 data_source, data_ancillary,
                 flag_updating=data_settings['algorithm']['flags']['cleaning_dynamic_data_ancillary'],
-                process_n=data_settings['algorithm']['ancillary']['process_mp'], limit=data_settings['algorithm']['ancillary']['remote_server_hit_per_min'])
+                process_n=data_settings['algorithm']['ancillary']['process_mp'], limit=data_settings['algorithm']['ancillary']['remote_server_hit_per_min'],
+                limiter_file=data_settings['algorithm']['ancillary'].get('remote_server_limiter_file'))
         else:
             retrieve_data_source_seq(
                 data_source, data_ancillary,
-                flag_updating=data_settings['algorithm']['flags']['cleaning_dynamic_data_ancillary'], limit=data_settings['algorithm']['ancillary']['remote_server_hit_per_min'])
+                flag_updating=data_settings['algorithm']['flags']['cleaning_dynamic_data_ancillary'], limit=data_settings['algorithm']['ancillary']['remote_server_hit_per_min'],
+                limiter_file=data_settings['algorithm']['ancillary'].get('remote_server_limiter_file'))
+# -------------------------------------------------------------------------------------
 
-        # Merge and mask data ancillary to data outcome
-        arrange_data_outcome(data_ancillary, data_outcome_global, data_outcome_domain,
-                             data_bbox=data_settings['data']['static']['bounding_box'],
-                             cdo_exec=data_settings['algorithm']['ancillary']['cdo_exec'],
-                             cdo_deps=data_settings['algorithm']['ancillary']['cdo_deps'],
-                             source_standards=data_settings['data']['dynamic']['source']['vars_standards'],
-                             data_range=time_data_range)
-
-        # Clean data tmp (such as ancillary and outcome global)
-        clean_data_tmp(
-            data_ancillary, data_outcome_global,
-            flag_cleaning_tmp=data_settings['algorithm']['flags']['cleaning_dynamic_data_tmp'])
-
-        # Ending info
-        logging.info(' ---> NWP RUN: ' + str(time_run_step) + ' ... DONE')
-    # -------------------------------------------------------------------------------------
 
-    # -------------------------------------------------------------------------------------
-    # Info algorithm
-    time_elapsed = round(time.time() - start_time, 1)
+# -------------------------------------------------------------------------------------
+# Method to merge and mask data ancillary to data outcome of a run
+def arrange_run_data(run_ws, data_settings):
 
-    logging.info(' ')
-    logging.info(' ==> ' + alg_name + ' (Version: ' + alg_version + ' Release_Date: ' + alg_release + ')')
-    logging.info(' ==> TIME ELAPSED: ' + str(time_elapsed) + ' seconds')
-    logging.info(' ==> ... END')
-    logging.info(' ==> Bye, Bye')
-    logging.info(' ============================================================================ ')
-    # -------------------------------------------------------------------------------------
+    time_data_range = run_ws['time_data_range']
+    data_ancillary = run_ws['data_ancillary']
+    data_outcome_global = run_ws['data_outcome_global']
+    data_outcome_domain = run_ws['data_outcome_domain']
 
+    # Data ancillary are merged and masked as soon as they are downloaded in progressive mode
+    if not data_settings['algorithm']['flags'].get('downloading_progressive', False):
+
+        # Merge and mask data ancillary to data outcome
+        if data_settings['algorithm']['flags'].get('arranging_cdo', False):
+            arrange_data_outcome(data_ancillary, data_outcome_global, data_outcome_domain,
+                                 data_bbox=data_settings['data']['static']['bounding_box'],
+                                 cdo_exec=data_settings['algorithm']['ancillary']['cdo_exec'],
+                                 cdo_deps=data_settings['algorithm']['ancillary']['cdo_deps'],
+                                 source_standards=data_settings['data']['dynamic']['source']['vars_standards'],
+                                 data_range=time_data_range)
+        else:
+            arrange_data_outcome_grib(data_ancillary, data_outcome_global, data_outcome_domain,
+                                      data_bbox=data_settings['data']['static']['bounding_box'],
+                                      source_standards=data_settings['data']['dynamic']['source']['vars_standards'],
+                                      data_range=time_data_range)
+
+    # Clean data tmp (such as ancillary and outcome global)
+    clean_data_tmp(
+        data_ancillary, data_outcome_global,
+        flag_cleaning_tmp=data_settings['algorithm']['flags']['cleaning_dynamic_data_tmp'])
 # -------------------------------------------------------------------------------------
 
 
@@ -262,7 +419,7 @@ def clean_data_tmp(data_ancillary, data_outcome_global,
                     os.remove(data_step)
         for data_key, data_value in data_outcome_global.items():
             for data_step in data_value:
-                if os.path.exists(data_step):
+                if (data_step is not None) and os.path.exists(data_step):
                     os.remove(data_step)
 # -------------------------------------------------------------------------------------
 
@@ -309,6 +466,12 @@ def arrange_data_outcome(src_data, dst_data_global, dst_data_domain,
         if isinstance(dst_data_domain_step, list):
             dst_data_domain_step = dst_data_domain_step[0]
 
+        # Global outcome not requested: use a temporary global file for cropping the domain
+        flag_global_tmp = dst_data_global_step is None
+        if flag_global_tmp:
+            dst_data_global_step = create_filename_tmp(folder=os.path.split(dst_data_domain_step)[0], suffix='.nc')
+            os.remove(dst_data_global_step)
+
         folder_data_global_step, filename_data_global_step = os.path.split(dst_data_global_step)
         tmp_data_global_step_cat = create_filename_tmp(folder=folder_data_global_step, suffix='.grib2')
         tmp_data_global_step_seltimestep = create_filename_tmp(folder=folder_data_global_step, suffix='.grib2')
@@ -347,63 +510,7 @@ def arrange_data_outcome(src_data, dst_data_global, dst_data_domain,
                     out_file = deepcopy(xr.open_dataset(dst_data_global_step))
                     os.remove(dst_data_global_step)
 
-                    if '2t' in var_in.tolist():
-                        if source_standards['source_temperature_mesurement_unit'] == 'C':
-                            pass
-                        elif source_standards['source_temperature_mesurement_unit'] == 'K':
-                            logging.info(' ------> Convert temperature to C ... ')
-                            #out_file = deepcopy(xr.open_dataset(dst_data_global_step))
-                            out_file['2t_C'] = out_file['2t'] - 273.15
-                            out_file['2t_C'].attrs['long_name'] = '2 metre temperature'
-                            out_file['2t_C'].attrs['units'] = 'C'
-                            out_file['2t_C'].attrs['standard_name'] = "air_temperature"
-                            out_file = out_file.rename({'2t': '2t_K'})
-                            #out_file.to_netcdf(dst_data_global_step)
-                            logging.info(' ------> Convert temperature to C ... DONE')
-                        else:
-                            raise NotImplementedError
-
-                    if 'tp' in var_in.tolist() and source_standards['source_precipitation_is_cumulated'] is True:
-                        logging.info(' ------> Decumulate precipitation ... ')
-                        #out_file = deepcopy(xr.open_dataset(dst_data_global_step))
-                        #os.remove(dst_data_global_step)
-                        out_file['tp'].values = np.diff(out_file['tp'].values, n=1, axis=0, prepend=0)
-                        out_file['tp'].attrs['long_name'] = 'hourly precipitation depth'
-                        out_file['tp'].attrs['units'] = 'mm'
-                        out_file['tp'].attrs['standard_name'] = "precipitation"
-                        #out_file.to_netcdf(dst_data_global_step)
-                        logging.info(' ------> Decumulate precipitation ... DONE')
-
-                    if '10u' in var_in.tolist() and source_standards['source_wind_separate_components'] is True:
-                        logging.info(' ------> Combine wind component ... ')
-                        #out_file = deepcopy(xr.open_dataset(dst_data_global_step))
-                        #os.remove(dst_data_global_step)
-                        out_file['10wind'] = np.sqrt(out_file['10u']**2 + out_file['10v']**2)
-                        out_file['10wind'].attrs['long_name'] = '10 m wind'
-                        out_file['10wind'].attrs['units'] = 'm s**-1'
-                        out_file['10wind'].attrs['standard_name'] = "wind"
-                        #out_file.to_netcdf(dst_data_global_step)
-                        logging.info(' ------> Combine wind component ... DONE')
-
-                    # out_file = deepcopy(xr.open_dataset(dst_data_global_step))
-                    # os.remove(dst_data_global_step)
-
-                    # Check if file has "heigth" dimension and remove it
-                    try:
-                        out_file = out_file.squeeze(dim="height", drop=True)
-                        out_file = out_file.squeeze(dim="height_2", drop=True)
-                        logging.info(' ------> Remove height dimensions ... ')
-                    except:
-                        pass
-
-                    try:
-                        out_file = out_file.squeeze(dim="reftime", drop=True)
-                        logging.info(' ------> Remove reftime dimensions ... ')
-                    except:
-                        pass
-
-                    # Reindex time axis by padding last available map over the time range
-                    out_file=out_file.reindex(time=data_range, method='nearest')
+                    out_file = convert_data_standards(out_file, var_in, source_standards, data_range)
                     out_file.to_netcdf(dst_data_global_step)
 
             if os.path.exists(tmp_data_global_step_cat):
@@ -427,12 +534,274 @@ def arrange_data_outcome(src_data, dst_data_global, dst_data_domain,
         else:
             logging.info(' ------> Mask data over domain ...  SKIPPED. Data already masked.')
 
+        if flag_global_tmp and os.path.exists(dst_data_global_step):
+            os.remove(dst_data_global_step)
+
         logging.info(' -----> Type ' + src_key_step + ' ... DONE')
 
     logging.info(' ----> Dumping data ... DONE')
 # -------------------------------------------------------------------------------------
 
 
+# -------------------------------------------------------------------------------------
+# Method to merge and mask outcome dataset(s) in a single in-process pass (ecCodes instead of cdo chain)
+def arrange_data_outcome_grib(src_data, dst_data_global, dst_data_domain,
+                              data_bbox=None, source_standards=None, data_range=None):
+
+    logging.info(' ----> Dumping data ... ')
+
+    if eccodes is None:
+        logging.error(' ===> Python eccodes library is not available! Grib data can not be arranged in-process.')
+        raise ImportError('Python eccodes library not found, please install or enable the "arranging_cdo" flag')
+
+    for (src_key_step, src_data_step), \
+        (dst_key_global_step, dst_data_global_step), (dst_key_domain_step, dst_data_domain_step) in \
+            zip(src_data.items(), dst_data_global.items(), dst_data_domain.items()):
+
+        logging.info(' -----> Type ' + src_key_step + ' ... ')
+
+        src_data_step.sort()
+        if isinstance(dst_data_global_step, list):
+            dst_data_global_step = dst_data_global_step[0]
+        if isinstance(dst_data_domain_step, list):
+            dst_data_domain_step = dst_data_domain_step[0]
+
+        flag_global = (dst_data_global_step is not None) and (not os.path.exists(dst_data_global_step))
+        flag_domain = (data_bbox is not None) and (not os.path.exists(dst_data_domain_step))
+
+        if flag_global or flag_domain:
+            logging.info(' ------> Read and crop data ... ')
+            dset_global, dset_domain = read_data_grib(
+                src_data_step, data_bbox=data_bbox if flag_domain else None, flag_global=flag_global)
+            logging.info(' ------> Read and crop data ... DONE')
+        else:
+            dset_global, dset_domain = None, None
+
+        logging.info(' ------> Merge, convert and project data ...  ')
+        if flag_global:
+            var_in = np.asarray(list(dset_global.data_vars))
+            logging.info(' ------> Var(s) found in file: ' + ','.join(var_in))
+            if (source_standards is not None) and source_standards['convert2standard_continuum_format']:
+                dset_global = convert_data_standards(dset_global, var_in, source_standards, data_range)
+            tmp_data = create_filename_tmp(folder=os.path.split(dst_data_global_step)[0], suffix='.nc')
+            dset_global.to_netcdf(tmp_data)
+            os.replace(tmp_data, dst_data_global_step)
+            logging.info(' ------> Merge, convert and project data ...  DONE')
+        else:
+            logging.info(' ------> Merge, convert and project data ...  SKIPPED. Data already merged.')
+
+        logging.info(' ------> Mask data over domain ...  ')
+        if flag_domain:
+            var_in = np.asarray(list(dset_domain.data_vars))
+            if (source_standards is not None) and source_standards['convert2standard_continuum_format']:
+                dset_domain = convert_data_standards(dset_domain, var_in, source_standards, data_range)
+            tmp_data = create_filename_tmp(folder=os.path.split(dst_data_domain_step)[0], suffix='.nc')
+            dset_domain.to_netcdf(tmp_data)
+            os.replace(tmp_data, dst_data_domain_step)
+            logging.info(' ------> Mask data over domain ...  DONE')
+        elif data_bbox is None:
+            logging.info(' ------> Mask data over domain ...  SKIPPED. Domain bounding box not defined.')
+        else:
+            logging.info(' ------> Mask data over domain ...  SKIPPED. Data already masked.')
+
+        logging.info(' -----> Type ' + src_key_step + ' ... DONE')
+
+    logging.info(' ----> Dumping data ... DONE')
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Method to read grib file(s) cropping each message to global [-180, 180] and domain grid(s) once decoded
+def read_data_grib(file_list, data_bbox=None, flag_global=True):
+
+    grib_ws = {}
+    for file_step in file_list:
+        update_data_grib(file_step, grib_ws, data_bbox=data_bbox, flag_global=flag_global)
+
+    return create_data_grib(grib_ws, data_bbox=data_bbox, flag_global=flag_global)
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Method to decode a grib file and to append its message(s) to the workspace of the decoded step(s)
+def update_data_grib(file_step, grib_ws, data_bbox=None, flag_global=True):
+
+    if not grib_ws:
+        grib_ws.update({'grid': None, 'global': {}, 'domain': {}, 'start': {}, 'attrs': {}})
+
+    var_data_global, var_data_domain = grib_ws['global'], grib_ws['domain']
+    var_step_start, var_attrs = grib_ws['start'], grib_ws['attrs']
+
+    with open(file_step, 'rb') as file_handle:
+        while True:
+            grib_id = eccodes.codes_grib_new_from_file(file_handle)
+            if grib_id is None:
+                break
+            try:
+                if grib_ws['grid'] is None:
+                    grib_ws['grid'] = set_grid_grib(grib_id, data_bbox=data_bbox)
+                grid_lat, grid_lon, grid_idx = grib_ws['grid']
+
+                var_name = eccodes.codes_get(grib_id, 'shortName')
+                var_time = pd.Timestamp(str(eccodes.codes_get(grib_id, 'validityDate')) +
+                                        str(eccodes.codes_get(grib_id, 'validityTime')).zfill(4))
+                var_start = eccodes.codes_get(grib_id, 'startStep')
+
+                if var_name not in var_attrs:
+                    var_attrs[var_name] = {'long_name': eccodes.codes_get(grib_id, 'name'),
+                                           'units': eccodes.codes_get(grib_id, 'units')}
+                    var_data_global[var_name], var_data_domain[var_name], var_step_start[var_name] = {}, {}, {}
+
+                # Keep only the message accumulated (or averaged) from the run start (as done by seltimestep)
+                if var_time in var_step_start[var_name] and var_step_start[var_name][var_time] <= var_start:
+                    continue
+                var_step_start[var_name][var_time] = var_start
+
+                var_values = eccodes.codes_get_values(grib_id)
+                if eccodes.codes_get(grib_id, 'bitmapPresent'):
+                    var_values[var_values == eccodes.codes_get(grib_id, 'missingValue')] = np.nan
+                var_values = var_values.reshape(grid_lat.shape[0], grid_lon.shape[0])
+
+                if flag_global:
+                    var_data_global[var_name][var_time] = var_values[:, grid_idx['lon_global']].astype(np.float32)
+                if data_bbox is not None:
+                    var_data_domain[var_name][var_time] = var_values[
+                        np.ix_(grid_idx['lat_domain'], grid_idx['lon_domain'])].astype(np.float32)
+            finally:
+                eccodes.codes_release(grib_id)
+
+    return grib_ws
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Method to create global and domain dataset(s) from the workspace of the decoded step(s)
+def create_data_grib(grib_ws, data_bbox=None, flag_global=True):
+
+    if not grib_ws or grib_ws['grid'] is None:
+        logging.error(' ===> No grib message found in source file(s)!')
+        raise IOError('No grib message found in source file(s)!')
+    grid_lat, grid_lon, grid_idx = grib_ws['grid']
+
+    dset_global, dset_domain = None, None
+    if flag_global:
+        dset_global = create_dset_grib(grib_ws['global'], grib_ws['attrs'],
+                                       grid_lat, grid_lon[grid_idx['lon_global']])
+    if data_bbox is not None:
+        dset_domain = create_dset_grib(grib_ws['domain'], grib_ws['attrs'],
+                                       grid_lat[grid_idx['lat_domain']], grid_lon[grid_idx['lon_domain']])
+
+    return dset_global, dset_domain
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Method to define grid coordinates (lon shifted to [-180, 180]) and crop indexes from the first grib message
+def set_grid_grib(grib_id, data_bbox=None):
+
+    grid_lat = np.linspace(eccodes.codes_get(grib_id, 'latitudeOfFirstGridPointInDegrees'),
+                           eccodes.codes_get(grib_id, 'latitudeOfLastGridPointInDegrees'),
+                           eccodes.codes_get(grib_id, 'Nj'))
+    grid_lon_first = eccodes.codes_get(grib_id, 'longitudeOfFirstGridPointInDegrees')
+    grid_lon_last = eccodes.codes_get(grib_id, 'longitudeOfLastGridPointInDegrees')
+    if grid_lon_last < grid_lon_first:
+        grid_lon_last = grid_lon_last + 360
+    grid_lon = np.linspace(grid_lon_first, grid_lon_last, eccodes.codes_get(grib_id, 'Ni'))
+    grid_lon = np.mod(grid_lon + 180, 360) - 180
+
+    grid_idx = {'lon_global': np.argsort(grid_lon, kind='stable')}
+    if data_bbox is not None:
+        lon_sorted = grid_lon[grid_idx['lon_global']]
+        if data_bbox['lon_left'] <= data_bbox['lon_right']:
+            grid_idx['lon_domain'] = grid_idx['lon_global'][
+                (lon_sorted >= data_bbox['lon_left']) & (lon_sorted <= data_bbox['lon_right'])]
+        else:
+            # Domain across the antimeridian: eastward from the left edge to the right edge
+            grid_idx['lon_domain'] = np.concatenate([
+                grid_idx['lon_global'][lon_sorted >= data_bbox['lon_left']],
+                grid_idx['lon_global'][lon_sorted <= data_bbox['lon_right']]])
+        grid_idx['lat_domain'] = np.where(
+            (grid_lat >= data_bbox['lat_bottom']) & (grid_lat <= data_bbox['lat_top']))[0]
+
+    return grid_lat, grid_lon, grid_idx
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Method to create a dataset from the decoded grib variable(s)
+def create_dset_grib(var_data, var_attrs, grid_lat, grid_lon):
+
+    dset_time = pd.DatetimeIndex(sorted(set([var_time for var_steps in var_data.values() for var_time in var_steps])))
+
+    dset_obj = xr.Dataset(coords={'time': dset_time, 'lat': grid_lat, 'lon': grid_lon})
+    for var_name, var_steps in var_data.items():
+        var_values = np.full((dset_time.shape[0], grid_lat.shape[0], grid_lon.shape[0]), np.nan, dtype=np.float32)
+        for var_time, var_step in var_steps.items():
+            var_values[dset_time.get_loc(var_time)] = var_step
+        dset_obj[var_name] = xr.DataArray(var_values, dims=['time', 'lat', 'lon'], attrs=var_attrs[var_name])
+
+    dset_obj['lat'].attrs = {'standard_name': 'latitude', 'units': 'degrees_north'}
+    dset_obj['lon'].attrs = {'standard_name': 'longitude', 'units': 'degrees_east'}
+
+    return dset_obj
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Method to convert dataset variable(s) to continuum standard(s)
+def convert_data_standards(out_file, var_in, source_standards, data_range):
+
+    if '2t' in var_in.tolist():
+        if source_standards['source_temperature_mesurement_unit'] == 'C':
+            pass
+        elif source_standards['source_temperature_mesurement_unit'] == 'K':
+            logging.info(' ------> Convert temperature to C ... ')
+            out_file['2t_C'] = out_file['2t'] - 273.15
+            out_file['2t_C'].attrs['long_name'] = '2 metre temperature'
+            out_file['2t_C'].attrs['units'] = 'C'
+            out_file['2t_C'].attrs['standard_name'] = "air_temperature"
+            out_file = out_file.rename({'2t': '2t_K'})
+            logging.info(' ------> Convert temperature to C ... DONE')
+        else:
+            raise NotImplementedError
+
+    if 'tp' in var_in.tolist() and source_standards['source_precipitation_is_cumulated'] is True:
+        logging.info(' ------> Decumulate precipitation ... ')
+        out_file['tp'].values = np.diff(out_file['tp'].values, n=1, axis=0, prepend=0)
+        out_file['tp'].attrs['long_name'] = 'hourly precipitation depth'
+        out_file['tp'].attrs['units'] = 'mm'
+        out_file['tp'].attrs['standard_name'] = "precipitation"
+        logging.info(' ------> Decumulate precipitation ... DONE')
+
+    if '10u' in var_in.tolist() and source_standards['source_wind_separate_components'] is True:
+        logging.info(' ------> Combine wind component ... ')
+        out_file['10wind'] = np.sqrt(out_file['10u']**2 + out_file['10v']**2)
+        out_file['10wind'].attrs['long_name'] = '10 m wind'
+        out_file['10wind'].attrs['units'] = 'm s**-1'
+        out_file['10wind'].attrs['standard_name'] = "wind"
+        logging.info(' ------> Combine wind component ... DONE')
+
+    # Check if file has "heigth" dimension and remove it
+    try:
+        out_file = out_file.squeeze(dim="height", drop=True)
+        out_file = out_file.squeeze(dim="height_2", drop=True)
+        logging.info(' ------> Remove height dimensions ... ')
+    except:
+        pass
+
+    try:
+        out_file = out_file.squeeze(dim="reftime", drop=True)
+        logging.info(' ------> Remove reftime dimensions ... ')
+    except:
+        pass
+
+    # Reindex time axis by padding last available map over the time range
+    out_file = out_file.reindex(time=data_range, method='nearest')
+
+    return out_file
+# -------------------------------------------------------------------------------------
+
+
 # -------------------------------------------------------------------------------------
 # Method to drop data
 def select_time_steps(info_file, id_start=2, id_end=None, id_period=2):
@@ -474,7 +843,8 @@ def create_filename_tmp(prefix='gfs_tmp_', suffix='.grib2', folder=None):
 
 # -------------------------------------------------------------------------------------
 # Method to retrieve and store data (multiprocess)
-def retrieve_data_source_mp(src_data, dst_data, flag_updating=False, process_n=20, process_max=None, limit=9999):
+def retrieve_data_source_mp(src_data, dst_data, flag_updating=False, process_n=20, process_max=None, limit=9999,
+                            limiter_file=None):
 
     logging.info(' ----> Downloading data in multiprocessing mode ... ')
 
@@ -503,86 +873,373 @@ def retrieve_data_source_mp(src_data, dst_data, flag_updating=False, process_n=2
 
             data_check.append([src_step_url, dst_step_path])
 
-    if len(data_list)>limit:
-        for i in range(0,len(data_list),limit):
-            max_available = min(i + limit, len(data_list))
-            chunk = data_list[i:i + limit]
-
-            with Pool(processes=process_n, maxtasksperchild=1) as process_pool:
-                _ = process_pool.map(request_data_source, chunk, chunksize=1)
-                process_pool.close()
-                process_pool.join()
-
-            logging.info(' ----> Wait 60 seconds for next requests ...')
-            time.sleep(60)
-            if max_available<len(data_list):
-                logging.info(' ----> '  + str(int(100*max_available/len(data_list))) + ' % complete...')
-                logging.info(' ----> Continue with next chunk of requests...')
-    else:
-        with Pool(processes=process_n, maxtasksperchild=1) as process_pool:
-            _ = process_pool.map(request_data_source, data_list, chunksize=1)
-            process_pool.close()
-            process_pool.join()
+    # Hits per minute are paced by the token bucket shared by all the workers (and processes) on the machine
+    with Pool(processes=process_n, maxtasksperchild=1) as process_pool:
+        _ = process_pool.map(partial(request_data_source, limit=limit, limiter_file=limiter_file),
+                             data_list, chunksize=1)
+        process_pool.close()
+        process_pool.join()
 
-    find_data_corrupted(data_check)
+    find_data_corrupted(data_check, limit=limit, limiter_file=limiter_file)
 
     logging.info(' ----> Downloading data in multiprocessing mode ... DONE')
 # -------------------------------------------------------------------------------------
 
 
-# ------------------------------------------------------------------------------------
-# Method to find outliers and to retry for downloading data again
-def find_data_corrupted(data_list, data_perc_min=5, data_size_min=100000):
+# -------------------------------------------------------------------------------------
+# Method to retrieve, decode and dump data step by step as soon as they are published (progressive mode)
+def retrieve_data_source_progressive(src_data, dst_data, dst_data_global, dst_data_domain, time_run, data_range,
+                                     data_bbox=None, source_standards=None, flag_updating=False,
+                                     limit=9999, limiter_file=None, partial_hours=None,
+                                     poll_min=30, poll_max=600, poll_timeout=10800):
 
-    logging.info(' -----> Checking for corrupted or unavailable data  ... ')
+    logging.info(' ----> Downloading data in progressive mode ... ')
+
+    if eccodes is None:
+        logging.error(' ===> Python eccodes library is not available! Progressive mode can not be used.')
+        raise ImportError('Python eccodes library not found, please install or disable the "downloading_progressive" flag')
+
+    if partial_hours is None:
+        partial_hours = []
+    partial_steps = {int((data_range <= time_run + pd.Timedelta(hours=partial_hour)).sum()): partial_hour
+                     for partial_hour in partial_hours}
+
+    for (src_data_key, src_data_list), (dst_data_key, dst_data_list), \
+        (dst_key_global_step, dst_data_global_step), (dst_key_domain_step, dst_data_domain_step) in \
+            zip(src_data.items(), dst_data.items(), dst_data_global.items(), dst_data_domain.items()):
+
+        logging.info(' -----> DataType: ' + src_data_key + ' ... ')
+
+        if isinstance(dst_data_global_step, list):
+            dst_data_global_step = dst_data_global_step[0]
+        if isinstance(dst_data_domain_step, list):
+            dst_data_domain_step = dst_data_domain_step[0]
+
+        flag_global = (dst_data_global_step is not None) and (not os.path.exists(dst_data_global_step))
+        flag_domain = (data_bbox is not None) and (not os.path.exists(dst_data_domain_step))
+        if not (flag_global or flag_domain):
+            logging.info(' -----> DataType: ' + src_data_key + ' ... SKIPPED. Data already dumped.')
+            continue
+
+        grib_ws = {}
+        poll_wait, poll_start = poll_min, time.time()
+        step_id = 0
+        while step_id < len(src_data_list):
+
+            src_step_url, dst_step_path = src_data_list[step_id], dst_data_list[step_id]
+            dst_step_root, dst_step_file = split(dst_step_path)
+            make_folder(dst_step_root)
+
+            if flag_updating or (not check_data_grib(dst_step_path)):
+                try:
+                    request_data_source([src_step_url, dst_step_path], limit=limit, limiter_file=limiter_file)
+                    if not check_data_grib(dst_step_path):
+                        os.remove(dst_step_path)
+                        raise IOError('Step ' + dst_step_file + ' is corrupted!')
+                except IOError:
+                    if time.time() - poll_start > poll_timeout:
+                        logging.error(' ===> Step ' + dst_step_file + ' is not published after ' +
+                                      str(poll_timeout) + ' seconds!')
+                        raise TimeoutError('Step ' + dst_step_file + ' is not published on the server!')
+                    logging.info(' ------> Step ' + dst_step_file + ' is not published. Wait ' +
+                                 str(poll_wait) + ' seconds ...')
+                    time.sleep(poll_wait)
+                    poll_wait = min(poll_wait * 2, poll_max)
+                    continue
+
+            poll_wait = poll_min
+            update_data_grib(dst_step_path, grib_ws,
+                             data_bbox=data_bbox if flag_domain else None, flag_global=flag_global)
+            step_id += 1
+
+            # Publish the partial product(s) as soon as the requested lead time(s) are available (partial file names,
+            # only the complete product is dumped to the outcome path(s))
+            if step_id in partial_steps and step_id < len(src_data_list):
+                logging.info(' ------> Dump partial data (' + str(step_id) + ' steps) ... ')
+                dump_data_grib(grib_ws,
+                               set_filename_partial(dst_data_global_step, partial_steps[step_id]),
+                               set_filename_partial(dst_data_domain_step, partial_steps[step_id]),
+                               data_bbox=data_bbox if flag_domain else None, flag_global=flag_global,
+                               source_standards=source_standards, data_range=data_range[:step_id])
+                logging.info(' ------> Dump partial data (' + str(step_id) + ' steps) ... DONE')
+
+        logging.info(' ------> Dump data ... ')
+        dump_data_grib(grib_ws, dst_data_global_step, dst_data_domain_step,
+                       data_bbox=data_bbox if flag_domain else None, flag_global=flag_global,
+                       source_standards=source_standards, data_range=data_range)
+        # Remove the partial product(s) superseded by the complete one
+        for partial_hour in partial_steps.values():
+            for dst_partial in [set_filename_partial(dst_data_global_step, partial_hour),
+                                set_filename_partial(dst_data_domain_step, partial_hour)]:
+                if (dst_partial is not None) and os.path.exists(dst_partial):
+                    os.remove(dst_partial)
+        logging.info(' ------> Dump data ... DONE')
+
+        logging.info(' -----> DataType: ' + src_data_key + ' ... DONE')
+
+    logging.info(' ----> Downloading data in progressive mode ... DONE')
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Method to define the filename of a partial product (<name>_partial_<N>h<ext>)
+def set_filename_partial(file_name, partial_hour):
+    if file_name is None:
+        return None
+    file_root, file_ext = os.path.splitext(file_name)
+    return file_root + '_partial_' + str(partial_hour) + 'h' + file_ext
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Method to dump global and domain dataset(s) from the workspace of the decoded step(s) (atomic replace)
+def dump_data_grib(grib_ws, dst_data_global, dst_data_domain, data_bbox=None, flag_global=True,
+                   source_standards=None, data_range=None):
+
+    dset_global, dset_domain = create_data_grib(grib_ws, data_bbox=data_bbox, flag_global=flag_global)
+
+    for dset_obj, dst_data in zip([dset_global, dset_domain], [dst_data_global, dst_data_domain]):
+        if (dset_obj is None) or (dst_data is None):
+            continue
+        var_in = np.asarray(list(dset_obj.data_vars))
+        if (source_standards is not None) and source_standards['convert2standard_continuum_format']:
+            dset_obj = convert_data_standards(dset_obj, var_in, source_standards, data_range)
+
+        tmp_data = create_filename_tmp(folder=os.path.split(dst_data)[0], suffix='.nc')
+        dset_obj.to_netcdf(tmp_data)
+        os.replace(tmp_data, dst_data)
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Method to retrieve and store data (asyncio)
+def retrieve_data_source_async(src_data, dst_data, flag_updating=False, process_n=20, limit=9999,
+                               limiter_file=None, request_timeout=200, chunk_size=1048576, retry_n=3):
+
+    logging.info(' ----> Downloading data in asyncio mode ... ')
 
-    data_size = []
-    idx_nodata = []
-    for dst_id, dst_step_path in enumerate(data_list):
-        if os.path.exists(dst_step_path[1]):
-            dst_step_size = os.path.getsize(dst_step_path[1])
+    if aiohttp is None:
+        logging.error(' ===> Python aiohttp library is not available! Asyncio mode can not be used.')
+        raise ImportError('Python aiohttp library not found, please install or disable the "downloading_async" flag')
+
+    data_list = []
+    data_check = []
+    for (src_data_key, src_data_list), (dst_data_key, dst_data_list) in zip(src_data.items(), dst_data.items()):
+        for src_step_url, dst_step_path in zip(src_data_list, dst_data_list):
+            dst_step_root, dst_step_file = split(dst_step_path)
+            make_folder(dst_step_root)
+
+            if exists(dst_step_path) and flag_updating:
+                flag_updating = True
+            elif (not exists(dst_step_path)) and flag_updating:
+                flag_updating = True
+            elif (not exists(dst_step_path)) and (not flag_updating):
+                flag_updating = True
+            if flag_updating:
+                data_list.append([src_step_url, dst_step_path])
+
+            data_check.append([src_step_url, dst_step_path])
+
+    asyncio.run(request_data_source_async(data_list, process_n=process_n, limit=limit, limiter_file=limiter_file,
+                                          request_timeout=request_timeout, chunk_size=chunk_size, retry_n=retry_n))
+
+    find_data_corrupted(data_check, limit=limit, limiter_file=limiter_file)
+
+    logging.info(' ----> Downloading data in asyncio mode ... DONE')
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Method to request a list of data sharing one keep-alive connection pool per host
+async def request_data_source_async(data_list, process_n=20, limit=9999, limiter_file=None,
+                                    request_timeout=200, chunk_size=1048576, retry_n=3):
+
+    request_connector = aiohttp.TCPConnector(limit=process_n, limit_per_host=process_n)
+    request_timeout = aiohttp.ClientTimeout(total=None, sock_connect=request_timeout, sock_read=request_timeout)
+    request_semaphore = asyncio.Semaphore(process_n)
+
+    async with aiohttp.ClientSession(connector=request_connector, timeout=request_timeout) as request_session:
+        request_results = await asyncio.gather(
+            *[stream_data_source_async(request_session, request_semaphore, data_step[0], data_step[1],
+                                       limit=limit, limiter_file=limiter_file,
+                                       chunk_size=chunk_size, retry_n=retry_n) for data_step in data_list],
+            return_exceptions=True)
+
+    # Failed requests are left to the check of corrupted or unavailable data
+    for data_step, request_result in zip(data_list, request_results):
+        if isinstance(request_result, BaseException):
+            logging.warning(' :: Http request for downloading: ' + data_step[0] + ' ... FAILED. ' +
+                            str(request_result))
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Method to stream data to a partial file using an asyncio session (same policy of stream_data_source)
+async def stream_data_source_async(session, semaphore, src_url, dst_path, limit=9999, limiter_file=None,
+                                   chunk_size=1048576, retry_n=3):
+
+    dst_path_part = dst_path + '.part'
+    request_loop = asyncio.get_running_loop()
+
+    async with semaphore:
+        logging.info(' :: Http request for downloading: ' + src_url + ' ... ')
+
+        # Index (.idx) sources are retrieved by byte-range requests in a worker thread
+        if urldefrag(src_url)[1]:
+            await request_loop.run_in_executor(
+                None, partial(stream_data_source, src_url, dst_path, chunk_size=chunk_size, retry_n=retry_n,
+                              limit=limit, limiter_file=limiter_file))
+            logging.info(' :: Http request for downloading: ' + src_url + ' ... DONE')
+            return
+
+        for retry_id in range(retry_n):
+
+            if exists(dst_path_part):
+                part_size = os.path.getsize(dst_path_part)
+            else:
+                part_size = 0
+
+            request_headers = {}
+            if part_size > 0:
+                request_headers['Range'] = 'bytes=' + str(part_size) + '-'
+
+            # Token reservation (sqlite transaction) and file writes run in the default executor: a locked
+            # limiter or a slow disk must not stall the other requests of the event loop
+            await asyncio.sleep(await request_loop.run_in_executor(
+                None, partial(reserve_server_token, src_url, limit=limit, limiter_file=limiter_file)))
+
+            try:
+                async with session.get(src_url, headers=request_headers) as request:
+
+                    # Partial file already covers the whole remote file
+                    if request.status == 416:
+                        remote_size = request.headers.get('Content-Range', '').split('/')[-1]
+                        if remote_size.isdigit() and int(remote_size) == part_size:
+                            break
+                        os.remove(dst_path_part)
+                        continue
+
+                    request.raise_for_status()
+
+                    # Append to the partial file only if the server honoured the range header
+                    if request.status == 206:
+                        part_mode = 'ab'
+                    else:
+                        part_mode, part_size = 'wb', 0
+
+                    request_length = request.headers.get('Content-Length')
+                    fh = await request_loop.run_in_executor(None, open, dst_path_part, part_mode)
+                    try:
+                        async for request_chunk in request.content.iter_chunked(chunk_size):
+                            await request_loop.run_in_executor(None, fh.write, request_chunk)
+                    finally:
+                        await request_loop.run_in_executor(None, fh.close)
+
+                if request_length is not None and os.path.getsize(dst_path_part) < part_size + int(request_length):
+                    logging.warning(' :: Http request for downloading: ' + src_url + ' ... INTERRUPTED. Resume ' +
+                                    str(retry_id + 1) + '/' + str(retry_n))
+                    continue
+                break
+
+            except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                logging.warning(' :: Http request for downloading: ' + src_url + ' ... INTERRUPTED. Resume ' +
+                                str(retry_id + 1) + '/' + str(retry_n))
         else:
-            dst_step_size = 0
-            idx_nodata.append(dst_id)
-        data_size.append(dst_step_size)
-    data_size = np.asarray(data_size)
+            raise ConnectionResetError(' :: Http request for downloading: ' + src_url +
+                                       ' ... FAILED. Retries exhausted.')
+
+        os.replace(dst_path_part, dst_path)
+        logging.info(' :: Http request for downloading: ' + src_url + ' ... DONE')
+# -------------------------------------------------------------------------------------
 
-    data_p_min = np.percentile(data_size, data_perc_min)
 
-    idx_false = np.where(data_size < min([data_size_min, data_p_min]))[0]
-    idx_nodata = np.asarray(idx_nodata, int)
-    idx_retry = np.unique(np.concatenate((idx_false, idx_nodata), axis=0))
+# ------------------------------------------------------------------------------------
+# Method to find corrupted (by grib structure) or unavailable data and to retry for downloading data again
+def find_data_corrupted(data_list, messages_min=1, limit=9999, limiter_file=None):
+
+    logging.info(' -----> Checking for corrupted or unavailable data  ... ')
+
+    for data_step in data_list:
 
-    for idx_step in idx_retry:
-        data_false = data_list[idx_step]
+        if check_data_grib(data_step[1], messages_min=messages_min):
+            continue
 
-        if os.path.exists(data_false[1]):
-            os.remove(data_false[1])
+        if os.path.exists(data_step[1]):
+            os.remove(data_step[1])
 
-        logging.info(' ------> Downloading data ' + split(data_false[1])[1] + ' ... ')
-        request_data_source(data_false)
-        logging.info(' ------> Downloading data ' + split(data_false[1])[1] + ' ... DONE')
+        logging.info(' ------> Downloading data ' + split(data_step[1])[1] + ' ... ')
+        request_data_source(data_step, limit=limit, limiter_file=limiter_file)
+        logging.info(' ------> Downloading data ' + split(data_step[1])[1] + ' ... DONE')
 
     logging.info(' -----> Checking for corrupted or unavailable data  ... DONE')
 # ------------------------------------------------------------------------------------
 
 
+# ------------------------------------------------------------------------------------
+# Method to check the grib framing ("GRIB" ... "7777") and section lengths of a file without decoding data
+def check_data_grib(file_path, messages_min=1):
+
+    if (not os.path.exists(file_path)) or os.path.getsize(file_path) == 0:
+        return False
+
+    messages_n = 0
+    with open(file_path, 'rb') as file_handle, \
+            mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ) as file_map:
+
+        file_size = len(file_map)
+        msg_start = 0
+        while msg_start < file_size:
+
+            if msg_start + 16 > file_size or file_map[msg_start:msg_start + 4] != b'GRIB':
+                return False
+
+            msg_edition = file_map[msg_start + 7]
+            if msg_edition == 2:
+                msg_end = msg_start + int.from_bytes(file_map[msg_start + 8:msg_start + 16], 'big')
+                if msg_end > file_size:
+                    return False
+                # Section(s) 1-7 must fill the message up to the end section
+                sec_start = msg_start + 16
+                while sec_start < msg_end - 4:
+                    sec_length = int.from_bytes(file_map[sec_start:sec_start + 4], 'big')
+                    if sec_length < 5 or file_map[sec_start + 4] not in range(1, 8):
+                        return False
+                    sec_start += sec_length
+                if sec_start != msg_end - 4:
+                    return False
+            elif msg_edition == 1:
+                msg_end = msg_start + int.from_bytes(file_map[msg_start + 4:msg_start + 7], 'big')
+                if msg_end > file_size:
+                    return False
+            else:
+                return False
+
+            if file_map[msg_end - 4:msg_end] != b'7777':
+                return False
+
+            messages_n += 1
+            msg_start = msg_end
+
+    return messages_n >= messages_min
+# ------------------------------------------------------------------------------------
+
+
 # -------------------------------------------------------------------------------------
 # Method to request data using a source url and a destination filename
-def request_data_source(data_list):
+def request_data_source(data_list, data_size_min=1000, chunk_size=1048576, retry_n=3, limit=9999, limiter_file=None):
     logging.info(' :: Http request for downloading: ' + data_list[0] + ' ... ')
     logging.info(' :: Outcome data will be dumped in: ' + split(data_list[1])[1] + ' ... ')
 
     try:
-        request = requests.get(data_list[0], timeout=200, stream=True)
-        with open(data_list[1], 'wb') as fh:
-            fh.write(request.content)
-        if os.path.getsize(data_list[1]) < 1000:
-            request = requests.get(data_list[0], timeout=1000, stream=True)
-            with open(data_list[1], 'wb') as fh:
-                fh.write(request.content)
-            if os.path.getsize(data_list[1]) < 1000:
-                raise FileNotFoundError("ERROR! File : " + data_list[1] + " is too small!")
+        # First attempt with the default timeout, then retry with a larger one (as for small files)
+        for request_timeout in [200, 1000]:
+            stream_data_source(data_list[0], data_list[1], timeout=request_timeout,
+                               chunk_size=chunk_size, retry_n=retry_n, limit=limit, limiter_file=limiter_file)
+            if os.path.getsize(data_list[1]) >= data_size_min:
+                break
+            os.remove(data_list[1])
+        else:
+            raise FileNotFoundError("ERROR! File : " + data_list[1] + " is too small!")
         #urllib.request.urlretrieve(data_list[0], filename=data_list[1])
         logging.info(' :: Outcome data will be dumped in: ' + split(data_list[1])[1] + ' ... DONE')
         logging.info(' :: Http request for downloading: ' + data_list[0] + ' ... DONE')
@@ -606,15 +1263,207 @@ def request_data_source(data_list):
 # -------------------------------------------------------------------------------------
 
 
+# -------------------------------------------------------------------------------------
+# Method to stream data to a partial file (resuming it with http range requests) and to rename it when completed
+def stream_data_source(src_url, dst_path, timeout=200, chunk_size=1048576, retry_n=3, limit=9999, limiter_file=None):
+
+    # Messages selected from the index file are passed as url fragment (never sent to the server)
+    src_url, src_select = urldefrag(src_url)
+    if src_select:
+        stream_data_source_idx(src_url, dst_path, unquote(src_select).split('|'), timeout=timeout,
+                               chunk_size=chunk_size, retry_n=retry_n, limit=limit, limiter_file=limiter_file)
+        return
+
+    dst_path_part = dst_path + '.part'
+
+    for retry_id in range(retry_n):
+
+        if exists(dst_path_part):
+            part_size = os.path.getsize(dst_path_part)
+        else:
+            part_size = 0
+
+        request_headers = {}
+        if part_size > 0:
+            request_headers['Range'] = 'bytes=' + str(part_size) + '-'
+
+        time.sleep(reserve_server_token(src_url, limit=limit, limiter_file=limiter_file))
+
+        try:
+            with requests.get(src_url, headers=request_headers, timeout=timeout, stream=True) as request:
+
+                # Partial file already covers the whole remote file
+                if request.status_code == 416:
+                    remote_size = request.headers.get('Content-Range', '').split('/')[-1]
+                    if remote_size.isdigit() and int(remote_size) == part_size:
+                        break
+                    os.remove(dst_path_part)
+                    continue
+
+                request.raise_for_status()
+
+                # Append to the partial file only if the server honoured the range header
+                if request.status_code == 206:
+                    part_mode = 'ab'
+                else:
+                    part_mode, part_size = 'wb', 0
+
+                request_length = request.headers.get('Content-Length')
+                with open(dst_path_part, part_mode) as fh:
+                    for request_chunk in request.iter_content(chunk_size=chunk_size):
+                        if request_chunk:
+                            fh.write(request_chunk)
+
+            if request_length is not None and os.path.getsize(dst_path_part) < part_size + int(request_length):
+                logging.warning(' :: Http request for downloading: ' + src_url + ' ... INTERRUPTED. Resume ' +
+                                str(retry_id + 1) + '/' + str(retry_n))
+                continue
+            break
+
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout):
+            logging.warning(' :: Http request for downloading: ' + src_url + ' ... INTERRUPTED. Resume ' +
+                            str(retry_id + 1) + '/' + str(retry_n))
+    else:
+        raise ConnectionResetError(' :: Http request for downloading: ' + src_url + ' ... FAILED. Retries exhausted.')
+
+    os.replace(dst_path_part, dst_path)
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Method to stream the selected grib messages using the index (.idx) file and http byte-range requests
+def stream_data_source_idx(src_url, dst_path, src_select, timeout=200, chunk_size=1048576, retry_n=3,
+                           limit=9999, limiter_file=None):
+
+    dst_path_part = dst_path + '.part'
+
+    with requests.Session() as request_session:
+
+        time.sleep(reserve_server_token(src_url, limit=limit, limiter_file=limiter_file))
+        request_idx = request_session.get(src_url + '.idx', timeout=timeout)
+        request_idx.raise_for_status()
+
+        src_ranges = select_idx_ranges(request_idx.text, src_select)
+        if not src_ranges:
+            logging.error(' :: Http request for downloading: ' + src_url + ' ... FAILED. No message(s) selected.')
+            raise IOError(' :: Http request for downloading: ' + src_url + ' ... FAILED. No message(s) selected.')
+
+        with open(dst_path_part, 'wb') as fh:
+            for range_start, range_end in src_ranges:
+
+                range_offset = fh.tell()
+                if range_end is None:
+                    range_header = 'bytes=' + str(range_start) + '-'
+                else:
+                    range_header = 'bytes=' + str(range_start) + '-' + str(range_end)
+
+                for retry_id in range(retry_n):
+
+                    fh.seek(range_offset)
+                    fh.truncate()
+
+                    time.sleep(reserve_server_token(src_url, limit=limit, limiter_file=limiter_file))
+
+                    try:
+                        with request_session.get(src_url, headers={'Range': range_header},
+                                                 timeout=timeout, stream=True) as request:
+                            request.raise_for_status()
+                            if request.status_code != 206:
+                                raise IOError(' :: Http request for downloading: ' + src_url +
+                                              ' ... FAILED. Byte-range requests are not supported by the server.')
+
+                            for request_chunk in request.iter_content(chunk_size=chunk_size):
+                                if request_chunk:
+                                    fh.write(request_chunk)
+
+                        if range_end is not None and fh.tell() - range_offset < range_end - range_start + 1:
+                            logging.warning(' :: Http request for downloading: ' + src_url + ' [' + range_header +
+                                            '] ... INTERRUPTED. Retry ' + str(retry_id + 1) + '/' + str(retry_n))
+                            continue
+                        break
+
+                    except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                            requests.exceptions.Timeout):
+                        logging.warning(' :: Http request for downloading: ' + src_url + ' [' + range_header +
+                                        '] ... INTERRUPTED. Retry ' + str(retry_id + 1) + '/' + str(retry_n))
+                else:
+                    raise ConnectionResetError(' :: Http request for downloading: ' + src_url +
+                                               ' ... FAILED. Retries exhausted.')
+
+    os.replace(dst_path_part, dst_path)
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Method to compute the byte ranges of the selected messages (contiguous messages are merged)
+def select_idx_ranges(idx_text, idx_select):
+
+    # Index row(s) format: "num:offset:d=YYYYMMDDHH:VAR:level:forecast:"
+    idx_rows = [idx_row.split(':') for idx_row in idx_text.splitlines() if idx_row.strip()]
+    idx_offsets = sorted(set([int(idx_row[1]) for idx_row in idx_rows]))
+
+    idx_ranges = []
+    for idx_row in idx_rows:
+        if ':'.join(idx_row[3:5]) not in idx_select:
+            continue
+
+        range_start = int(idx_row[1])
+        range_next = bisect_right(idx_offsets, range_start)
+        if range_next < len(idx_offsets):
+            range_end = idx_offsets[range_next] - 1
+        else:
+            range_end = None
+
+        if idx_ranges and idx_ranges[-1][1] is not None and idx_ranges[-1][1] + 1 >= range_start:
+            if idx_ranges[-1][1] < range_start:
+                idx_ranges[-1] = (idx_ranges[-1][0], range_end)
+        else:
+            idx_ranges.append((range_start, range_end))
+
+    return idx_ranges
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Method to reserve a token of the remote server bucket (shared by all processes through a sqlite file)
+def reserve_server_token(src_url, limit=9999, limiter_file=None, limiter_burst=1):
+
+    if limiter_file is None:
+        limiter_file = join(tempfile.gettempdir(), 'door_server_limiter.db')
+
+    src_host = urlparse(src_url).netloc
+    token_rate = limit / 60.0
+
+    # Tokens may go negative: the deficit is the time to wait before using the reserved token
+    with closing(sqlite3.connect(limiter_file, timeout=60, isolation_level=None)) as limiter_db:
+        limiter_db.execute('CREATE TABLE IF NOT EXISTS bucket (host TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+        limiter_db.execute('BEGIN IMMEDIATE')
+        bucket_row = limiter_db.execute('SELECT tokens, updated FROM bucket WHERE host = ?', (src_host,)).fetchone()
+
+        time_now = time.time()
+        if bucket_row is None:
+            bucket_tokens = limiter_burst
+        else:
+            bucket_tokens = min(limiter_burst, bucket_row[0] + (time_now - bucket_row[1]) * token_rate)
+        bucket_tokens -= 1
+
+        limiter_db.execute('INSERT OR REPLACE INTO bucket (host, tokens, updated) VALUES (?, ?, ?)',
+                           (src_host, bucket_tokens, time_now))
+        limiter_db.execute('COMMIT')
+
+    return max(0.0, -bucket_tokens / token_rate)
+# -------------------------------------------------------------------------------------
+
+
 # -------------------------------------------------------------------------------------
 # Method to retrieve and store data (sequential)
-def retrieve_data_source_seq(src_data, dst_data, flag_updating=False, limit=9999):
+def retrieve_data_source_seq(src_data, dst_data, flag_updating=False, limit=9999, limiter_file=None):
 
     logging.info(' ----> Downloading data in sequential mode ... ')
 
     data_list = []
     data_check = []
-    hit_count = 0
     for (src_data_key, src_data_list), (dst_data_key, dst_data_list) in zip(src_data.items(), dst_data.items()):
 
         logging.info(' -----> DataType: ' + src_data_key + ' ... ')
@@ -633,15 +1482,9 @@ def retrieve_data_source_seq(src_data, dst_data, flag_updating=False, limit=9999
                 flag_updating = True
 
             if flag_updating:
-                request_data_source([src_step_url, dst_step_path])
-                hit_count += 1
+                request_data_source([src_step_url, dst_step_path], limit=limit, limiter_file=limiter_file)
                 data_list.append([src_step_url, dst_step_path])
                 logging.info(' -------> Save data in file: ' + str(dst_step_file) + ' ... DONE')
-                if hit_count == limit:
-                    logging.info(' ----> Wait 60 seconds for next requests ...')
-                    time.sleep(60)
-                    hit_count = 0
-                    logging.info(' ----> Continue with next chunk of requests...')
             else:
                 logging.info(' ------> Save data in file: ' + str(dst_step_file) +
                              ' ... SKIPPED. File saved previously')
@@ -650,7 +1493,7 @@ def retrieve_data_source_seq(src_data, dst_data, flag_updating=False, limit=9999
 
         logging.info(' -----> DataType: ' + src_data_key + ' ... DONE')
 
-    find_data_corrupted(data_check)
+    find_data_corrupted(data_check, limit=limit, limiter_file=limiter_file)
 
     logging.info(' ----> Downloading data in sequential mode ... DONE')
 # -------------------------------------------------------------------------------------
@@ -765,7 +1608,7 @@ def set_data_ancillary(time_run, time_range, data_def, geo_def, ancillary_def, t
 # -------------------------------------------------------------------------------------
 # Method to create data source list
 def set_data_source(time_run, time_range, data_def, geo_def, ancillary_def, tags_template,
-                    type_data=None, anl_include=False):
+                    type_data=None, anl_include=False, bbox_auto=False):
 
     if type_data is None:
         type_data = ["surface"]
@@ -775,8 +1618,22 @@ def set_data_source(time_run, time_range, data_def, geo_def, ancillary_def, tags
     url_lev_list = data_def['url_lev']
     url_vars_list = data_def['url_vars']
     url_bbox_list = data_def['url_bbox']
+    if bbox_auto:
+        url_bbox_list = [set_url_bbox(geo_def, bbox_margin=data_def.get('url_bbox_margin', 1.0))] * len(url_bbox_list)
     url_loc_list = data_def['url_loc']
 
+    # Source mode: "filter" (nomads cgi subsetting) or "idx" (byte-range requests using the index files)
+    url_mode = data_def.get('url_mode', 'filter')
+    if url_mode == 'idx':
+        url_root_list = data_def['url_idx_root']
+        url_file_list = data_def['url_idx_file']
+        url_select_list = data_def['url_idx_select']
+    elif url_mode == 'filter':
+        url_select_list = [None] * len(url_root_list)
+    else:
+        logging.error(' ===> Source url mode "' + str(url_mode) + '" is not supported!')
+        raise NotImplementedError('Source url mode not supported! Use "filter" or "idx"')
+
     lon_right = geo_def['lon_right']
     lon_left = geo_def['lon_left']
     lat_top = geo_def['lat_top']
@@ -787,8 +1644,9 @@ def set_data_source(time_run, time_range, data_def, geo_def, ancillary_def, tags
     hour_run = time_run.hour
     datetime_run = time_run.to_pydatetime()
     url_ws = {}
-    for url_root_raw, url_file_raw, url_lev_raw, url_vars_raw, url_bbox_raw, url_loc_raw, type_step in zip(
-            url_root_list, url_file_list, url_lev_list, url_vars_list, url_bbox_list, url_loc_list, type_data):
+    for url_root_raw, url_file_raw, url_lev_raw, url_vars_raw, url_bbox_raw, url_loc_raw, url_select_raw, type_step in zip(
+            url_root_list, url_file_list, url_lev_list, url_vars_list, url_bbox_list, url_loc_list, url_select_list,
+            type_data):
 
         if url_bbox_raw is None:
             url_bbox_raw = ''
@@ -816,7 +1674,10 @@ def set_data_source(time_run, time_range, data_def, geo_def, ancillary_def, tags
             url_bbox_step = fill_tags2string(url_bbox_raw, tags_template, tags_values_step)
             url_loc_step = fill_tags2string(url_loc_raw, tags_template, tags_values_step)
 
-            url_step = url_root_step + url_file_step + url_lev_step + url_vars_step + url_bbox_step + url_loc_step
+            if url_select_raw is None:
+                url_step = url_root_step + url_file_step + url_lev_step + url_vars_step + url_bbox_step + url_loc_step
+            else:
+                url_step = url_root_step + url_file_step + '#' + quote('|'.join(url_select_raw))
 
             url_list.append(url_step)
 
@@ -826,6 +1687,32 @@ def set_data_source(time_run, time_range, data_def, geo_def, ancillary_def, tags
 # -------------------------------------------------------------------------------------
 
 
+# -------------------------------------------------------------------------------------
+# Method to define the server-side subregion from the domain bounding box (with margin and longitudes in [0, 360];
+# a domain crossing the greenwich meridian is sent as a wrapped pair with leftlon > rightlon)
+def set_url_bbox(geo_def, bbox_margin=1.0):
+
+    lat_bottom = max(-90.0, geo_def['lat_bottom'] - bbox_margin)
+    lat_top = min(90.0, geo_def['lat_top'] + bbox_margin)
+
+    lon_span = geo_def['lon_right'] - geo_def['lon_left']
+    if lon_span < 0:
+        lon_span = lon_span + 360
+    lon_span = lon_span + 2 * bbox_margin
+
+    if lon_span >= 360:
+        lon_left, lon_right = 0.0, 360.0
+    else:
+        lon_left = (geo_def['lon_left'] - bbox_margin) % 360
+        lon_right = (lon_left + lon_span) % 360
+
+    url_bbox = '&subregion=&leftlon=' + str(lon_left) + '&rightlon=' + str(lon_right) + \
+               '&toplat=' + str(lat_top) + '&bottomlat=' + str(lat_bottom)
+
+    return url_bbox
+# -------------------------------------------------------------------------------------
+
+
 # -------------------------------------------------------------------------------------
 # Method to add time in a unfilled string (path or filename)
 def fill_tags2string(string_raw, tags_format=None, tags_filling=None):
@@ -2,8 +2,8 @@
 """
 door - NWP GFS 0.25 OPeNDAP
 
-__date__ = '20240527'
-__version__ = '1.0.2'
+__date__ = '20261017'
+__version__ = '1.2.0'
 __author__ =
         'Andrea Libertino (andrea.libertino@cimafoundation.org',
 __library__ = 'door'
@@ -12,6 +12,10 @@ General command line:
 python3 door_downloader_nwp_gfs_opendap.py -settings_file configuration.json -time YYYY-MM-DD HH:MM
 
 Version(s):
+20261017 (1.2.0) --> Derive standard variables (precipitation, temperature, wind) as chunks arrive, check all-nan variables
+                     incrementally and write the outcome once (no ancillary reopen and rewrite)
+20261017 (1.1.0) --> Download (variable, time block) hyperslabs concurrently with per-chunk retries under the hit-per-minute budget,
+                     writing them in place in the ancillary file and resuming completed chunks
 20240527 (1.0.2) --> Add final check for all nan values in the downloaded file
 20230630 (1.0.1) --> Fixed longitude value for georeferenced plot
 20220512 (1.0.0) --> Beta release
@@ -23,26 +27,36 @@ Version(s):
 import datetime as dt
 import json
 import logging
+import netCDF4
 import numpy as np
 import os
 import pandas as pd
+import shutil
+import sqlite3
+import tempfile
+import threading
 import time
 import xarray as xr
 import warnings
 
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing
 from copy import deepcopy
 from itertools import chain
 from math import floor, ceil
+from urllib.parse import urlparse
 # -------------------------------------------------------------------------------------
 
 # -------------------------------------------------------------------------------------
 # Algorithm information
 alg_name = 'DOOR - NWP GFS - OPeNDAP'
-alg_version = '1.0.2'
-alg_release = '2024-05-27'
+alg_version = '1.2.0'
+alg_release = '2026-10-17'
 # Algorithm parameter(s)
 time_format = '%Y%m%d%H%M'
+# Thread data (one OPeNDAP handle for each download thread)
+thread_data = threading.local()
 # -------------------------------------------------------------------------------------
 
 # -------------------------------------------------------------------------------------
@@ -96,8 +110,6 @@ def main():
     if max_step > 121:
         logging.error(" ERROR! Only the first 120 forecast hours are available trough OPeNDAP, use nomads or ftp for downloading further steps!")
     time_span = (min_step, max_step)
-    time_range = pd.date_range(time_run + pd.Timedelta(str(min_step) + "H"),
-                               time_run + pd.Timedelta(str(max_step - 1) + "H"), freq="H")
     # Spatial settings
     logging.info(" ---> Space settings...")
     logging.warning(" ---> WARNING! Domain limits will be rounded to integer!")
@@ -123,7 +135,7 @@ def main():
 
     # Other settings
     logging.info(" ---> Model settings...")
-    vars = [i for i in data_settings['data']['dynamic']["variables"].keys()]
+    vars = [i for i in data_settings['data']['dynamic']["variables"].keys() if not i.startswith('__')]
     logging.info(" ----> Vars to be downloaded: " + (", ").join(vars))
 
     gfs = f"https://nomads.ncep.noaa.gov/dods/gfs_0p25_1hr"
@@ -133,70 +145,36 @@ def main():
     # -------------------------------------------------------------------------------------
 
     # -------------------------------------------------------------------------------------
-    # Download
-    logging.info(" --> Download forecast...")
+    # Download and postprocess (derived variable(s) are computed as chunks arrive and the outcome is written once)
+    logging.info(" --> Download and postprocess forecast...")
     ancillary_file = os.path.join(ancillary_fld, data_settings["data"]["ancillary"]["filename"]).format(**template_filled)
+    outcome_file = os.path.join(outcome_fld, data_settings["data"]["outcome"]["filename"]).format(**template_filled)
+    ancillary_settings = data_settings["algorithm"].get("ancillary", {})
     try:
-        with xr.open_dataset(url, engine="pydap") as ds:
-            ds[vars]\
-                .isel(time=slice(*time_span))\
-                .sel(lat=slice(*lat), lon=lon)\
-                .to_netcdf(ancillary_file)
-        logging.info(" --> Download forecast... DONE")
+        var_valid = retrieve_data_opendap(
+            url, vars, time_span, lat, lon, ancillary_file, time_run, geo_interval_lon,
+            var_names=data_settings['data']['dynamic']["variables"],
+            var_standards=data_settings['data']['dynamic']["vars_standards"],
+            time_block=ancillary_settings.get("time_block", 24),
+            process_n=ancillary_settings.get("process_n", 4),
+            retry_n=ancillary_settings.get("retry_n", 3),
+            limit=ancillary_settings.get("remote_server_hit_per_min", 120),
+            limiter_file=ancillary_settings.get("remote_server_limiter_file"))
+        logging.info(" --> Download and postprocess forecast... DONE")
     except:
         logging.error(" ERROR! Download failed. If you are sure the file exist, try to wait considering the 120 hit/minute limits of nomads server")
         raise FileNotFoundError
-    # -------------------------------------------------------------------------------------
 
-    # -------------------------------------------------------------------------------------
-    # Postprocessing
-    logging.info(" --> Postprocess data...")
-    ds_sub = xr.open_dataset(ancillary_file).assign_coords(time = time_range, lon = geo_interval_lon)
-    ds_sub.lon.attrs = {"grads_dim": 'x', "grads_mapping": 'linear', "grads_size": str(len(geo_interval_lon)),
-                        "units": 'degrees_east', "long_name": 'longitude', "minimum": -180, "maximum": 180,
-                        "resolution": 0.25}
-
-    if "apcpsfc" in ds_sub.keys() and \
-            data_settings['data']['dynamic']["vars_standards"]["decumulate_precipitation"] is True:
-        logging.info(" ---> Decumulate precipitation...")
-        first_step = ds_sub["apcpsfc"].values[0,:,:]
-        ds_sub["apcpsfc"] = ds_sub["apcpsfc"].diff("time",1)
-        ds_sub["apcpsfc"].values[0, :, :] = first_step
-        ds_sub['apcpsfc'].attrs['long_name'] = 'precipitation in the time step'
-        ds_sub['apcpsfc'].attrs['units'] = 'mm'
-        ds_sub['apcpsfc'].attrs['standard_name'] = "precipitation"
-        logging.info(" ---> Decumulate precipitation...DONE!")
-
-    if "tmp2m" in ds_sub.keys() and \
-            data_settings['data']['dynamic']["vars_standards"]["convert_temperature_to_C"] is True:
-        logging.info(" ---> Convert temperature to °C...")
-        ds_sub["tmp2m"] = ds_sub["tmp2m"] - 273.15
-        ds_sub['tmp2m'].attrs['long_name'] = '2 metre temperature'
-        ds_sub['tmp2m'].attrs['units'] = 'C'
-        ds_sub['tmp2m'].attrs['standard_name'] = "air_temperature"
-        logging.info(" ---> Convert temperature to °C...DONE!")
-
-    if "ugrd10m" in ds_sub.keys() and "vgrd10m" in ds_sub.keys() and \
-            data_settings['data']['dynamic']["vars_standards"]["aggregate_wind_components"] is True:
-        logging.info(" ---> Aggregate wind components...")
-        ds_sub["10wind"] = np.sqrt(ds_sub["ugrd10m"]**2 + ds_sub["vgrd10m"]**2)
-        ds_sub['10wind'].attrs['long_name'] = '10 m wind'
-        ds_sub['10wind'].attrs['units'] = 'm s**-1'
-        ds_sub['10wind'].attrs['standard_name'] = "wind"
-        logging.info(" ---> Aggregate wind components...DONE!")
-
-    logging.info(" ---> Rename variables and save...")
-    outcome_file = os.path.join(outcome_fld, data_settings["data"]["outcome"]["filename"]).format(**template_filled)
     logging.info(" ---> Check for all nan variables in the downloaded file...")
-    for var in ds_sub.keys():
-        if np.isnan(ds_sub[var]).all():
+    for var, var_flag in var_valid.items():
+        if not var_flag:
             logging.error("ERROR! " + var + " is composed of only nan values! Something was wrong in the download")
             raise ValueError
-        else:
-            logging.info(" ---> Check for all nan variables in the downloaded file...DONE! File is OK!")
-    ds_sub.rename(data_settings['data']['dynamic']["variables"]).to_netcdf(outcome_file)
-    os.remove(ancillary_file)
-    logging.info(" ---> Rename variables and save...DONE")
+    logging.info(" ---> Check for all nan variables in the downloaded file...DONE! File is OK!")
+
+    logging.info(" ---> Save...")
+    shutil.move(ancillary_file, outcome_file)
+    logging.info(" ---> Save...DONE")
     # -------------------------------------------------------------------------------------
 
     # -------------------------------------------------------------------------------------
@@ -211,6 +189,261 @@ def main():
     logging.info(' ============================================================================ ')
     # -------------------------------------------------------------------------------------
 
+# -------------------------------------------------------------------------------------
+# Method to download the forecast subset in (variable, time block) hyperslab(s) fetched concurrently, to derive
+# the standard variable(s) as hyperslab(s) arrive and to write them in place in the product file (completed
+# hyperslab(s) are checkpointed and skipped on restart); return the not-all-nan flag of each written variable
+def retrieve_data_opendap(url, var_list, time_span, lat, lon, ancillary_file, time_run, geo_interval_lon,
+                          var_names=None, var_standards=None,
+                          time_block=24, process_n=4, retry_n=3, limit=120, limiter_file=None):
+
+    if var_names is None:
+        var_names = {}
+    if var_standards is None:
+        var_standards = {}
+    flag_decumulate = "apcpsfc" in var_list and var_standards.get("decumulate_precipitation", False) is True
+    flag_temperature = "tmp2m" in var_list and var_standards.get("convert_temperature_to_C", False) is True
+    flag_wind = "ugrd10m" in var_list and "vgrd10m" in var_list and \
+        var_standards.get("aggregate_wind_components", False) is True
+
+    # Read coordinates and attributes once and define the hyperslab(s) as index slice(s)
+    time.sleep(reserve_server_token(url, limit=limit, limiter_file=limiter_file))
+    with xr.open_dataset(url, engine="pydap") as ds:
+        lat_values = ds["lat"].values
+        lon_values = ds["lon"].values
+        var_attrs = {var_name: dict(ds[var_name].attrs) for var_name in var_list}
+
+    lat_idx = np.where((lat_values >= lat[0]) & (lat_values <= lat[1]))[0]
+    lon_idx = pd.Index(lon_values).get_indexer(lon, method="nearest")
+    # Longitude is split in contiguous slices (two if the domain crosses the greenwich meridian)
+    lon_runs = np.split(lon_idx, np.where(np.diff(lon_idx) != 1)[0] + 1)
+    lat_slice = slice(int(lat_idx[0]), int(lat_idx[-1]) + 1)
+    lon_slices = [slice(int(lon_run[0]), int(lon_run[-1]) + 1) for lon_run in lon_runs]
+
+    # Define product variable(s) and attribute(s) (renamed and converted to standards)
+    if flag_decumulate:
+        var_attrs["apcpsfc"].update({"long_name": 'precipitation in the time step', "units": 'mm',
+                                     "standard_name": "precipitation"})
+    if flag_temperature:
+        var_attrs["tmp2m"].update({"long_name": '2 metre temperature', "units": 'C',
+                                   "standard_name": "air_temperature"})
+    out_attrs = {var_names.get(var_name, var_name): var_attr for var_name, var_attr in var_attrs.items()}
+    if flag_wind:
+        out_attrs["10wind"] = {"long_name": '10 m wind', "units": 'm s**-1', "standard_name": "wind"}
+
+    chunk_file = ancillary_file + ".done"
+    fix_file = ancillary_file + ".fix.npz"
+    if os.path.exists(ancillary_file) and os.path.exists(chunk_file):
+        with open(chunk_file, "r") as chunk_handle:
+            chunk_info = json.load(chunk_handle)
+        chunk_done = set([tuple(chunk_step) for chunk_step in chunk_info["chunks"]])
+        var_valid = {var_name: var_name in chunk_info["valid"] for var_name in out_attrs.keys()}
+        flag_block_fix = chunk_info.get("block_fix_applied", False)
+        logging.info(" ---> Resume download from " + str(len(chunk_done)) + " completed chunk(s)")
+    else:
+        chunk_done = set()
+        var_valid = {var_name: False for var_name in out_attrs.keys()}
+        flag_block_fix = False
+        create_data_ancillary(ancillary_file, out_attrs, time_run, time_span,
+                              lat_values[lat_idx], np.asarray(geo_interval_lon, dtype=float))
+
+    time_starts = list(range(time_span[0], time_span[1], time_block))
+    chunk_list = [(var_name, time_start, min(time_start + time_block, time_span[1]))
+                  for var_name in var_list for time_start in time_starts
+                  if (var_name, time_start) not in chunk_done]
+    logging.info(" ---> Download " + str(len(chunk_list)) + " chunk(s) with " + str(process_n) + " thread(s)...")
+
+    # First and last cumulated map of each precipitation block (to decumulate across blocks at the end)
+    chunk_bounds = {}
+    # Wind component(s) waiting for the other component of the same block
+    chunk_wind = {}
+
+    with ThreadPoolExecutor(max_workers=process_n) as thread_pool, \
+            netCDF4.Dataset(ancillary_file, "a") as file_handle:
+        chunk_futures = {thread_pool.submit(request_data_opendap, url, var_name, (time_start, time_end),
+                                            lat_slice, lon_slices,
+                                            retry_n=retry_n, limit=limit, limiter_file=limiter_file):
+                         (var_name, time_start, time_end) for var_name, time_start, time_end in chunk_list}
+        try:
+            # Chunks are converted and written by the main thread only, as soon as each of them is completed
+            for chunk_future in as_completed(chunk_futures):
+                var_name, time_start, time_end = chunk_futures[chunk_future]
+                var_values = chunk_future.result()
+                time_idx = slice(time_start - time_span[0], time_end - time_span[0])
+
+                if var_name == "apcpsfc" and flag_decumulate:
+                    chunk_bounds[time_start] = (var_values[0].copy(), var_values[-1].copy())
+                    var_values = np.concatenate([var_values[:1], np.diff(var_values, n=1, axis=0)], axis=0)
+                if var_name == "tmp2m" and flag_temperature:
+                    var_values = var_values - 273.15
+
+                out_name = var_names.get(var_name, var_name)
+                file_handle[out_name][time_idx, :, :] = var_values
+                var_valid[out_name] = var_valid[out_name] or bool(np.isfinite(var_values).any())
+
+                if var_name in ["ugrd10m", "vgrd10m"] and flag_wind:
+                    var_pair = "vgrd10m" if var_name == "ugrd10m" else "ugrd10m"
+                    if (var_pair, time_start) in chunk_wind:
+                        pair_values = chunk_wind.pop((var_pair, time_start))
+                    elif (var_pair, time_start) in chunk_done:
+                        pair_values = file_handle[var_names.get(var_pair, var_pair)][time_idx, :, :].filled(np.nan)
+                    else:
+                        pair_values = None
+                        chunk_wind[(var_name, time_start)] = var_values
+                    if pair_values is not None:
+                        wind_values = np.sqrt(var_values ** 2 + pair_values ** 2)
+                        file_handle["10wind"][time_idx, :, :] = wind_values
+                        var_valid["10wind"] = var_valid["10wind"] or bool(np.isfinite(wind_values).any())
+
+                file_handle.sync()
+                chunk_done.add((var_name, time_start))
+                with open(chunk_file, "w") as chunk_handle:
+                    json.dump({"chunks": sorted(chunk_done),
+                               "valid": sorted([var_key for var_key, var_flag in var_valid.items() if var_flag])},
+                              chunk_handle)
+        except BaseException:
+            for chunk_future in chunk_futures:
+                chunk_future.cancel()
+            raise
+
+        # Decumulate precipitation across blocks (first map of a block minus last cumulated map of the previous one)
+        if flag_decumulate and len(time_starts) > 1:
+            logging.info(" ---> Decumulate precipitation...")
+            out_name = var_names.get("apcpsfc", "apcpsfc")
+            if flag_block_fix:
+                # Fix computed before a restart: the file may be already corrected, the saved maps are written again
+                with np.load(fix_file) as fix_handle:
+                    block_fix = {int(time_key): fix_handle[time_key] for time_key in fix_handle.files}
+            else:
+                block_fix = compute_block_fix(file_handle, out_name, time_starts, time_span, time_block, chunk_bounds)
+                # Saved and checkpointed before writing: on restart the fix is never subtracted a second time
+                with open(fix_file + ".part", "wb") as fix_handle:
+                    np.savez(fix_handle, **{str(time_key): fix_values for time_key, fix_values in block_fix.items()})
+                os.replace(fix_file + ".part", fix_file)
+                with open(chunk_file, "w") as chunk_handle:
+                    json.dump({"chunks": sorted(chunk_done),
+                               "valid": sorted([var_key for var_key, var_flag in var_valid.items() if var_flag]),
+                               "block_fix_applied": True}, chunk_handle)
+            for time_start, block_values in block_fix.items():
+                file_handle[out_name][time_start - time_span[0], :, :] = block_values
+            file_handle.sync()
+            logging.info(" ---> Decumulate precipitation...DONE!")
+
+    os.remove(chunk_file)
+    if os.path.exists(fix_file):
+        os.remove(fix_file)
+    logging.info(" ---> Download " + str(len(chunk_list)) + " chunk(s) with " + str(process_n) + " thread(s)...DONE")
+
+    return var_valid
+# -------------------------------------------------------------------------------------
+
+# -------------------------------------------------------------------------------------
+# Method to compute the first map of each precipitation block (first cumulated map of the block minus the last
+# cumulated map of the previous block); blocks written before a restart are recovered from the product file
+def compute_block_fix(file_handle, out_name, time_starts, time_span, time_block, chunk_bounds):
+
+    block_fix = {}
+    for time_prev, time_start in zip(time_starts[:-1], time_starts[1:]):
+        # Blocks written before a restart are recovered from the file (first map cumulated, others diffs)
+        if time_start not in chunk_bounds:
+            block_values = file_handle[out_name][time_start - time_span[0]:
+                                                 min(time_start + time_block, time_span[1]) - time_span[0],
+                                                 :, :].filled(np.nan)
+            chunk_bounds[time_start] = (block_values[0], block_values.sum(axis=0))
+        if time_prev not in chunk_bounds:
+            block_values = file_handle[out_name][time_prev - time_span[0]:time_start - time_span[0],
+                                                 :, :].filled(np.nan)
+            chunk_bounds[time_prev] = (block_values[0], block_values.sum(axis=0))
+        block_fix[time_start] = chunk_bounds[time_start][0] - chunk_bounds[time_prev][1]
+
+    return block_fix
+# -------------------------------------------------------------------------------------
+
+# -------------------------------------------------------------------------------------
+# Method to create the product file with the subset coordinates and empty variable(s)
+def create_data_ancillary(ancillary_file, var_attrs, time_run, time_span, lat_values, lon_values):
+
+    with netCDF4.Dataset(ancillary_file, "w") as file_handle:
+        file_handle.createDimension("time", time_span[1] - time_span[0])
+        file_handle.createDimension("lat", lat_values.shape[0])
+        file_handle.createDimension("lon", lon_values.shape[0])
+
+        time_var = file_handle.createVariable("time", "f8", ("time",))
+        time_var.units = "hours since " + time_run.strftime("%Y-%m-%d %H:%M:%S")
+        time_var[:] = np.arange(time_span[0], time_span[1])
+        lat_var = file_handle.createVariable("lat", "f8", ("lat",))
+        lat_var[:] = lat_values
+        lon_var = file_handle.createVariable("lon", "f8", ("lon",))
+        lon_var.setncatts({"grads_dim": 'x', "grads_mapping": 'linear', "grads_size": str(lon_values.shape[0]),
+                           "units": 'degrees_east', "long_name": 'longitude', "minimum": -180, "maximum": 180,
+                           "resolution": 0.25})
+        lon_var[:] = lon_values
+
+        for var_name, var_attr in var_attrs.items():
+            var_obj = file_handle.createVariable(var_name, "f4", ("time", "lat", "lon"), fill_value=np.nan,
+                                                 chunksizes=(1, lat_values.shape[0], lon_values.shape[0]))
+            var_obj.setncatts({attr_key: attr_value for attr_key, attr_value in var_attr.items()
+                               if attr_key not in ["_FillValue", "missing_value"]})
+# -------------------------------------------------------------------------------------
+
+# -------------------------------------------------------------------------------------
+# Method to request a hyperslab (one OPeNDAP handle reused by each thread and reopened after a failure)
+def request_data_opendap(url, var_name, time_slice, lat_slice, lon_slices, retry_n=3, limit=120, limiter_file=None):
+
+    for retry_id in range(retry_n):
+        try:
+            if getattr(thread_data, "ds", None) is None:
+                time.sleep(reserve_server_token(url, limit=limit, limiter_file=limiter_file))
+                thread_data.ds = xr.open_dataset(url, engine="pydap")
+
+            var_values = []
+            for lon_slice in lon_slices:
+                time.sleep(reserve_server_token(url, limit=limit, limiter_file=limiter_file))
+                var_values.append(thread_data.ds[var_name].isel(
+                    time=slice(*time_slice), lat=lat_slice, lon=lon_slice).values)
+            return np.concatenate(var_values, axis=2).astype(np.float32)
+
+        except Exception as exc:
+            logging.warning(" ---> WARNING! Chunk " + var_name + " " + str(time_slice) + " failed (" + str(exc) +
+                            "). Retry " + str(retry_id + 1) + "/" + str(retry_n))
+            thread_data.ds = None
+            time.sleep(min(10 * 2 ** retry_id, 120))
+
+    logging.error(" ERROR! Chunk " + var_name + " " + str(time_slice) + " not downloaded after " +
+                  str(retry_n) + " retries!")
+    raise IOError("Chunk " + var_name + " " + str(time_slice) + " not downloaded")
+# -------------------------------------------------------------------------------------
+
+# -------------------------------------------------------------------------------------
+# Method to reserve a token of the remote server bucket (shared by all processes through a sqlite file)
+def reserve_server_token(src_url, limit=9999, limiter_file=None, limiter_burst=1):
+
+    if limiter_file is None:
+        limiter_file = os.path.join(tempfile.gettempdir(), 'door_server_limiter.db')
+
+    src_host = urlparse(src_url).netloc
+    token_rate = limit / 60.0
+
+    # Tokens may go negative: the deficit is the time to wait before using the reserved token
+    with closing(sqlite3.connect(limiter_file, timeout=60, isolation_level=None)) as limiter_db:
+        limiter_db.execute('CREATE TABLE IF NOT EXISTS bucket (host TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+        limiter_db.execute('BEGIN IMMEDIATE')
+        bucket_row = limiter_db.execute('SELECT tokens, updated FROM bucket WHERE host = ?', (src_host,)).fetchone()
+
+        time_now = time.time()
+        if bucket_row is None:
+            bucket_tokens = limiter_burst
+        else:
+            bucket_tokens = min(limiter_burst, bucket_row[0] + (time_now - bucket_row[1]) * token_rate)
+        bucket_tokens -= 1
+
+        limiter_db.execute('INSERT OR REPLACE INTO bucket (host, tokens, updated) VALUES (?, ?, ?)',
+                           (src_host, bucket_tokens, time_now))
+        limiter_db.execute('COMMIT')
+
+    return max(0.0, -bucket_tokens / token_rate)
+# -------------------------------------------------------------------------------------
+
 # -------------------------------------------------------------------------------------
 # Method to read file json
 def read_file_json(file_name):
@@ -0,0 +1,1371 @@
+"""
+Tests of the helper(s) of the downloaders (crop indexes, byte ranges, grib check, domain remapping,
+directory listing, ensemble statistics and http engines) on synthetic data: remote servers are replaced by
+local http server(s), no network access is needed.
+
+General command line:
+python3 -m pytest tests
+"""
+# -------------------------------------------------------------------------------------
+
+# -------------------------------------------------------------------------------------
+# Complete library
+import bz2
+import importlib.util
+import http.server
+import json
+import os
+import re
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+xr = pytest.importorskip('xarray')
+eccodes = pytest.importorskip('eccodes')
+
+# Path of the repository
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Method to load a downloader script as a module (skipped if one of its dependencies is missing)
+def load_script(script_path, script_deps=()):
+    for script_dep in script_deps:
+        pytest.importorskip(script_dep)
+    script_spec = importlib.util.spec_from_file_location(
+        os.path.splitext(os.path.basename(script_path))[0].replace('-', '_'), os.path.join(repo_path, script_path))
+    script_module = importlib.util.module_from_spec(script_spec)
+    # Registered module: functions sent to the process pool(s) must be importable by name
+    sys.modules[script_spec.name] = script_module
+    script_spec.loader.exec_module(script_module)
+    return script_module
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Method to start a local http server (requests are logged and answered by the "source_handler" of the test)
+@pytest.fixture
+def http_server():
+
+    request_log = []
+
+    class SourceHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            request_log.append({'path': self.path, 'headers': dict(self.headers)})
+            self.server.source_handler(self)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), SourceHandler)
+    server.daemon_threads = True
+    server.request_log = request_log
+    server.url = 'http://127.0.0.1:' + str(server.server_port)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+# Method to send a response (the body is cut at "body_drop" bytes and the connection is closed after "body_wait" s)
+def send_data(handler, data, status=200, headers=None, body_drop=None, body_wait=0):
+    handler.send_response(status)
+    for header_key, header_value in (headers or {}).items():
+        handler.send_header(header_key, header_value)
+    handler.send_header('Content-Length', str(len(data)))
+    handler.end_headers()
+    if body_drop is None:
+        handler.wfile.write(data)
+        return len(data)
+    handler.wfile.write(data[:body_drop])
+    time.sleep(body_wait)
+    handler.close_connection = True
+    handler.connection.shutdown(socket.SHUT_RDWR)
+    return body_drop
+
+
+# Method to send a file honouring the "Range: bytes=start-[end]" header (as an apache or nginx server)
+def send_range(handler, data):
+    data_range = re.match(r'bytes=(\d+)-(\d*)$', handler.headers.get('Range', ''))
+    if data_range is None:
+        return send_data(handler, data)
+    range_start = int(data_range.group(1))
+    range_end = min(int(data_range.group(2) or len(data) - 1), len(data) - 1)
+    if range_start >= len(data):
+        return send_data(handler, b'', status=416, headers={'Content-Range': 'bytes */' + str(len(data))})
+    return send_data(handler, data[range_start:range_end + 1], status=206, headers={
+        'Content-Range': 'bytes ' + str(range_start) + '-' + str(range_end) + '/' + str(len(data))})
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Method to write a synthetic regular lat/lon grib2 file (one message for each step, "grib_keys" set on each message)
+def write_grib(file_path, lat_first, lat_last, lon_first, lon_last, lat_n, lon_n, values_list, grib_keys=None):
+    with open(file_path, 'wb') as file_handle:
+        for step_id, values in enumerate(values_list):
+            grib_id = eccodes.codes_grib_new_from_samples('regular_ll_sfc_grib2')
+            eccodes.codes_set(grib_id, 'Ni', lon_n)
+            eccodes.codes_set(grib_id, 'Nj', lat_n)
+            eccodes.codes_set(grib_id, 'latitudeOfFirstGridPointInDegrees', lat_first)
+            eccodes.codes_set(grib_id, 'latitudeOfLastGridPointInDegrees', lat_last)
+            eccodes.codes_set(grib_id, 'longitudeOfFirstGridPointInDegrees', lon_first)
+            eccodes.codes_set(grib_id, 'longitudeOfLastGridPointInDegrees', lon_last)
+            eccodes.codes_set(grib_id, 'iDirectionIncrementInDegrees', abs(lon_last - lon_first) / (lon_n - 1))
+            eccodes.codes_set(grib_id, 'jDirectionIncrementInDegrees', abs(lat_last - lat_first) / (lat_n - 1))
+            eccodes.codes_set(grib_id, 'endStep', 3 * (step_id + 1))
+            for grib_key, grib_value in (grib_keys or {}).items():
+                eccodes.codes_set(grib_id, grib_key, grib_value)
+            eccodes.codes_set(grib_id, 'bitsPerValue', 24)
+            eccodes.codes_set_values(grib_id, values.ravel())
+            eccodes.codes_write(grib_id, file_handle)
+            eccodes.codes_release(grib_id)
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Test of the crop indexes of ecmwf open data against the previous xarray crop (where with drop)
+@pytest.mark.parametrize('data_bbox', [
+    {'lon_left': -20, 'lon_right': 55, 'lat_top': 40, 'lat_bottom': -40},
+    {'lon_left': 10.1, 'lon_right': 12.4, 'lat_top': 46.3, 'lat_bottom': 44.05},
+    {'lon_left': -180, 'lon_right': 180, 'lat_top': 90, 'lat_bottom': -90}])
+def test_ecmwf_crop_index(tmp_path, data_bbox):
+
+    module = load_script('ecmwf/door_downloader_ecmwf_opendata_single_hires.py', ['ecmwf.opendata'])
+
+    lat_n, lon_n = 721, 1440
+    values = np.random.default_rng(1).normal(size=(lat_n, lon_n))
+    file_path = str(tmp_path / 'ecmwf.grib2')
+    write_grib(file_path, 90, -90, -180, 179.75, lat_n, lon_n, [values])
+
+    with open(file_path, 'rb') as file_handle:
+        grib_id = eccodes.codes_grib_new_from_file(file_handle)
+    grid_lat, grid_lon, grid_shape, grid_idx = module.set_grid_grib(grib_id, data_bbox)
+    values_grib = eccodes.codes_get_values(grib_id)
+    eccodes.codes_release(grib_id)
+    values_crop = values_grib.reshape(grid_shape)[grid_idx['lat'], :][:, grid_idx['lon']]
+
+    da_global = xr.DataArray(values_grib.reshape(lat_n, lon_n), dims=['latitude', 'longitude'],
+                             coords={'latitude': np.linspace(90, -90, lat_n),
+                                     'longitude': np.linspace(-180, 179.75, lon_n)})
+    da_crop = da_global.where((da_global.latitude <= data_bbox['lat_top']) &
+                              (da_global.latitude >= data_bbox['lat_bottom']) &
+                              (da_global.longitude >= data_bbox['lon_left']) &
+                              (da_global.longitude <= data_bbox['lon_right']), drop=True)
+
+    np.testing.assert_allclose(grid_lat, da_crop.latitude.values)
+    np.testing.assert_allclose(grid_lon, da_crop.longitude.values)
+    np.testing.assert_array_equal(values_crop, da_crop.values)
+
+
+def test_ecmwf_crop_index_slice():
+
+    module = load_script('ecmwf/door_downloader_ecmwf_opendata_single_hires.py', ['ecmwf.opendata'])
+
+    assert module.set_crop_index(np.array([False, True, True, True, False])) == slice(1, 4)
+    np.testing.assert_array_equal(module.set_crop_index(np.array([True, False, True])), [0, 2])
+    with pytest.raises(ValueError):
+        module.set_crop_index(np.zeros(4, dtype=bool))
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Test of the per-step retrieval through the index files (byte ranges of the needed parameters, merged if adjacent,
+# retry if the server ignores the range header) against the decoding of the whole files
+def test_ecmwf_retrieve_data_index(tmp_path, monkeypatch, http_server):
+
+    module = load_script('ecmwf/door_downloader_ecmwf_opendata_single_hires.py', ['ecmwf.opendata'])
+    sleep_log = []
+    monkeypatch.setattr(module, 'time', type('time', (), {'sleep': staticmethod(sleep_log.append)}))
+
+    rng = np.random.default_rng(7)
+    lat_n, lon_n = 19, 36
+    time_run = pd.Timestamp('2026-10-17 00:00')
+    time_steps, var_list = [3, 6], ['2t', '10u', 'sp']
+
+    # Step files (2t and 10u are contiguous, 10v and msl are not requested) and json lines index files
+    src_files, src_ranges = {}, {}
+    for time_step in time_steps:
+        step_data, step_index = b'', []
+        for var_name in ['2t', '10u', '10v', 'sp', 'msl']:
+            var_path = str(tmp_path / (var_name + '.grib2'))
+            write_grib(var_path, 90, -90, -180, 170, lat_n, lon_n, [rng.normal(size=(lat_n, lon_n))],
+                       grib_keys={'shortName': var_name, 'endStep': time_step})
+            var_data = open(var_path, 'rb').read()
+            step_index.append(json.dumps({'param': var_name, 'step': str(time_step),
+                                          '_offset': len(step_data), '_length': len(var_data)}))
+            step_data += var_data
+        step_url = '/20261017/00z/ifs/0p25/oper/20261017000000-' + str(time_step) + 'h-oper-fc'
+        src_files[step_url + '.grib2'] = step_data
+        src_files[step_url + '.index'] = '\n'.join(step_index).encode()
+        step_offsets = [json.loads(step_row)['_offset'] for step_row in step_index] + [len(step_data)]
+        src_ranges[step_url + '.grib2'] = ['bytes=' + str(step_offsets[0]) + '-' + str(step_offsets[2] - 1),
+                                           'bytes=' + str(step_offsets[3]) + '-' + str(step_offsets[4] - 1)]
+
+    # First range request of the 6h step is answered with the whole file (range header ignored)
+    range_ignored = []
+
+    def source_handler(handler):
+        src_data = src_files[handler.path]
+        if handler.path.endswith('6h-oper-fc.grib2') and not range_ignored:
+            range_ignored.append(handler.headers.get('Range'))
+            send_data(handler, src_data)
+        elif handler.path.endswith('.grib2'):
+            send_range(handler, src_data)
+        else:
+            send_data(handler, src_data)
+    http_server.source_handler = source_handler
+
+    time_range = pd.date_range(time_run + pd.Timedelta('3h'), periods=2, freq='3h')
+    data_bbox = {'lon_left': -20, 'lon_right': 55, 'lat_top': 40, 'lat_bottom': -40}
+    dset_index, ancillary_list = module.retrieve_data_index(
+        time_run, 'ifs', time_range, var_list, str(tmp_path), 'ecmwf.grib2', data_bbox=data_bbox,
+        url_root=http_server.url, process_n=2)
+
+    # Only the byte ranges of the needed parameters are requested (the ignored range is retried)
+    for step_url in [step_url for step_url in src_files if step_url.endswith('.grib2')]:
+        step_range = [request['headers'].get('Range') for request in http_server.request_log
+                      if request['path'] == step_url]
+        if step_url.endswith('6h-oper-fc.grib2'):
+            assert step_range == src_ranges[step_url][:1] + src_ranges[step_url]
+        else:
+            assert step_range == src_ranges[step_url]
+    assert range_ignored and len(sleep_log) == 1
+    assert sorted(ancillary_list) == [str(tmp_path / 'ecmwf_003.grib2'), str(tmp_path / 'ecmwf_006.grib2')]
+    assert not [file_name for file_name in os.listdir(str(tmp_path)) if file_name.endswith('.part')]
+
+    # Decoded cube is the same of the decoding of the whole step files
+    full_path = str(tmp_path / 'ecmwf_full.grib2')
+    with open(full_path, 'wb') as file_handle:
+        for step_url in sorted(src_files):
+            if step_url.endswith('.grib2'):
+                file_handle.write(src_files[step_url])
+    dset_full = module.read_data_grib(full_path, time_run, time_range, data_bbox=data_bbox)
+
+    assert sorted(dset_index.data_vars) == ['sp', 't2m', 'u10']
+    for var_name in dset_index.data_vars:
+        xr.testing.assert_identical(dset_index[var_name], dset_full[var_name])
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Test of the byte ranges selected from a wgrib2 index (contiguous messages merged, last message open-ended)
+def test_gfs_select_idx_ranges():
+
+    module = load_script('gfs/door_downloader_nwp_gfs_nomads.py', ['cdo'])
+
+    idx_text = '\n'.join(['1:0:d=2026101700:PRMSL:mean sea level:anl:',
+                          '2:100:d=2026101700:TMP:2 m above ground:anl:',
+                          '3:250:d=2026101700:UGRD:10 m above ground:anl:',
+                          '4:400:d=2026101700:VGRD:10 m above ground:anl:',
+                          '5:520:d=2026101700:APCP:surface:0-3 hour acc fcst:'])
+
+    assert module.select_idx_ranges(idx_text, ['TMP:2 m above ground']) == [(100, 249)]
+    assert module.select_idx_ranges(
+        idx_text, ['UGRD:10 m above ground', 'VGRD:10 m above ground']) == [(250, 519)]
+    assert module.select_idx_ranges(
+        idx_text, ['TMP:2 m above ground', 'APCP:surface']) == [(100, 249), (520, None)]
+    assert module.select_idx_ranges(idx_text, ['RH:2 m above ground']) == []
+
+
+# Test of the server-side subregion (plain, greenwich crossing, antimeridian crossing and near-global domains)
+@pytest.mark.parametrize('script_path', ['gfs/door_downloader_nwp_gfs_nomads.py',
+                                         'gefs/door_downloader_nwp_gefs_nomads.py'])
+@pytest.mark.parametrize('geo_def, url_lon', [
+    ({'lon_left': 5, 'lon_right': 20, 'lat_bottom': 35, 'lat_top': 48}, (4, 21)),
+    ({'lon_left': -10, 'lon_right': 30, 'lat_bottom': 35, 'lat_top': 48}, (349, 31)),
+    ({'lon_left': 170, 'lon_right': -170, 'lat_bottom': -20, 'lat_top': 10}, (169, 191)),
+    ({'lon_left': -179.5, 'lon_right': 179.5, 'lat_bottom': -89.5, 'lat_top': 89.5}, (0, 360))])
+def test_nomads_set_url_bbox(script_path, geo_def, url_lon):
+
+    module = load_script(script_path, ['cdo'])
+
+    url_bbox = dict(url_arg.split('=') for url_arg in module.set_url_bbox(geo_def, bbox_margin=1.0).split('&')[2:])
+    assert sorted(url_bbox) == ['bottomlat', 'leftlon', 'rightlon', 'toplat']
+    assert (float(url_bbox['leftlon']), float(url_bbox['rightlon'])) == url_lon
+    for url_key in ['leftlon', 'rightlon']:
+        assert 0 <= float(url_bbox[url_key]) <= 360
+    assert float(url_bbox['bottomlat']) == max(-90, geo_def['lat_bottom'] - 1)
+    assert float(url_bbox['toplat']) == min(90, geo_def['lat_top'] + 1)
+
+
+# Test of the structural grib check (complete, truncated and not grib files)
+def test_gfs_check_data_grib(tmp_path):
+
+    module = load_script('gfs/door_downloader_nwp_gfs_nomads.py', ['cdo'])
+
+    file_path = str(tmp_path / 'gfs.grib2')
+    write_grib(file_path, 60, -60, 0, 30, 25, 31, [np.ones((25, 31)), np.zeros((25, 31))])
+    assert module.check_data_grib(file_path)
+    assert module.check_data_grib(file_path, messages_min=2)
+    assert not module.check_data_grib(file_path, messages_min=3)
+
+    with open(file_path, 'rb') as file_handle:
+        file_data = file_handle.read()
+    with open(file_path, 'wb') as file_handle:
+        file_handle.write(file_data[:-10])
+    assert not module.check_data_grib(file_path)
+
+    with open(file_path, 'wb') as file_handle:
+        file_handle.write(b'<html>404 Not Found</html>')
+    assert not module.check_data_grib(file_path)
+    assert not module.check_data_grib(str(tmp_path / 'missing.grib2'))
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Method to record the rename(s) of the partial file(s) (size of the partial file when it is renamed)
+def record_replace(monkeypatch, module):
+    replace_log = []
+    os_replace = os.replace
+
+    def replace_file(src_path, dst_path):
+        replace_log.append((src_path, dst_path, os.path.getsize(src_path)))
+        os_replace(src_path, dst_path)
+
+    monkeypatch.setattr(module.os, 'replace', replace_file)
+    return replace_log
+
+
+# Test of the resume of a download interrupted in the middle of the body (range request from the partial size)
+@pytest.mark.parametrize('script_path', ['gfs/door_downloader_nwp_gfs_nomads.py',
+                                         'gefs/door_downloader_nwp_gefs_nomads.py'])
+def test_nomads_stream_resume(tmp_path, monkeypatch, http_server, script_path):
+
+    module = load_script(script_path, ['cdo'])
+    replace_log = record_replace(monkeypatch, module)
+
+    src_data = np.random.default_rng(5).bytes(300000)
+    dst_path = str(tmp_path / 'gfs.grib2')
+    body_log, part_log = [], []
+
+    def source_handler(handler):
+        # Final file is never visible while the download is running
+        assert not os.path.exists(dst_path)
+        if not body_log:
+            body_log.append(send_data(handler, src_data, body_drop=120000))
+        else:
+            part_log.append(os.path.getsize(dst_path + '.part'))
+            body_log.append(send_range(handler, src_data))
+    http_server.source_handler = source_handler
+
+    module.stream_data_source(http_server.url + '/gfs.grib2', dst_path, timeout=10, chunk_size=16384,
+                              limiter_file=str(tmp_path / 'limiter.db'))
+
+    # Resume from the bytes written to the partial file: written bytes are never requested again
+    assert 120000 - 16384 <= part_log[0] <= 120000
+    assert [request['headers'].get('Range') for request in http_server.request_log] == [None, 'bytes=' + str(part_log[0]) + '-']
+    assert body_log[1] == len(src_data) - part_log[0]
+    assert open(dst_path, 'rb').read() == src_data
+    assert replace_log == [(dst_path + '.part', dst_path, len(src_data))]
+
+
+# Test of the resume of the asyncio engine (two steps on one session, the first interrupted in the middle of the body)
+@pytest.mark.parametrize('script_path', ['gfs/door_downloader_nwp_gfs_nomads.py',
+                                         'gefs/door_downloader_nwp_gefs_nomads.py'])
+def test_nomads_stream_resume_async(tmp_path, monkeypatch, http_server, script_path):
+
+    pytest.importorskip('aiohttp')
+    module = load_script(script_path, ['cdo'])
+    replace_log = record_replace(monkeypatch, module)
+
+    rng = np.random.default_rng(14)
+    src_files = {'/gfs.t00z.pgrb2.0p25.f003': rng.bytes(300000), '/gfs.t00z.pgrb2.0p25.f006': rng.bytes(200000)}
+    body_log, part_log = {}, []
+
+    def source_handler(handler):
+        src_data = src_files[handler.path]
+        if handler.path.endswith('f003') and handler.path not in body_log:
+            body_log[handler.path] = [send_data(handler, src_data, body_drop=120000, body_wait=0.5)]
+            return
+        if handler.headers.get('Range') is not None:
+            part_log.append(os.path.getsize(str(tmp_path / (handler.path[1:] + '.part'))))
+        body_log.setdefault(handler.path, []).append(send_range(handler, src_data))
+    http_server.source_handler = source_handler
+
+    data_list = [[http_server.url + src_path, str(tmp_path / src_path[1:])] for src_path in sorted(src_files)]
+    module.asyncio.run(module.request_data_source_async(data_list, process_n=2, chunk_size=16384,
+                                                        limiter_file=str(tmp_path / 'limiter.db')))
+
+    # Interrupted step resumed from the bytes written to its partial file, the other one downloaded once
+    step_range = [request['headers'].get('Range') for request in http_server.request_log
+                  if request['path'].endswith('f003')]
+    assert len(part_log) == 1 and 0 < part_log[0] <= 120000
+    assert step_range == [None, 'bytes=' + str(part_log[0]) + '-']
+    assert body_log['/gfs.t00z.pgrb2.0p25.f003'][1] == 300000 - part_log[0]
+    assert body_log['/gfs.t00z.pgrb2.0p25.f006'] == [200000]
+    for src_path, src_data in src_files.items():
+        assert open(str(tmp_path / src_path[1:]), 'rb').read() == src_data
+    assert sorted(replace_log) == sorted((dst_path + '.part', dst_path, len(src_files['/' + os.path.basename(dst_path)]))
+                                         for _, dst_path in data_list)
+
+
+# Test of the 416 answer (partial file already complete or not matching the remote size)
+@pytest.mark.parametrize('script_path', ['gfs/door_downloader_nwp_gfs_nomads.py',
+                                         'gefs/door_downloader_nwp_gefs_nomads.py'])
+@pytest.mark.parametrize('part_size', [300000, 310000])
+def test_nomads_stream_range_not_satisfiable(tmp_path, monkeypatch, http_server, script_path, part_size):
+
+    module = load_script(script_path, ['cdo'])
+    replace_log = record_replace(monkeypatch, module)
+
+    src_data = np.random.default_rng(6).bytes(300000)
+    dst_path = str(tmp_path / 'gfs.grib2')
+    with open(dst_path + '.part', 'wb') as file_handle:
+        file_handle.write((src_data + b'\x00' * 10000)[:part_size])
+    http_server.source_handler = lambda handler: send_range(handler, src_data)
+
+    module.stream_data_source(http_server.url + '/gfs.grib2', dst_path, timeout=10,
+                              limiter_file=str(tmp_path / 'limiter.db'))
+
+    request_range = [request['headers'].get('Range') for request in http_server.request_log]
+    if part_size == len(src_data):
+        assert request_range == ['bytes=300000-']
+    else:
+        # Partial file longer than the remote file is removed and the download restarts from scratch
+        assert request_range == ['bytes=310000-', None]
+    assert open(dst_path, 'rb').read() == src_data
+    assert replace_log == [(dst_path + '.part', dst_path, len(src_data))]
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Test of the progressive mode (step not yet published polled with backoff, partial product dumped at its lead time)
+def test_nomads_retrieve_data_source_progressive(tmp_path, monkeypatch, http_server):
+
+    module = load_script('gfs/door_downloader_nwp_gfs_nomads.py', ['cdo'])
+    sleep_log = []
+    monkeypatch.setattr(module, 'time', type('time', (), {'sleep': staticmethod(sleep_log.append),
+                                                          'time': staticmethod(time.time)}))
+
+    rng = np.random.default_rng(15)
+    src_files, src_values = {}, {}
+    for step_id in [3, 6, 9, 12]:
+        src_path = str(tmp_path / ('gfs.f' + str(step_id).zfill(3)))
+        src_values[step_id] = rng.normal(size=(25, 31))
+        write_grib(src_path, 60, -60, 0, 30, 25, 31, [src_values[step_id]],
+                   grib_keys={'shortName': '2t', 'endStep': step_id})
+        src_files['/gfs.t00z.pgrb2.0p25.f' + str(step_id).zfill(3)] = open(src_path, 'rb').read()
+
+    dst_domain = str(tmp_path / 'outcome' / 'gfs_domain.nc')
+    dst_partial = str(tmp_path / 'outcome' / 'gfs_domain_partial_6h.nc')
+    os.makedirs(os.path.dirname(dst_domain))
+    step_missing, partial_log = [], []
+
+    # Step 6h is published at the third request; the partial product of 6h is checked when the 9h step is requested
+    def source_handler(handler):
+        if handler.path.endswith('f006') and len(step_missing) < 2:
+            step_missing.append(handler.path)
+            send_data(handler, b'Not Found', status=404)
+            return
+        if handler.path.endswith('f009') and not partial_log:
+            with xr.open_dataset(dst_partial) as dset_partial:
+                partial_log.append(dset_partial['2t'].shape)
+        send_data(handler, src_files[handler.path])
+    http_server.source_handler = source_handler
+
+    time_run = pd.Timestamp('2026-10-17 00:00')
+    src_data = {'sfc': [http_server.url + src_path for src_path in sorted(src_files)]}
+    dst_data = {'sfc': [str(tmp_path / 'ancillary' / src_path[1:]) for src_path in sorted(src_files)]}
+    data_bbox = {'lon_left': 5, 'lon_right': 20, 'lat_bottom': -30, 'lat_top': 30}
+    module.retrieve_data_source_progressive(
+        src_data, dst_data, {'sfc': None}, {'sfc': dst_domain}, time_run,
+        pd.date_range(time_run + pd.Timedelta('3h'), periods=4, freq='3h'), data_bbox=data_bbox,
+        limiter_file=str(tmp_path / 'limiter.db'), partial_hours=[6], poll_min=30, poll_max=600)
+
+    # Two polls of the step not published (backoff), partial product of 6h with two steps removed at the end
+    assert [sleep_wait for sleep_wait in sleep_log if sleep_wait >= 1] == [30, 60]
+    assert [request['path'] for request in http_server.request_log].count('/gfs.t00z.pgrb2.0p25.f006') == 3
+    assert partial_log == [(2, 13, 16)]
+    assert sorted(os.listdir(os.path.dirname(dst_domain))) == ['gfs_domain.nc']
+    with xr.open_dataset(dst_domain) as dset_domain:
+        assert dset_domain['2t'].shape == (4, 13, 16)
+        for step_pos, step_id in enumerate([3, 6, 9, 12]):
+            np.testing.assert_allclose(dset_domain['2t'].values[step_pos], src_values[step_id][6:19, 5:21],
+                                       rtol=1e-5, atol=1e-5)
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Test of the backfill mode (download of a run overlaps the arranging of the previous run, bounded by runs_max)
+def test_nomads_process_run_backfill(tmp_path, monkeypatch):
+
+    module = load_script('gfs/door_downloader_nwp_gfs_nomads.py', ['cdo'])
+    event_file = str(tmp_path / 'event.log')
+
+    # Events are logged to a file: the arranging is done in the processes of the pool
+    def log_event(event_name, time_run):
+        with open(event_file, 'a') as event_handle:
+            event_handle.write(' '.join([event_name, time_run.strftime('%H'), repr(time.time())]) + '\n')
+
+    def set_run_data(time_run, data_settings):
+        return {'time_run': time_run, 'time_data_range': [time_run], 'data_ancillary': {'sfc': [str(time_run)]},
+                'data_outcome_global': {'sfc': [None]}, 'data_outcome_domain': {'sfc': [None]}}
+
+    def retrieve_run_data(run_ws, data_settings):
+        log_event('download', run_ws['time_run'])
+        time.sleep(0.1)
+
+    def arrange_data_outcome_grib(data_ancillary, data_outcome_global, data_outcome_domain, **kwargs):
+        time_run = pd.Timestamp(data_ancillary['sfc'][0])
+        log_event('arrange_start', time_run)
+        time.sleep(1.0)
+        log_event('arrange_end', time_run)
+
+    monkeypatch.setattr(module, 'set_run_data', set_run_data)
+    monkeypatch.setattr(module, 'retrieve_run_data', retrieve_run_data)
+    monkeypatch.setattr(module, 'arrange_data_outcome_grib', arrange_data_outcome_grib)
+
+    data_settings = {'algorithm': {'flags': {'cleaning_dynamic_data_tmp': False}},
+                     'data': {'static': {'bounding_box': {}}, 'dynamic': {'source': {'vars_standards': {}}}}}
+    module.process_run_backfill(pd.date_range('2026-10-17 00:00', periods=3, freq='6h'), data_settings, runs_max=2)
+
+    with open(event_file) as event_handle:
+        event_lines = event_handle.read().split('\n')[:-1]
+    event_log = {tuple(event_line.split()[:2]): float(event_line.split()[2]) for event_line in event_lines}
+
+    # Every run is downloaded and arranged once
+    assert len(event_lines) == 9 and len(event_log) == 9
+    # Download of the second run overlaps the arranging of the first run
+    assert event_log[('download', '06')] < event_log[('arrange_end', '00')]
+    # Download of the third run waits for a free slot (two runs in the arranging step)
+    assert event_log[('download', '12')] >= event_log[('arrange_end', '00')]
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Script of a process reserving the tokens of a server (start on a line of stdin, print the reservation times)
+limiter_script = """
+import importlib.util, json, sys, time
+script_spec = importlib.util.spec_from_file_location('limiter_module', sys.argv[1])
+script_module = importlib.util.module_from_spec(script_spec)
+script_spec.loader.exec_module(script_module)
+print('ready', flush=True)
+sys.stdin.readline()
+token_times = []
+for token_id in range(int(sys.argv[4])):
+    token_wait = script_module.reserve_server_token(sys.argv[2], limit=int(sys.argv[3]), limiter_file=sys.argv[5])
+    token_times.append(time.time() + token_wait)
+    time.sleep(token_wait)
+print(json.dumps(token_times), flush=True)
+"""
+
+
+# Test of the token bucket shared by two processes (combined budget) and split by hostname
+@pytest.mark.parametrize('script_path', ['gfs/door_downloader_nwp_gfs_nomads.py',
+                                         'gefs/door_downloader_nwp_gefs_nomads.py',
+                                         'gfs/door_downloader_nwp_gfs_opendap.py'])
+def test_nomads_reserve_server_token(tmp_path, script_path):
+
+    module = load_script(script_path, ['cdo', 'netCDF4'])
+
+    limiter_file = str(tmp_path / 'limiter.db')
+    limit, token_n, token_tolerance = 600, 6, 0.02
+    token_rate = limit / 60.0
+
+    process_list = [subprocess.Popen(
+        [sys.executable, '-c', limiter_script, os.path.join(repo_path, script_path),
+         'https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_0p25.pl', str(limit), str(token_n), limiter_file],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True) for process_id in range(2)]
+    for process_obj in process_list:
+        assert process_obj.stdout.readline().strip() == 'ready'
+    for process_obj in process_list:
+        process_obj.stdin.write('start\n')
+        process_obj.stdin.flush()
+    token_times = []
+    for process_obj in process_list:
+        process_out, _ = process_obj.communicate(timeout=60)
+        assert process_obj.returncode == 0
+        token_times.extend(json.loads(process_out))
+
+    # In any window of the two processes: tokens <= burst (1) + window * rate
+    token_times = np.sort(token_times)
+    assert token_times.size == 2 * token_n
+    for token_i in range(token_times.size):
+        for token_j in range(token_i + 1, token_times.size):
+            assert token_times[token_j] - token_times[token_i] >= (token_j - token_i - 1) / token_rate - token_tolerance
+
+    # Bucket of another hostname is not drained by the requests to the first one
+    module.reserve_server_token('https://nomads.ncep.noaa.gov/', limit=limit, limiter_file=limiter_file)
+    assert module.reserve_server_token('https://nomads.ncep.noaa.gov/', limit=limit, limiter_file=limiter_file) > 0
+    assert module.reserve_server_token('https://thredds.ucar.edu/thredds/', limit=limit,
+                                       limiter_file=limiter_file) == 0
+    with sqlite3.connect(limiter_file) as limiter_db:
+        assert sorted(row[0] for row in limiter_db.execute('SELECT host FROM bucket')) == [
+            'nomads.ncep.noaa.gov', 'thredds.ucar.edu']
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Method to replace the OPeNDAP server with in-memory variable(s) (precipitation cumulated from the run start)
+def set_opendap_source(module, monkeypatch, chunk_failed=()):
+
+    rng = np.random.default_rng(13)
+    lat_values, lon_values = np.arange(30, 50.25, 0.25), np.arange(0, 20, 0.25)
+    src_hourly = rng.gamma(0.5, 2.0, size=(13, lat_values.size, lon_values.size)).astype(np.float32)
+    src_hourly[0] = 0
+    src_values = {'apcpsfc': np.cumsum(src_hourly, axis=0),
+                  'tmp2m': rng.normal(288, 5, size=(13, lat_values.size, lon_values.size)).astype(np.float32)}
+    request_log = []
+
+    def open_dataset(url, engine=None):
+        return xr.Dataset({var_name: xr.DataArray(0, attrs={'long_name': var_name}) for var_name in src_values},
+                          coords={'lat': lat_values, 'lon': lon_values})
+
+    def request_data_opendap(url, var_name, time_slice, lat_slice, lon_slices, **kwargs):
+        request_log.append((var_name, time_slice[0]))
+        if (var_name, time_slice[0]) in chunk_failed:
+            # Failed chunk is the slowest one (the other chunks are completed and checkpointed before)
+            time.sleep(0.5)
+            raise IOError('Chunk ' + var_name + ' ' + str(time_slice) + ' not downloaded')
+        return np.concatenate([src_values[var_name][slice(*time_slice), lat_slice, lon_slice]
+                               for lon_slice in lon_slices], axis=2)
+
+    monkeypatch.setattr(module, 'xr', type('xr', (), {'open_dataset': staticmethod(open_dataset)}))
+    monkeypatch.setattr(module, 'request_data_opendap', request_data_opendap)
+
+    lat_idx = np.where((lat_values >= 40) & (lat_values <= 42))[0]
+    lon_idx = np.where((lon_values >= 8) & (lon_values <= 10))[0]
+    data_expected = {'tp': src_hourly[1:][:, lat_idx][:, :, lon_idx],
+                     't2m': src_values['tmp2m'][1:][:, lat_idx][:, :, lon_idx] - 273.15}
+    return request_log, data_expected
+
+
+# Method to run the OPeNDAP retrieval of 12 hourly steps in blocks of 4 steps over a 2x2 degrees domain
+def run_opendap_source(module, ancillary_file):
+    lon_list = list(np.arange(8, 10.25, 0.25))
+    return module.retrieve_data_opendap(
+        'https://nomads.ncep.noaa.gov/dods/gfs_0p25_1hr/gfs20261017/gfs_0p25_1hr_00z', ['apcpsfc', 'tmp2m'], (1, 13),
+        (40, 42), lon_list, ancillary_file, pd.Timestamp('2026-10-17 00:00').to_pydatetime(), lon_list,
+        var_names={'apcpsfc': 'tp', 'tmp2m': 't2m'},
+        var_standards={'decumulate_precipitation': True, 'convert_temperature_to_C': True},
+        time_block=4, process_n=2, limit=9999, limiter_file=os.path.join(os.path.dirname(ancillary_file), 'limiter.db'))
+
+
+# Method to check the variable(s) of the OPeNDAP product file
+def check_opendap_source(ancillary_file, data_expected):
+    netCDF4 = pytest.importorskip('netCDF4')
+    with netCDF4.Dataset(ancillary_file) as file_handle:
+        for var_name, var_expected in data_expected.items():
+            np.testing.assert_allclose(file_handle[var_name][:].filled(np.nan), var_expected, rtol=1e-4, atol=1e-3)
+
+
+# Test of the resume from the checkpoint (failed chunk of precipitation, completed chunks never downloaded again)
+def test_opendap_chunk_resume(tmp_path, monkeypatch):
+
+    module = load_script('gfs/door_downloader_nwp_gfs_opendap.py', ['netCDF4'])
+    request_log, data_expected = set_opendap_source(module, monkeypatch, chunk_failed=(('apcpsfc', 5),))
+    ancillary_file = str(tmp_path / 'gfs_opendap.nc')
+
+    with pytest.raises(IOError):
+        run_opendap_source(module, ancillary_file)
+    with open(ancillary_file + '.done') as chunk_handle:
+        chunk_done = set(tuple(chunk_step) for chunk_step in json.load(chunk_handle)['chunks'])
+    chunk_all = set((var_name, time_start) for var_name in ['apcpsfc', 'tmp2m'] for time_start in [1, 5, 9])
+    assert ('apcpsfc', 5) in request_log and ('apcpsfc', 5) not in chunk_done
+    assert chunk_done and chunk_done < chunk_all
+
+    # Restart: only the chunks missing in the checkpoint are requested, blocks are decumulated with the resumed ones
+    request_log, data_expected = set_opendap_source(module, monkeypatch)
+    var_valid = run_opendap_source(module, ancillary_file)
+    assert sorted(request_log) == sorted(chunk_all - chunk_done)
+    assert var_valid == {'tp': True, 't2m': True}
+    check_opendap_source(ancillary_file, data_expected)
+    assert sorted(os.listdir(str(tmp_path))) == ['gfs_opendap.nc', 'limiter.db']
+
+
+# Test of the decumulation across blocks when the process dies after the fix is written (fix never applied twice)
+def test_opendap_block_fix_restart(tmp_path, monkeypatch):
+
+    module = load_script('gfs/door_downloader_nwp_gfs_opendap.py', ['netCDF4'])
+    request_log, data_expected = set_opendap_source(module, monkeypatch)
+    ancillary_file = str(tmp_path / 'gfs_opendap.nc')
+
+    os_remove = os.remove
+
+    def remove_file(file_path):
+        if file_path == ancillary_file + '.done':
+            raise KeyboardInterrupt('process killed before removing the checkpoint')
+        os_remove(file_path)
+    monkeypatch.setattr(module.os, 'remove', remove_file)
+    with pytest.raises(KeyboardInterrupt):
+        run_opendap_source(module, ancillary_file)
+    monkeypatch.setattr(module.os, 'remove', os_remove)
+
+    with open(ancillary_file + '.done') as chunk_handle:
+        assert json.load(chunk_handle)['block_fix_applied'] is True
+    check_opendap_source(ancillary_file, data_expected)
+
+    # Restart: every chunk is completed, the saved fix is written again and not subtracted a second time
+    request_n = len(request_log)
+    var_valid = run_opendap_source(module, ancillary_file)
+    assert len(request_log) == request_n
+    assert var_valid == {'tp': True, 't2m': True}
+    check_opendap_source(ancillary_file, data_expected)
+    assert sorted(os.listdir(str(tmp_path))) == ['gfs_opendap.nc', 'limiter.db']
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Method to serve the NetcdfSubset metadata (dataset.xml) of a historical gfs step
+def send_ncss_metadata(handler, var_list=('Temperature_height_above_ground',)):
+    send_data(handler, ('<?xml version="1.0" encoding="UTF-8"?><gridDataset location="gfs.grib2" path="ncss/grid">'
+                        '<gridSet name="time lat lon">' +
+                        ''.join('<grid name="' + var_name + '" desc="' + var_name + '" shape="time lat lon" '
+                                'type="float"/>' for var_name in var_list) +
+                        '</gridSet></gridDataset>').encode(), headers={'Content-Type': 'application/xml'})
+
+
+# Test of the http session of the NCSS client (one session for each thread, reused by the clients of the thread)
+def test_historical_ncss_thread_session(monkeypatch, http_server):
+
+    module = load_script('gfs/door_downloader_nwp_gfs_historical.py', ['siphon', 'netCDF4'])
+    http_server.source_handler = send_ncss_metadata
+
+    # Sessions record the url(s) they request (siphon also creates a session for each client, then replaced)
+    session_log = {}
+    create_session = module.session_manager.create_session
+
+    def create_session_log():
+        session_obj = create_session()
+        session_request = session_obj.request
+        session_log[id(session_obj)] = []
+
+        def request_log(method, url, *args, **kwargs):
+            session_log[id(session_obj)].append(url)
+            return session_request(method, url, *args, **kwargs)
+        session_obj.request = request_log
+        return session_obj
+    monkeypatch.setattr(module.session_manager, 'create_session', create_session_log)
+
+    ncss_sessions = {}
+
+    def create_ncss(thread_name):
+        ncss_list = [module.NCSSThread(http_server.url + '/thredds/ncss/grid/gfs.0p25.2026101700.f00' + str(step_id) +
+                                       '.grib2') for step_id in [3, 6]]
+        assert all(ncss_obj.variables == {'Temperature_height_above_ground'} for ncss_obj in ncss_list)
+        ncss_sessions[thread_name] = [ncss_obj._session for ncss_obj in ncss_list]
+    for thread_name in ['thread_a', 'thread_b']:
+        thread_obj = threading.Thread(target=create_ncss, args=(thread_name,))
+        thread_obj.start()
+        thread_obj.join()
+
+    # Clients of a thread share its session; sessions of different threads are distinct
+    assert ncss_sessions['thread_a'][0] is ncss_sessions['thread_a'][1]
+    assert ncss_sessions['thread_b'][0] is ncss_sessions['thread_b'][1]
+    assert ncss_sessions['thread_a'][0] is not ncss_sessions['thread_b'][0]
+    # Metadata of the clients are requested only through the session of their thread
+    assert sorted(session_id for session_id, session_urls in session_log.items() if session_urls) == sorted(
+        id(ncss_session[0]) for ncss_session in ncss_sessions.values())
+    assert sum(len(session_urls) for session_urls in session_log.values()) == len(http_server.request_log) == 4
+
+
+# Test of the catalog listing cache (fresh cache without request, expired cache revalidated with the ETag)
+def test_historical_get_catalog_listing(tmp_path, http_server):
+
+    module = load_script('gfs/door_downloader_nwp_gfs_historical.py', ['siphon', 'netCDF4'])
+    catalog_source = {'etag': '"v1"', 'steps': ['f000', 'f003']}
+
+    def source_handler(handler):
+        if handler.headers.get('If-None-Match') == catalog_source['etag']:
+            send_data(handler, b'', status=304, headers={'ETag': catalog_source['etag']})
+            return
+        send_data(handler, (
+            '<?xml version="1.0" encoding="UTF-8"?><catalog xmlns="http://www.unidata.ucar.edu/namespaces/thredds/'
+            'InvCatalog/v1.0"><service name="all" serviceType="Compound" base=""><service name="ncss" '
+            'serviceType="NetcdfSubset" base="/thredds/ncss/grid/"/></service><dataset name="gfs">' +
+            ''.join('<dataset name="gfs.' + step + '.grib2" urlPath="ds084.1/gfs.' + step + '.grib2"/>'
+                    for step in catalog_source['steps']) + '</dataset></catalog>').encode(),
+            headers={'Content-Type': 'application/xml', 'ETag': catalog_source['etag']})
+    http_server.source_handler = source_handler
+
+    catalog_url, cache_folder = http_server.url + '/thredds/catalog/ds084.1/catalog.xml', str(tmp_path / 'cache')
+    catalog_expected = [{'name': 'gfs.' + step + '.grib2',
+                         'ncss_url': http_server.url + '/thredds/ncss/grid/ds084.1/gfs.' + step + '.grib2'}
+                        for step in ['f000', 'f003']]
+
+    # First listing parsed from the catalog, then read from the fresh cache without any request
+    assert module.get_catalog_listing(catalog_url, cache_folder=cache_folder) == catalog_expected
+    assert module.get_catalog_listing(catalog_url, cache_folder=cache_folder) == catalog_expected
+    assert len(http_server.request_log) == 1 and 'If-None-Match' not in http_server.request_log[0]['headers']
+
+    # Expired cache of an unchanged catalog: revalidated (304) and listing reused
+    assert module.get_catalog_listing(catalog_url, cache_folder=cache_folder, cache_ttl=0) == catalog_expected
+    assert http_server.request_log[1]['headers'].get('If-None-Match') == '"v1"'
+
+    # Expired cache of an updated catalog: parsed again and cached with the new ETag
+    catalog_source.update({'etag': '"v2"', 'steps': ['f000', 'f003', 'f006']})
+    catalog_listing = module.get_catalog_listing(catalog_url, cache_folder=cache_folder, cache_ttl=0)
+    assert [catalog_step['name'] for catalog_step in catalog_listing] == [
+        'gfs.f000.grib2', 'gfs.f003.grib2', 'gfs.f006.grib2']
+    assert http_server.request_log[2]['headers'].get('If-None-Match') == '"v1"'
+    assert len(http_server.request_log) == 3
+    cache_files = os.listdir(cache_folder)
+    assert len(cache_files) == 1 and cache_files[0].endswith('.json')
+    with open(os.path.join(cache_folder, cache_files[0])) as cache_handle:
+        assert json.load(cache_handle)['etag'] == '"v2"'
+
+
+# Test of a run without forecast steps in the catalog (clear error instead of a failure on the empty cube)
+def test_historical_process_run_empty(tmp_path, monkeypatch):
+
+    module = load_script('gfs/door_downloader_nwp_gfs_historical.py', ['siphon', 'netCDF4'])
+    monkeypatch.setattr(module, 'get_catalog_listing', lambda *args, **kwargs: [
+        {'name': 'gfs.0p25.2026101700.f000.grib2', 'ncss_url': 'https://thredds.rda.ucar.edu/thredds/ncss/grid/f000'}])
+
+    data_settings = {
+        'data': {'dynamic': {'time': {'time_forecast_period': 12, 'time_forecast_frequency': 'h'},
+                             'outcome': {'folder': str(tmp_path / '{domain}'), 'filename': '{domain}_gfs.nc'},
+                             'variables': {'air_t': {'Temperature_height_above_ground': {
+                                 'varName': '2t', 'freq': 'h', 'out_group': 'sfc', 'height': 2}}}},
+                 'static': {'bounding_box': {'lon_left': 5, 'lon_right': 20, 'lat_bottom': 35, 'lat_top': 48}}},
+        'algorithm': {'template': {'run_date': '%Y%m%d'}, 'ancillary': {'domain': 'test', 'process_n': 2}}}
+
+    with pytest.raises(FileNotFoundError, match='No forecast step of run 2026101700'):
+        module.process_run(pd.Timestamp('2026-10-17 00:00').to_pydatetime(), data_settings)
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Test of the concurrent NCSS queries (one for each variable and time block) merged along the time dimension
+def test_ftp_retrieve_data_ncss(tmp_path, monkeypatch):
+
+    netCDF4 = pytest.importorskip('netCDF4')
+    module = load_script('gfs/door_downloader_nwp_gfs_ftp.py', ['siphon', 'netCDF4'])
+    monkeypatch.setattr(module, 'time', type('time', (), {'sleep': staticmethod(lambda sleep_wait: None)}))
+    NCSSQuery = pytest.importorskip('siphon.ncss').NCSSQuery
+
+    rng = np.random.default_rng(14)
+    time_run = pd.Timestamp('2026-10-17 00:00')
+    src_data = xr.Dataset(
+        {var_name: (('time', 'lat', 'lon'), rng.normal(size=(24, 5, 6)))
+         for var_name in ['Temperature_height_above_ground', 'Relative_humidity_height_above_ground']},
+        coords={'time': pd.date_range(time_run + pd.Timedelta('1h'), periods=24, freq='h'),
+                'lat': np.arange(40, 45), 'lon': np.arange(5, 11)})
+    query_log, query_failed, query_active = [], [], []
+    query_lock = threading.Lock()
+
+    # NCSS service answering each query with the requested variable and time range (first query of a block fails)
+    class SourceNCSS:
+        def query(self):
+            return NCSSQuery()
+
+        def get_data(self, query):
+            var_name = list(query.var)[0]
+            time_start, time_end = pd.Timestamp(query.time_query['time_start']), pd.Timestamp(query.time_query['time_end'])
+            with query_lock:
+                query_active.append(threading.get_ident())
+                query_log.append((var_name, time_start, len(query_active)))
+            time.sleep(0.1)
+            with query_lock:
+                query_active.remove(threading.get_ident())
+                if (var_name, time_start) == ('Temperature_height_above_ground', time_run + pd.Timedelta('7h')) \
+                        and not query_failed:
+                    query_failed.append(var_name)
+                    raise IOError('Query failed')
+            query_file = str(tmp_path / ('_'.join([var_name, time_start.strftime('%H'), str(len(query_log))]) + '.nc'))
+            src_data[[var_name]].sel(time=slice(time_start, time_end)).to_netcdf(query_file)
+            return netCDF4.Dataset(query_file)
+
+    data = module.retrieve_data_ncss(
+        SourceNCSS(), list(src_data.data_vars), {'lon_left': 5, 'lon_right': 10, 'lat_bottom': 40, 'lat_top': 44},
+        time_run + pd.Timedelta('1h'), time_run + pd.Timedelta('24h'), time_block=6, process_n=4)
+
+    # Four blocks of each variable (one retried), sent concurrently and merged without duplicated time steps
+    assert len(query_log) == 9 and query_failed == ['Temperature_height_above_ground']
+    assert sorted(set((var_name, time_start.hour) for var_name, time_start, _ in query_log)) == sorted(
+        (var_name, time_hour) for var_name in src_data.data_vars for time_hour in [1, 7, 13, 19])
+    assert max(query_n for _, _, query_n in query_log) > 1
+    for var_name in src_data.data_vars:
+        assert list(data[var_name]['time'].values) == list(src_data['time'].values)
+        np.testing.assert_allclose(data[var_name].values, src_data[var_name].values)
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Test of the conversion to the continuum standards (in-memory dataset, never written and opened again)
+def test_ftp_convert_data_standards(monkeypatch):
+
+    module = load_script('gfs/door_downloader_nwp_gfs_ftp.py', ['siphon', 'netCDF4'])
+
+    def open_dataset(*args, **kwargs):
+        raise AssertionError('dataset opened again during the conversion')
+    monkeypatch.setattr(module.xr, 'open_dataset', open_dataset)
+
+    rng = np.random.default_rng(15)
+    src_values = {var_name: rng.normal(size=(3, 4, 5)) for var_name in ['2t', '10u', '10v']}
+    src_values['2t'] += 288
+    lon_values = np.array([350, 355, 0, 5, 10])
+    out_file = xr.Dataset(
+        {var_name: (('time', 'latitude', 'longitude'), var_values) for var_name, var_values in src_values.items()},
+        coords={'time': pd.date_range('2026-10-17 01:00', periods=3, freq='h'), 'latitude': np.arange(40, 44),
+                'longitude': lon_values, 'reftime': pd.Timestamp('2026-10-17 00:00')})
+
+    out_file = module.convert_data_standards(
+        out_file, {'source_temperature_mesurement_unit': 'K', 'source_wind_separate_components': True})
+
+    assert sorted(out_file.data_vars) == ['10u', '10v', '10wind', '2t_C', '2t_K']
+    assert dict(out_file.sizes) == {'time': 3, 'lat': 4, 'lon': 5} and 'reftime' not in out_file.variables
+    assert list(out_file['lon'].values) == [-10, -5, 0, 5, 10]
+    np.testing.assert_allclose(out_file['2t_C'].values, src_values['2t'] - 273.15)
+    np.testing.assert_allclose(out_file['2t_K'].values, src_values['2t'])
+    np.testing.assert_allclose(out_file['10wind'].values, np.hypot(src_values['10u'], src_values['10v']))
+    assert out_file['2t_C'].attrs['units'] == 'C' and out_file['10wind'].attrs['standard_name'] == 'wind'
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Test of the icon domain remapping (sparse matrix restricted to the domain) against the global remapping and crop
+def test_icon_remap_domain(tmp_path, monkeypatch):
+
+    pytest.importorskip('scipy')
+    module = load_script('dwd/door_downloader_nwp_icon.py')
+
+    rng = np.random.default_rng(2)
+    src_n, lat_n, lon_n, links_n = 500, 18, 36, 3
+    dst_lat = np.linspace(-85, 85, lat_n)
+    dst_lon = np.linspace(-180, 170, lon_n)
+    dst_grid_lat, dst_grid_lon = np.meshgrid(dst_lat, dst_lon, indexing='ij')
+
+    # Each target cell is a weighted sum of three source cells (scrip order: longitude runs fastest)
+    dst_address = np.repeat(np.arange(lat_n * lon_n), links_n)
+    src_address = rng.integers(0, src_n, size=dst_address.size)
+    remap_weights = rng.random(dst_address.size)
+    weights_file = str(tmp_path / 'weights.nc')
+    xr.Dataset({'src_address': ('num_links', (src_address + 1).astype(np.int32)),
+                'dst_address': ('num_links', (dst_address + 1).astype(np.int32)),
+                'remap_matrix': (('num_links', 'num_wgts'), remap_weights[:, np.newaxis]),
+                'src_grid_center_lat': ('src_grid_size', np.zeros(src_n)),
+                'dst_grid_dims': ('dst_grid_rank', np.array([lon_n, lat_n], dtype=np.int32)),
+                'dst_grid_center_lat': ('dst_grid_size', np.deg2rad(dst_grid_lat.ravel()),
+                                        {'units': 'radians'}),
+                'dst_grid_center_lon': ('dst_grid_size', np.deg2rad(dst_grid_lon.ravel()),
+                                        {'units': 'radians'})}).to_netcdf(weights_file)
+
+    data_bbox = {'lon_left': -20, 'lon_right': 55, 'lat_top': 40, 'lat_bottom': -40}
+    remap_matrix, grid_lat, grid_lon = module.set_remap_matrix(weights_file, data_bbox)
+    monkeypatch.setattr(module, 'model_settings', {'remap_matrix': remap_matrix, 'lat': grid_lat, 'lon': grid_lon},
+                        raising=False)
+
+    src_values = rng.normal(size=src_n)
+    dst_values = np.zeros(lat_n * lon_n)
+    np.add.at(dst_values, dst_address, remap_weights * src_values[src_address])
+    da_global = xr.DataArray(dst_values.reshape(lat_n, lon_n), dims=['lat', 'lon'],
+                             coords={'lat': dst_lat, 'lon': dst_lon})
+    da_crop = da_global.where((da_global.lat <= data_bbox['lat_top']) & (da_global.lat >= data_bbox['lat_bottom']) &
+                              (da_global.lon >= data_bbox['lon_left']) & (da_global.lon <= data_bbox['lon_right']),
+                              drop=True)
+
+    np.testing.assert_allclose(grid_lat, da_crop.lat.values)
+    np.testing.assert_allclose(grid_lon, da_crop.lon.values)
+    np.testing.assert_allclose(module.remap_data(src_values), da_crop.values, rtol=1e-6, atol=1e-6)
+    assert remap_matrix.shape == (da_crop.size, src_n)
+
+
+# Test of the parser of an apache-style directory listing
+def test_icon_get_listing(monkeypatch):
+
+    module = load_script('dwd/door_downloader_nwp_icon.py')
+
+    listing_text = '\n'.join([
+        '<html><head><title>Index of /weather/nwp/icon/grib/00/tot_prec/</title></head><body><pre>',
+        '<a href="../">../</a>',
+        '<a href="icon_global_icosahedral_single-level_2026101700_001_TOT_PREC.grib2.bz2">'
+        'icon_global_icosahedral_single-level_2026101700_001_TOT_PREC.grib2.bz2</a>'
+        '   17-Oct-2026 03:41             5428807',
+        '<a href="icon_global_icosahedral_single-level_2026101700_002_TOT_PREC.grib2.bz2">'
+        'icon_global_icosahedral_single-level_2026101700_002_TOT_PREC.grib2.bz2</a>'
+        '   17-Oct-2026 03:42:10  5.2M',
+        '</pre></body></html>'])
+
+    class ListingResponse:
+        text = listing_text
+
+        def raise_for_status(self):
+            return None
+
+    monkeypatch.setattr(module.requests, 'get', lambda *args, **kwargs: ListingResponse())
+    listing = module.get_listing('https://opendata.dwd.de/weather/nwp/icon/grib/00/tot_prec/')
+
+    assert sorted(listing.keys()) == ['icon_global_icosahedral_single-level_2026101700_001_TOT_PREC.grib2.bz2',
+                                      'icon_global_icosahedral_single-level_2026101700_002_TOT_PREC.grib2.bz2']
+    step_1 = listing['icon_global_icosahedral_single-level_2026101700_001_TOT_PREC.grib2.bz2']
+    step_2 = listing['icon_global_icosahedral_single-level_2026101700_002_TOT_PREC.grib2.bz2']
+    assert step_1['size'] == 5428807 and step_1['time'] == pd.Timestamp('2026-10-17 03:41')
+    assert step_2['size'] == int(5.2 * 1024 ** 2) and step_2['time'] == pd.Timestamp('2026-10-17 03:42:10')
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Method to write the icon steps (bz2 grib files of one message of 4x5 values) served with the dwd folder layout
+def write_icon_source(tmp_path, var_list, step_list):
+    rng = np.random.default_rng(8)
+    src_files, in_out_files, var_files = {}, [], {}
+    for var_name in var_list:
+        os.makedirs(str(tmp_path / var_name), exist_ok=True)
+        var_files[var_name] = []
+        for step_id in step_list:
+            file_name = 'icon_global_icosahedral_single-level_2026101700_' + str(step_id).zfill(3) + '_' + \
+                        var_name.upper() + '.grib2.bz2'
+            file_path = str(tmp_path / var_name / ('frc_' + str(step_id).zfill(3) + '.grib2'))
+            write_grib(file_path, 0, 3, 0, 4, 4, 5, [rng.normal(size=(4, 5))])
+            src_files['/weather/nwp/icon/grib/00/' + var_name + '/' + file_name] = bz2.compress(
+                open(file_path, 'rb').read())
+            in_out_files.append(('/weather/nwp/icon/grib/00/' + var_name + '/' + file_name, file_path + '.bz2',
+                                 var_name))
+            var_files[var_name].append(file_path + '.bz2')
+    return src_files, in_out_files, var_files
+
+
+# Method to send an apache-style directory listing of the published file(s) of a folder
+def send_listing(handler, src_files, src_published):
+    listing_rows = ['<html><body><pre>', '<a href="../">../</a>']
+    for file_path in sorted(src_published):
+        if file_path.startswith(handler.path):
+            file_name = file_path[len(handler.path):]
+            listing_rows.append('<a href="' + file_name + '">' + file_name + '</a>   17-Oct-2026 03:41  ' +
+                                str(len(src_files[file_path])))
+    send_data(handler, '\n'.join(listing_rows + ['</pre></body></html>']).encode())
+
+
+# Method to create the process pool of the icon steps (remapping matrix of 4x5 source values to a 2x3 domain)
+def create_icon_pool(module):
+    remap_matrix = module.sp.csr_matrix(np.random.default_rng(9).random((6, 20)))
+    return module.ProcessPoolExecutor(max_workers=2, initializer=module.set_worker,
+                                      initargs=(remap_matrix, np.array([1.0, 2.0]), np.array([1.0, 2.0, 3.0]))), \
+        remap_matrix
+
+
+# Method to read the values of the first message of a grib file
+def read_grib_values(file_path):
+    with open(file_path, 'rb') as file_handle:
+        grib_id = eccodes.codes_grib_new_from_file(file_handle)
+    values = eccodes.codes_get_values(grib_id)
+    eccodes.codes_release(grib_id)
+    return values
+
+
+# Test of the listing re-poll loop (step published after the first poll, step never published)
+def test_icon_download_listing(tmp_path, http_server):
+
+    pytest.importorskip('scipy')
+    module = load_script('dwd/door_downloader_nwp_icon.py')
+
+    src_files, in_out_files, var_files = write_icon_source(tmp_path, ['tot_prec', 't_2m'], [1, 2, 3])
+    in_out_files = [(http_server.url + in_out_file[0],) + in_out_file[1:] for in_out_file in in_out_files]
+    step_late = [file_path for file_path in src_files if '_002_TOT_PREC' in file_path][0]
+    step_missing = [file_path for file_path in src_files if '_003_T_2M' in file_path][0]
+
+    listing_log, missing_log = {}, []
+
+    def source_handler(handler):
+        if handler.path.endswith('/'):
+            listing_log[handler.path] = listing_log.get(handler.path, 0) + 1
+            # Late step is published after the first listing of its folder, missing step is never published
+            src_published = [file_path for file_path in src_files if file_path != step_missing and
+                             (file_path != step_late or listing_log[handler.path] > 1)]
+            send_listing(handler, src_files, src_published)
+        elif handler.path == step_missing or (handler.path == step_late and
+                                              listing_log['/weather/nwp/icon/grib/00/tot_prec/'] < 2):
+            missing_log.append(handler.path)
+            send_data(handler, b'Not Found', status=404)
+        else:
+            send_data(handler, src_files[handler.path])
+    http_server.source_handler = source_handler
+
+    process_pool, remap_matrix = create_icon_pool(module)
+    out_vars = {}
+
+    def consume_vars():
+        for var_name, var_results in module.download_parallel(in_out_files, 2, process_pool, var_files,
+                                                              listing_settings={'poll_interval': 0.2, 'poll_max': 3}):
+            out_vars[var_name] = var_results
+    consumer = threading.Thread(target=consume_vars, daemon=True)
+    try:
+        consumer.start()
+        consumer.join(timeout=60)
+        assert not consumer.is_alive()
+    finally:
+        process_pool.shutdown(cancel_futures=True)
+
+    grib_log = [request['path'] for request in http_server.request_log if not request['path'].endswith('/')]
+    assert sorted(out_vars) == ['t_2m', 'tot_prec']
+    assert missing_log == []
+    assert grib_log.count(step_late) == 1 and grib_log.count(step_missing) == 0
+    assert sorted(grib_log) == sorted(file_path for file_path in src_files if file_path != step_missing)
+    # Initial listing and poll_max polls of the folder of the missing step, one poll for the late step
+    assert listing_log == {'/weather/nwp/icon/grib/00/tot_prec/': 2, '/weather/nwp/icon/grib/00/t_2m/': 4}
+
+    for in_out_file in in_out_files:
+        out_result = out_vars[in_out_file[2]][in_out_file[1]]
+        if in_out_file[0].endswith(step_missing):
+            assert out_result is None
+        else:
+            np.testing.assert_allclose(out_result[0].ravel(),
+                                       remap_matrix.dot(read_grib_values(in_out_file[1][:-len('.bz2')])),
+                                       rtol=1e-5)
+
+
+# Method to serve the icon steps with a random latency for each url (a slow step and a failing step)
+def set_icon_latency(http_server, src_files, step_slow, step_failed):
+    rng = np.random.default_rng(10)
+    src_latency = {file_path: rng.uniform(0, 0.05) for file_path in src_files}
+    src_latency[step_slow] = 1.5
+    slow_log = []
+
+    def source_handler(handler):
+        time.sleep(src_latency[handler.path])
+        if handler.path == step_failed:
+            send_data(handler, b'Internal Server Error', status=500)
+            return
+        send_data(handler, src_files[handler.path])
+        if handler.path == step_slow:
+            slow_log.append(time.time())
+    http_server.source_handler = source_handler
+    return slow_log
+
+
+# Test of the single download queue (each variable yielded once and as soon as its steps are computed)
+def test_icon_download_parallel(tmp_path, http_server):
+
+    pytest.importorskip('scipy')
+    module = load_script('dwd/door_downloader_nwp_icon.py')
+
+    src_files, in_out_files, var_files = write_icon_source(tmp_path, ['tot_prec', 't_2m', 'u_10m'], [1, 2, 3, 4])
+    in_out_files = [(http_server.url + in_out_file[0],) + in_out_file[1:] for in_out_file in in_out_files]
+    step_slow = [file_path for file_path in src_files if '_004_T_2M' in file_path][0]
+    step_failed = [file_path for file_path in src_files if '_002_U_10M' in file_path][0]
+    slow_log = set_icon_latency(http_server, src_files, step_slow, step_failed)
+
+    process_pool, remap_matrix = create_icon_pool(module)
+    out_vars, out_times = [], {}
+    try:
+        for var_name, var_results in module.download_parallel(in_out_files, 4, process_pool, var_files):
+            out_vars.append(var_name)
+            out_times[var_name] = time.time()
+            assert sorted(var_results) == sorted(var_files[var_name])
+            for file_path, out_result in var_results.items():
+                if file_path.endswith('_002.grib2.bz2') and var_name == 'u_10m':
+                    assert out_result is None
+                else:
+                    np.testing.assert_allclose(out_result[0].ravel(),
+                                               remap_matrix.dot(read_grib_values(file_path[:-len('.bz2')])),
+                                               rtol=1e-5)
+    finally:
+        process_pool.shutdown(cancel_futures=True)
+
+    assert sorted(out_vars) == ['t_2m', 'tot_prec', 'u_10m']
+    # Variables without the slow step are yielded before the slow step is downloaded
+    assert out_vars[-1] == 't_2m'
+    assert out_times['tot_prec'] < slow_log[0] and out_times['u_10m'] < slow_log[0]
+
+
+# Test of the shutdown of the thread and process pools when the consumer of the variables fails
+def test_icon_download_parallel_failed(tmp_path, monkeypatch, http_server):
+
+    pytest.importorskip('scipy')
+    module = load_script('dwd/door_downloader_nwp_icon.py')
+
+    src_files, in_out_files, var_files = write_icon_source(tmp_path, ['tot_prec', 't_2m'], [1, 2, 3])
+    in_out_files = [(http_server.url + in_out_file[0],) + in_out_file[1:] for in_out_file in in_out_files]
+    step_slow = [file_path for file_path in src_files if '_003_T_2M' in file_path][0]
+    set_icon_latency(http_server, src_files, step_slow, None)
+
+    thread_pools = []
+    thread_pool_class = module.ThreadPool
+
+    def create_thread_pool(*args):
+        thread_pools.append(thread_pool_class(*args))
+        return thread_pools[-1]
+    monkeypatch.setattr(module, 'ThreadPool', create_thread_pool)
+
+    process_pool, _ = create_icon_pool(module)
+    out_iterator = module.download_parallel(in_out_files, 4, process_pool, var_files)
+    try:
+        with pytest.raises(RuntimeError, match='consumer failed'):
+            try:
+                for var_name, var_results in out_iterator:
+                    raise RuntimeError('consumer failed on ' + var_name)
+            finally:
+                out_iterator.close()
+
+        with pytest.raises(ValueError):
+            thread_pools[0].apply_async(print)
+        with pytest.raises(RuntimeError):
+            process_pool.submit(print)
+    finally:
+        process_pool.shutdown(cancel_futures=True)
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Test of the cmc step assembler (crop against the previous xarray crop, steps not decoded left as nan)
+def test_cmc_read_data_grib(tmp_path):
+
+    module = load_script('cmc/door_downloader_nwp_cmc-gdps.py', ['cdo'])
+
+    lat_n, lon_n = 361, 720
+    values = np.random.default_rng(4).normal(size=(lat_n, lon_n))
+    file_list = [str(tmp_path / 'frc_003.grib2'), str(tmp_path / 'frc_006.grib2'), str(tmp_path / 'frc_009.grib2')]
+    write_grib(file_list[0], -90, 90, -180, 179.5, lat_n, lon_n, [values])
+    write_grib(file_list[2], -90, 90, -180, 179.5, lat_n, lon_n, [values + 1])
+    with open(file_list[1], 'wb') as file_handle:
+        file_handle.write(open(file_list[0], 'rb').read()[:500])
+
+    data_bbox = {'lon_left': -20, 'lon_right': 55, 'lat_top': 40, 'lat_bottom': -40}
+    time_run = pd.Timestamp('2026-10-17 00:00')
+    da_var = module.read_data_grib(file_list, [3, 6, 9], time_run, data_bbox, 2)
+
+    with open(file_list[0], 'rb') as file_handle:
+        grib_id = eccodes.codes_grib_new_from_file(file_handle)
+    values_grib = eccodes.codes_get_values(grib_id)
+    eccodes.codes_release(grib_id)
+    da_global = xr.DataArray(values_grib.reshape(lat_n, lon_n), dims=['latitude', 'longitude'],
+                             coords={'latitude': np.linspace(-90, 90, lat_n),
+                                     'longitude': np.linspace(-180, 179.5, lon_n)})
+    da_crop = da_global.where((da_global.latitude <= data_bbox['lat_top']) &
+                              (da_global.latitude >= data_bbox['lat_bottom']) &
+                              (da_global.longitude >= data_bbox['lon_left']) &
+                              (da_global.longitude <= data_bbox['lon_right']), drop=True)
+
+    assert list(da_var.time.values) == list(pd.DatetimeIndex([time_run + pd.Timedelta(hours=t) for t in [3, 6, 9]]))
+    np.testing.assert_allclose(da_var.lat.values, da_crop.latitude.values)
+    np.testing.assert_allclose(da_var.lon.values, da_crop.longitude.values)
+    np.testing.assert_allclose(da_var.values[0], da_crop.values, rtol=1e-6)
+    assert np.all(np.isnan(da_var.values[1]))
+    np.testing.assert_allclose(da_var.values[2], da_crop.values + 1, rtol=1e-5, atol=1e-5)
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Test of the global and domain outcome(s) of a member (written to temporary files and renamed when complete)
+@pytest.mark.parametrize('script_path', ['gfs/door_downloader_nwp_gfs_nomads.py',
+                                         'gefs/door_downloader_nwp_gefs_nomads.py'])
+def test_nomads_arrange_data_outcome_grib(tmp_path, monkeypatch, script_path):
+
+    module = load_script(script_path, ['cdo'])
+    replace_log = record_replace(monkeypatch, module)
+
+    values_list = [np.random.default_rng(12).normal(size=(25, 31)) for step_id in range(2)]
+    src_path = str(tmp_path / 'gfs_step.grib2')
+    write_grib(src_path, 60, -60, 0, 30, 25, 31, values_list, grib_keys={'shortName': '2t'})
+
+    out_folder = tmp_path / 'outcome'
+    out_folder.mkdir()
+    dst_list = [str(out_folder / 'gfs_domain.nc'), str(out_folder / 'gfs_global.nc')]
+    data_bbox = {'lon_left': 5, 'lon_right': 20, 'lat_bottom': -30, 'lat_top': 30}
+    module.arrange_data_outcome_grib({'sfc': [src_path]}, {'sfc': dst_list[1]}, {'sfc': dst_list[0]},
+                                     data_bbox=data_bbox)
+
+    assert sorted(os.listdir(str(out_folder))) == ['gfs_domain.nc', 'gfs_global.nc']
+    assert sorted(replace_step[1] for replace_step in replace_log) == dst_list
+    with xr.open_dataset(dst_list[0]) as dset_domain:
+        assert dset_domain['2t'].shape == (2, 13, 16)
+# -------------------------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------------------------
+# Test of the stacked ensemble outcome (member order, one chunk for each member) and of the statistics outcome
+@pytest.mark.parametrize('file_format', ['netcdf', 'zarr'])
+def test_gefs_arrange_data_outcome_ensemble(tmp_path, monkeypatch, file_format):
+
+    module = load_script('gefs/door_downloader_nwp_gefs_nomads.py', ['cdo', 'netCDF4'])
+    if file_format == 'zarr':
+        pytest.importorskip('zarr')
+    replace_log = record_replace(monkeypatch, module)
+
+    rng = np.random.default_rng(11)
+    ens_members = [3, 1, 2]
+    src_data_members, src_values = [], []
+    for ens_member in ens_members:
+        values_list = [rng.normal(size=(25, 31)) for step_id in range(2)]
+        file_path = str(tmp_path / ('gefs_member_' + str(ens_member) + '.grib2'))
+        write_grib(file_path, 60, -60, 0, 30, 25, 31, values_list, grib_keys={'shortName': '2t'})
+        src_data_members.append({'sfc': [file_path]})
+        src_values.append(np.stack(values_list))
+
+    out_folder = tmp_path / 'outcome'
+    out_folder.mkdir()
+    dst_data = {'sfc': str(out_folder / ('gefs_ensemble.' + ('zarr' if file_format == 'zarr' else 'nc')))}
+    dst_data_stats = {'sfc': str(out_folder / 'gefs_stats.nc')}
+    data_bbox = {'lon_left': 5, 'lon_right': 20, 'lat_bottom': -30, 'lat_top': 30}
+    module.arrange_data_outcome_ensemble(src_data_members, dst_data, ens_members, data_bbox=data_bbox, process_n=2,
+                                         file_format=file_format, dst_data_stats=dst_data_stats,
+                                         stats_settings={'percentiles': [50], 'thresholds': {}})
+
+    # Outcome(s) appear only by renaming complete temporary file(s)
+    dst_list = sorted([dst_data['sfc'], dst_data_stats['sfc']])
+    assert sorted(os.listdir(str(out_folder))) == [os.path.basename(dst_path) for dst_path in dst_list]
+    assert sorted(str(replace_step[1]) for replace_step in replace_log if str(replace_step[1]) in dst_list) == dst_list
+
+    if file_format == 'zarr':
+        dset_ensemble = xr.open_zarr(dst_data['sfc'])
+        var_chunks = dset_ensemble['2t'].encoding['chunks']
+    else:
+        dset_ensemble = xr.open_dataset(dst_data['sfc'])
+        var_chunks = dset_ensemble['2t'].encoding['chunksizes']
+    lat_idx = np.where((np.linspace(60, -60, 25) >= -30) & (np.linspace(60, -60, 25) <= 30))[0]
+    lon_idx = np.where((np.linspace(0, 30, 31) >= 5) & (np.linspace(0, 30, 31) <= 20))[0]
+
+    assert list(dset_ensemble['member'].values) == ens_members
+    assert dset_ensemble['2t'].dims == ('member', 'time', 'lat', 'lon')
+    assert tuple(var_chunks) == (1, 2, lat_idx.size, lon_idx.size)
+    for member_id, member_values in enumerate(src_values):
+        np.testing.assert_allclose(dset_ensemble['2t'].values[member_id],
+                                   member_values[:, lat_idx][:, :, lon_idx], rtol=1e-5, atol=1e-5)
+
+    with xr.open_dataset(dst_data_stats['sfc']) as dset_stats:
+        np.testing.assert_allclose(dset_stats['2t_mean'].values, dset_ensemble['2t'].values.mean(axis=0), atol=1e-5)
+    dset_ensemble.close()
+
+
+# -------------------------------------------------------------------------------------
+# Test of the streaming ensemble statistics (welford and P2 percentiles) against the stacked members
+@pytest.mark.parametrize('members_n', [5, 31])
+def test_gefs_stats_ensemble(members_n):
+
+    module = load_script('gefs/door_downloader_nwp_gefs_nomads.py', ['cdo'])
+
+    rng = np.random.default_rng(3)
+    coords = {'time': pd.date_range('2026-10-17 03:00', periods=2, freq='3h'),
+              'lat': np.arange(20.0), 'lon': np.arange(25.0)}
+    members = rng.normal(loc=2.0, scale=1.5, size=(members_n, 2, 20, 25)).astype(np.float32)
+    members[:, 0, 0, 0] = np.nan
+    members_valid = np.ones((2, 20, 25), dtype=bool)
+    members_valid[0, 0, 0] = False
+    stats_settings = {'percentiles': [10, 50, 90], 'thresholds': {'tp': [2.0]}}
+
+    stats_obj = None
+    for member_values in members:
+        dset_member = xr.Dataset({'tp': (('time', 'lat', 'lon'), member_values)}, coords=coords)
+        if stats_obj is None:
+            stats_obj = module.create_stats_ensemble(dset_member, stats_settings)
+        module.update_stats_ensemble(stats_obj, dset_member)
+    dset_stats = module.compute_stats_ensemble(stats_obj, stats_settings)
+
+    np.testing.assert_allclose(dset_stats['tp_mean'].values, np.mean(members, axis=0), atol=1e-5)
+    np.testing.assert_allclose(dset_stats['tp_std'].values, np.std(members, axis=0, ddof=1), atol=1e-5)
+    np.testing.assert_allclose(dset_stats['tp_prob_gt2.0'].values[members_valid],
+                               np.mean(members > 2.0, axis=0)[members_valid], atol=1e-6)
+    for var_stat in ['tp_mean', 'tp_std', 'tp_p50', 'tp_prob_gt2.0']:
+        assert np.isnan(dset_stats[var_stat].values[0, 0, 0])
+
+    for var_perc in [10, 50, 90]:
+        perc_estimate = dset_stats['tp_p' + str(var_perc)].values[members_valid]
+        perc_exact = np.percentile(members, var_perc, axis=0)[members_valid]
+        if members_n < 2 * len(stats_settings['percentiles']) + 3:
+            # Fewer members than markers: percentiles are computed from the stored values
+            np.testing.assert_allclose(perc_estimate, perc_exact, atol=1e-5)
+        else:
+            assert np.mean(np.abs(perc_estimate - perc_exact)) < 0.25 * 1.5
+# -------------------------------------------------------------------------------------